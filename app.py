@@ -1,4 +1,5 @@
 import os
+import re
 from flask import Flask, render_template, request, redirect, url_for, flash, jsonify, make_response, g, send_file
 from sqlalchemy.exc import IntegrityError, OperationalError
 from sqlalchemy import func, distinct
@@ -16,25 +17,41 @@ from flask_socketio import SocketIO, emit
 from openpyxl import Workbook
 from openpyxl.styles import Font, Alignment, PatternFill, Border, Side
 from io import BytesIO
-
-from database import db, Config, MonitoredGroup, Keyword, MatchedMessage, DB_URI, User, Session, auto_upgrade_database
-from telegram_monitor import start_monitoring, stop_monitoring, is_running, keyword_automatons, automatons_lock
+from collections import Counter
+from markupsafe import Markup, escape
+
+from database import db, Config, config_cache, MonitoredGroup, Keyword, MatchedMessage, MatchedKeywordSpan, DB_URI, DB_POOL_OPTIONS, User, Session, auto_upgrade_database, bind_engine, get_pool_status
+from keyword_engine import (KEYWORD_LITERAL, KEYWORD_REGEX, KEYWORD_RULE, REGEX_ALLOW_UNFILTERED, REGEX_MIN_LITERAL,
+                            compile_keyword_pattern, required_literals)
+from keyword_rules import RuleSyntaxError, parse_rule
+from text_normalize import stripped_symbols
+from telegram_monitor import start_monitoring, stop_monitoring, is_running, invalidate_keyword_matcher, group_index, keyword_engine, entity_cache, chat_id_aliases
+from match_writer import match_writer
+from message_dedup import duplicate_filter
+from ocr_cache import ocr_cache
+from ocr_engine import ocr_engine
+from notifier import notification_dispatcher, alert_digester
 from telegram_utils import get_group_details, get_my_groups, batch_join_groups
+from backfill import BACKFILL_DAYS, run_backfill
 
 app = Flask(__name__)
 app.config['SQLALCHEMY_DATABASE_URI'] = DB_URI
 app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
+app.config['SQLALCHEMY_ENGINE_OPTIONS'] = DB_POOL_OPTIONS
 app.config['SECRET_KEY'] = os.environ.get('FLASK_SECRET_KEY', 'your_very_secret_key_here_please_change_me')
 
 # 初始化 SocketIO
 socketio = SocketIO(app, cors_allowed_origins="*", async_mode='threading')
 
 batch_join_tasks = {}
+backfill_tasks = {}
 tasks_lock = Lock()
 
 db.init_app(app)
 
 with app.app_context():
+    # 性能优化: 监控线程与OCR线程共用 Flask 的数据库引擎（同一个连接池）
+    bind_engine(db.engine)
     db.create_all()
     # 自动检查并升级数据库结构
     auto_upgrade_database()
@@ -67,9 +84,8 @@ def load_logged_in_user():
     g.user = check_session_and_renew()
 
 def check_config_exists():
-    """检查 Telegram 配置是否存在"""
-    config = Config.query.first()
-    return config is not None
+    """检查 Telegram 配置是否存在（读取进程内缓存的配置快照，不逐请求查询数据库）"""
+    return config_cache.get() is not None
 
 # 免配置检查的路由
 NO_CONFIG_ALLOWED = {'setup', 'static', 'login', 'logout', 'verify', 'verify_status'}
@@ -99,8 +115,7 @@ def login_required(f):
 @app.route('/setup', methods=['GET', 'POST'])
 def setup():
     """Telegram API 配置向导（网页端）"""
-    config = Config.query.first()
-    if config:
+    if config_cache.get():
         # 已有配置，跳转到登录页
         return redirect(url_for('login'))
 
@@ -128,6 +143,7 @@ def setup():
         )
         db.session.add(new_config)
         db.session.commit()
+        config_cache.invalidate()
 
         flash('Telegram 配置已保存！正在启动监控服务...', 'success')
 
@@ -166,7 +182,7 @@ def verify():
         return redirect(url_for('verify'))
 
     # 获取手机号用于显示（隐藏中间几位）
-    config = Config.query.first()
+    config = config_cache.get()
     phone_display = ''
     if config and config.phone_number:
         p = config.phone_number
@@ -360,19 +376,34 @@ def dashboard_hot_keywords():
         else:  # all
             start_date = datetime(2000, 1, 1)
         
-        # 统计关键词频率
-        keyword_stats = db.session.query(
-            MatchedMessage.matched_keyword,
-            func.count(MatchedMessage.matched_keyword).label('count')
+        # 统计关键词频率: 有命中区间记录的消息按区间表统计（一条消息命中多个关键词时分别计数）
+        span_stats = db.session.query(
+            MatchedKeywordSpan.keyword_text,
+            func.count(distinct(MatchedKeywordSpan.message_id)).label('count')
+        ).join(
+            MatchedMessage, MatchedKeywordSpan.message_id == MatchedMessage.id
         ).filter(
             MatchedMessage.message_date >= start_date
+        ).group_by(
+            MatchedKeywordSpan.keyword_text
+        ).all()
+
+        # 没有区间记录的旧消息仍按 matched_keyword 统计
+        legacy_stats = db.session.query(
+            MatchedMessage.matched_keyword,
+            func.count(MatchedMessage.id).label('count')
+        ).filter(
+            MatchedMessage.message_date >= start_date,
+            ~MatchedMessage.spans.any()
         ).group_by(
             MatchedMessage.matched_keyword
-        ).order_by(
-            func.count(MatchedMessage.matched_keyword).desc()
-        ).limit(limit).all()
+        ).all()
+
+        keyword_counter = Counter()
+        for kw, cnt in list(span_stats) + list(legacy_stats):
+            keyword_counter[kw] += cnt
         
-        result = [{'keyword': kw, 'count': cnt} for kw, cnt in keyword_stats]
+        result = [{'keyword': kw, 'count': cnt} for kw, cnt in keyword_counter.most_common(limit)]
         
         return jsonify(result)
     except Exception as e:
@@ -552,6 +583,7 @@ def config():
             db.session.add(config_item)
         
         db.session.commit()
+        config_cache.invalidate()
         flash('配置已成功保存！', 'success')
         return redirect(url_for('config'))
 
@@ -626,6 +658,73 @@ def stop_batch_join(task_id):
     return jsonify({'error': '任务未找到或已结束'}), 404
 
 
+def start_backfill_task(keyword_ids, days):
+    """创建历史消息回溯任务并在后台线程中运行，返回任务ID"""
+    task_id = str(uuid.uuid4())
+    with tasks_lock:
+        backfill_tasks[task_id] = {
+            'status': 'pending',
+            'log': ['[INFO] 任务已创建，正在等待后台线程启动...'],
+            'stop_requested': False,
+            'keyword_ids': keyword_ids,
+            'days': days,
+            'task_key': None,
+            'total': 0,
+            'current': 0,
+            'scanned': 0,
+            'matched': 0,
+            'groups': {},
+        }
+
+    thread = Thread(target=run_backfill, args=(task_id, keyword_ids, days, backfill_tasks, tasks_lock))
+    thread.daemon = True
+    thread.start()
+    return task_id
+
+@app.route('/api/backfill', methods=['POST'])
+@login_required
+def start_backfill():
+    data = request.get_json() or {}
+    try:
+        keyword_ids = [int(keyword_id) for keyword_id in data.get('keyword_ids', [])]
+        days = int(data.get('days', BACKFILL_DAYS))
+    except (ValueError, TypeError):
+        return jsonify({'error': '参数格式不正确。'}), 400
+    if not keyword_ids:
+        return jsonify({'error': '关键词列表不能为空。'}), 400
+    from telegram_monitor import is_running as tg_running
+    if not tg_running:
+        return jsonify({'error': '监控未启动，无法回溯历史消息。'}), 400
+    days = max(1, min(days, 365))
+
+    return jsonify({'task_id': start_backfill_task(keyword_ids, days)})
+
+@app.route('/api/backfill/status/<task_id>', methods=['GET'])
+@login_required
+def get_backfill_status(task_id):
+    with tasks_lock:
+        task = backfill_tasks.get(task_id)
+        if task:
+            task = dict(task, log=list(task['log']), groups={name: dict(info) for name, info in task['groups'].items()})
+
+    if not task:
+        return jsonify({'error': '任务未找到'}), 404
+
+    return jsonify(task)
+
+@app.route('/api/backfill/stop/<task_id>', methods=['POST'])
+@login_required
+def stop_backfill(task_id):
+    with tasks_lock:
+        task = backfill_tasks.get(task_id)
+        if task and task['status'] in ('pending', 'running'):
+            task['stop_requested'] = True
+            task['log'].append('[INFO] 收到停止请求，将在当前批次写入后中止...')
+            return jsonify({'message': '停止请求已发送。'})
+
+    return jsonify({'error': '任务未找到或已结束'}), 404
+
+
 @app.route('/status')
 @login_required # 添加鉴权装饰器
 def status():
@@ -633,10 +732,27 @@ def status():
     is_alive = client_thread is not None and client_thread.is_alive()
     return jsonify({'is_running': is_alive})
 
+@app.route('/api/metrics')
+@login_required
+def metrics():
+    """运行时性能指标（连接池等）"""
+    return jsonify({
+        'db_pool': get_pool_status(),
+        'keyword_engine': keyword_engine.get_stats(),
+        'match_writer': match_writer.get_stats(),
+        'notifier': notification_dispatcher.get_stats(),
+        'alert_digest': alert_digester.get_stats(),
+        'config_cache': config_cache.get_stats(),
+        'entity_cache': entity_cache.get_stats(),
+        'dedup': duplicate_filter.get_stats(),
+        'ocr': ocr_engine.get_stats(),
+        'ocr_cache': ocr_cache.get_stats()
+    })
+
 @app.route('/control/test_dingtalk', methods=['POST'])
 @login_required # 添加鉴权装饰器
 def test_dingtalk():
-    config = Config.query.first()
+    config = config_cache.get()
     if not config or not config.dingtalk_webhook:
         flash('请先保存钉钉Webhook地址。', 'warning')
         return redirect(url_for('config'))
@@ -644,7 +760,7 @@ def test_dingtalk():
     title = "测试消息"
     message = "这是一条来自Telegram监控系统的测试消息。"
     
-    from telegram_monitor import send_to_dingtalk
+    from notifier import send_to_dingtalk
     result = send_to_dingtalk(config.dingtalk_webhook, config.dingtalk_secret, title, message, is_test=True)
     
     flash(f'钉钉测试结果: {result}', 'info')
@@ -653,7 +769,7 @@ def test_dingtalk():
 @app.route('/control/test_wecom', methods=['POST'])
 @login_required # 添加鉴权装饰器
 def test_wecom():
-    config = Config.query.first()
+    config = config_cache.get()
     if not config or not config.wecom_webhook:
         flash('请先保存企业微信Webhook地址。', 'warning')
         return redirect(url_for('config'))
@@ -661,13 +777,18 @@ def test_wecom():
     title = "测试消息"
     message = "这是一条来自Telegram监控系统的测试消息。\n\n> **测试项目**: 企业微信机器人\n> **测试时间**: " + datetime.now().strftime('%Y-%m-%d %H:%M:%S')
     
-    from telegram_monitor import send_to_wecom
+    from notifier import send_to_wecom
     result = send_to_wecom(config.wecom_webhook, title, message, is_test=True)
     
     flash(f'企业微信测试结果: {result}', 'info')
     return redirect(url_for('config'))
 
 
+def find_monitored_group(identifier):
+    """按群组ID查找已监控的群组（-100xxx / xxx / -xxx 视为同一个群组）"""
+    return MonitoredGroup.query.filter(MonitoredGroup.group_identifier.in_(chat_id_aliases(identifier))).first()
+
+
 @app.route('/groups', methods=['GET', 'POST'])
 @login_required # 添加鉴权装饰器
 def groups():
@@ -680,6 +801,8 @@ def groups():
 
                 if details.get('error'):
                     flash(f"添加失败: {details['error']}", 'danger')
+                elif find_monitored_group(details['identifier']):
+                    flash(f"群组 '{details['name']}' 已经存在。", 'danger')
                 else:
                     new_group = MonitoredGroup(
                         group_identifier=details['identifier'], 
@@ -689,6 +812,7 @@ def groups():
                     db.session.add(new_group)
                     try:
                         db.session.commit()
+                        group_index.refresh()
                         flash(f"群组 '{details['name']}' 添加成功！", 'success')
                     except IntegrityError:
                         db.session.rollback()
@@ -738,7 +862,9 @@ def add_my_groups_page():
 @login_required # 添加鉴权装饰器
 def api_get_my_groups():
     try:
-        monitored_ids = {g.group_identifier for g in MonitoredGroup.query.all()}
+        monitored_ids = set()
+        for group in MonitoredGroup.query.all():
+            monitored_ids.update(chat_id_aliases(group.group_identifier))
     finally:
         db.session.remove()
 
@@ -757,14 +883,17 @@ def batch_add_groups():
     groups_to_add = request.form.getlist('groups')
     added_count = 0
     skipped_count = 0
+    added_ids = set()
     for group_data in groups_to_add:
         parts = group_data.split('|||')
         if len(parts) != 3: continue
 
         group_id, group_name, logo_path = parts
         
-        exists = MonitoredGroup.query.filter_by(group_identifier=group_id).first()
+        aliases = chat_id_aliases(group_id)
+        exists = not aliases.isdisjoint(added_ids) or find_monitored_group(group_id)
         if not exists:
+            added_ids.update(aliases)
             new_group = MonitoredGroup(
                 group_identifier=group_id,
                 group_name=group_name,
@@ -777,6 +906,7 @@ def batch_add_groups():
     
     if added_count > 0:
         db.session.commit()
+        group_index.refresh()
         flash(f'成功添加 {added_count} 个新群组！', 'success')
     if skipped_count > 0:
         flash(f'跳过 {skipped_count} 个已存在的群组。', 'info')
@@ -784,12 +914,30 @@ def batch_add_groups():
     return redirect(url_for('groups'))
 
 
+@app.route('/groups/toggle_priority/<int:group_id>')
+@login_required
+def toggle_group_priority(group_id):
+    group = MonitoredGroup.query.get_or_404(group_id)
+    group.priority = 0 if group.priority else 1
+    db.session.commit()
+
+    # 刷新群组索引，新的优先级对之后的图片生效
+    group_index.refresh()
+
+    flash(f"群组 '{group.group_name}' 已{'设为重要群组（图片优先识别）' if group.priority else '取消重要标记'}。", 'info')
+    return redirect(url_for('groups'))
+
 @app.route('/groups/delete/<int:group_id>')
 @login_required # 添加鉴权装饰器
 def delete_group(group_id):
     group_to_delete = MonitoredGroup.query.get_or_404(group_id)
     db.session.delete(group_to_delete)
     db.session.commit()
+
+    # 性能优化: 同步刷新群组索引，并让关键词匹配器重新构建
+    group_index.refresh()
+    invalidate_keyword_matcher()
+
     flash('群组已删除。', 'info')
     return redirect(url_for('groups'))
 
@@ -808,6 +956,9 @@ def batch_delete_groups():
         db.session.delete(group)
 
     db.session.commit()
+
+    group_index.refresh()
+    invalidate_keyword_matcher()
     flash(f'成功删除 {deleted_count} 个群组!', 'success')
     return redirect(url_for('groups'))
 
@@ -817,6 +968,9 @@ def keywords():
     if request.method == 'POST':
         keywords_text = request.form.get('keywords_text', '').strip()
         group_ids = request.form.getlist('groups')
+        keyword_type = request.form.get('keyword_type')
+        if keyword_type not in (KEYWORD_REGEX, KEYWORD_RULE):
+            keyword_type = KEYWORD_LITERAL
 
         if not keywords_text:
             flash('关键词列表不能为空。', 'danger')
@@ -826,31 +980,64 @@ def keywords():
             keywords_list = [kw.strip() for kw in keywords_text.splitlines() if kw.strip()]
             added_count = 0
             skipped_count = 0
+            invalid_patterns = []
+            new_keywords = []
             groups = MonitoredGroup.query.filter(MonitoredGroup.id.in_(group_ids)).all()
 
             for keyword_text in keywords_list:
+                try:
+                    if keyword_type == KEYWORD_REGEX:
+                        compile_keyword_pattern(keyword_text)
+                    elif keyword_type == KEYWORD_RULE:
+                        parse_rule(keyword_text)
+                except (re.error, RuleSyntaxError) as e:
+                    invalid_patterns.append(f'{keyword_text}（{e}）')
+                    continue
+                # 没有固定文字的正则无法预筛选，要对每条消息执行，一个就会拖慢全部消息的处理
+                if (keyword_type == KEYWORD_REGEX and not REGEX_ALLOW_UNFILTERED
+                        and required_literals(keyword_text) is None):
+                    invalid_patterns.append(f'{keyword_text}（需要包含至少 {REGEX_MIN_LITERAL} 个字的固定文字）')
+                    continue
+                # 开启删除标点时，含标点的关键词会变成另一个词（c# → c、1.5 → 15），不允许添加
+                symbols = stripped_symbols(keyword_text) if keyword_type == KEYWORD_LITERAL else ''
+                if symbols:
+                    invalid_patterns.append(f'{keyword_text}（{symbols} 在匹配时会被忽略）')
+                    continue
                 existing_keyword = Keyword.query.filter_by(text=keyword_text).first()
                 if existing_keyword:
                     skipped_count += 1
                 else:
-                    new_keyword = Keyword(text=keyword_text)
+                    new_keyword = Keyword(text=keyword_text, keyword_type=keyword_type)
                     new_keyword.groups.extend(groups)
                     db.session.add(new_keyword)
+                    new_keywords.append(new_keyword)
                     added_count += 1
             
             if added_count > 0:
                 db.session.commit()
                 
-                # 性能优化: 清空相关群组的AC自动机缓存
-                with automatons_lock:
-                    for group in groups:
-                        keyword_automatons.pop(group.id, None)
+                # 性能优化: 关键词变更，重新构建全局AC自动机
+                invalidate_keyword_matcher()
                 
                 flash(f'成功添加 {added_count} 个新关键词！', 'success')
+
+                # 可选: 对新关键词回溯最近一段时间的历史消息
+                if request.form.get('backfill'):
+                    from telegram_monitor import is_running as tg_running
+                    if tg_running:
+                        task_id = start_backfill_task([keyword.id for keyword in new_keywords], BACKFILL_DAYS)
+                        flash(f'已开始回溯最近 {BACKFILL_DAYS} 天的历史消息，'
+                              f'进度可通过 /api/backfill/status/{task_id} 查看。', 'info')
+                    else:
+                        flash('监控未启动，无法回溯历史消息。', 'warning')
             
             if skipped_count > 0:
                 flash(f'跳过了 {skipped_count} 个已存在的关键词。', 'info')
 
+            if invalid_patterns:
+                kind = {KEYWORD_REGEX: '正则表达式', KEYWORD_RULE: '规则'}.get(keyword_type, '关键词')
+                flash(f"以下{kind}无效，未添加: {'; '.join(invalid_patterns)}", 'danger')
+
         return redirect(url_for('keywords'))
 
     # 处理GET请求
@@ -875,7 +1062,8 @@ def keywords():
         keywords=pagination.items,  # 当前页的关键词
         pagination=pagination,       # 分页对象
         groups=all_groups, 
-        search_query=search_query
+        search_query=search_query,
+        regex_min_literal=REGEX_MIN_LITERAL
     )
 
 @app.route('/keywords/edit/<int:keyword_id>', methods=['GET', 'POST'])
@@ -887,19 +1075,13 @@ def edit_keyword(keyword_id):
         if not group_ids:
             flash('必须至少选择一个群组。', 'danger')
         else:
-            # 性能优化: 保存旧的群组列表
-            old_groups = list(keyword_to_edit.groups)
-            
             groups = MonitoredGroup.query.filter(MonitoredGroup.id.in_(group_ids)).all()
             keyword_to_edit.groups = groups 
+            keyword_to_edit.notify_immediately = 'notify_immediately' in request.form
             db.session.commit()
             
-            # 性能优化: 清空旧的和新的群组的AC自动机缓存
-            with automatons_lock:
-                for group in old_groups:
-                    keyword_automatons.pop(group.id, None)
-                for group in groups:
-                    keyword_automatons.pop(group.id, None)
+            # 性能优化: 关键词关联变更，重新构建全局AC自动机
+            invalidate_keyword_matcher()
             
             flash('关键词关联已更新！', 'success')
         return redirect(url_for('keywords'))
@@ -914,16 +1096,11 @@ def edit_keyword(keyword_id):
 def delete_keyword(keyword_id):
     keyword_to_delete = Keyword.query.get_or_404(keyword_id)
     
-    # 性能优化: 清空相关群组的AC自动机缓存
-    affected_groups = list(keyword_to_delete.groups)
-    
     db.session.delete(keyword_to_delete)
     db.session.commit()
     
-    # 删除后清空缓存
-    with automatons_lock:
-        for group in affected_groups:
-            keyword_automatons.pop(group.id, None)
+    # 删除后重新构建全局AC自动机
+    invalidate_keyword_matcher()
     
     flash('关键词已删除。', 'info')
     return redirect(url_for('keywords'))
@@ -938,27 +1115,38 @@ def batch_delete_keywords():
         
     keywords_to_delete = Keyword.query.filter(Keyword.id.in_(keyword_ids)).all()
     
-    # 性能优化: 收集所有受影响的群组
-    affected_groups = set()
-    for keyword in keywords_to_delete:
-        for group in keyword.groups:
-            affected_groups.add(group.id)
-    
     deleted_count = len(keywords_to_delete)
     for keyword in keywords_to_delete:
         db.session.delete(keyword)
     
     db.session.commit()
     
-    # 清空所有受影响群组的AC自动机缓存
-    with automatons_lock:
-        for group_id in affected_groups:
-            keyword_automatons.pop(group_id, None)
+    # 性能优化: 重新构建全局AC自动机
+    invalidate_keyword_matcher()
     
     flash(f'成功删除 {deleted_count} 个关键词！', 'success')
     return redirect(url_for('keywords'))
 
 
+@app.template_filter('highlight_keywords')
+def highlight_keywords(message):
+    """根据保存的关键词命中区间高亮消息内容（无需重新扫描文本）"""
+    content = message.message_content or ''
+    if not message.spans:
+        return content
+
+    parts = []
+    pos = 0
+    for span in message.spans:
+        # 跳过与前一个高亮重叠或越界的区间
+        if span.start < pos or span.end > len(content):
+            continue
+        parts.append(escape(content[pos:span.start]))
+        parts.append(Markup('<mark>') + escape(content[span.start:span.end]) + Markup('</mark>'))
+        pos = span.end
+    parts.append(escape(content[pos:]))
+    return Markup('').join(parts)
+
 @app.route('/messages')
 @login_required # 添加鉴权装饰器
 def messages():
@@ -1151,6 +1339,7 @@ def delete_message(message_id):
 @login_required # 添加鉴权装饰器
 def clear_all_messages():
     try:
+        db.session.query(MatchedKeywordSpan).delete()
         num_rows_deleted = db.session.query(MatchedMessage).delete()
         db.session.commit()
         flash(f'已清空 {num_rows_deleted} 条消息。', 'success')
@@ -1220,6 +1409,12 @@ if __name__ == '__main__':
             print("   请务必妥善保管此密码")
             print("------------------------------------------------------")
 
+    # --- 启动 OCR 进程池（在启动其他后台线程之前创建工作进程） --- #
+    ocr_engine.start()
+
+    # --- 启动通知发送线程（同时补发上次运行遗留的未送达通知） --- #
+    notification_dispatcher.start()
+
     # --- 启动 Telegram 监控（如果已配置，异步启动） --- #
     with app.app_context():
         config = Config.query.first()
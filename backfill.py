@@ -0,0 +1,343 @@
+"""
+历史消息回溯
+新添加的关键词只对之后的消息生效。回溯任务用 client.iter_messages 扫描监控群组最近 N 天的历史消息，
+只用这些关键词单独构建的临时匹配器匹配（不影响正在使用的全局自动机），命中结果批量写入数据库。
+    - 并发: 同时扫描的群组数不超过 BACKFILL_CONCURRENCY
+    - 限速: iter_messages 每次请求之间等待 BACKFILL_WAIT_TIME 秒；遇到 FloodWait 时所有群组一起暂停
+    - 断点: 每写入一批就在同一事务中更新该群组的检查点，中断后用相同关键词和天数重新发起即从检查点继续
+    - 去重: 命中记录带与实时监控相同的内容指纹；实时监控已保存过的同一条消息、之前的回溯任务（包括回溯天数不同的任务）
+      已写入的记录都会跳过，不会重复保存
+只回溯文本（不下载图片做OCR），也不发送通知和实时推送。
+任务进度与批量加群任务结构相同（status / log / total / current ...），由 /api/backfill/status 查询。
+"""
+import asyncio
+import hashlib
+import os
+import time
+from datetime import datetime, timedelta, timezone
+
+from sqlalchemy import or_, select
+from telethon.errors import FloodWaitError
+
+import telegram_monitor
+from database import BackfillCheckpoint, MatchedMessage, get_session
+from keyword_engine import KeywordMatcher, load_keyword_rows
+from match_writer import match_writer
+from message_dedup import message_fingerprint
+
+BACKFILL_DAYS = int(os.environ.get('BACKFILL_DAYS', 30))
+BACKFILL_CONCURRENCY = int(os.environ.get('BACKFILL_CONCURRENCY', 3))   # 同时扫描的群组数
+BACKFILL_BATCH_SIZE = int(os.environ.get('BACKFILL_BATCH_SIZE', 200))   # 每扫描这么多条消息写入一次结果和检查点
+BACKFILL_WAIT_TIME = float(os.environ.get('BACKFILL_WAIT_TIME', 1))     # 秒，每次拉取历史消息之间的间隔
+BACKFILL_MAX_LOG = 500  # 任务日志最多保留的行数
+
+
+def backfill_task_key(keyword_ids, days):
+    """同一组关键词、同样回溯天数的任务共用检查点"""
+    ids = ','.join(str(keyword_id) for keyword_id in sorted(set(keyword_ids)))
+    return hashlib.sha1(f"{ids}|{days}".encode('utf-8')).hexdigest()
+
+
+def entity_reference(identifier):
+    """群组标识转换为 get_entity 参数: 数字ID转为整数，用户名保持原样"""
+    return int(identifier) if identifier.lstrip('-').isdigit() else identifier
+
+
+def load_matcher(keyword_ids):
+    """只用指定关键词构建临时匹配器"""
+    wanted = set(keyword_ids)
+    session = get_session()
+    try:
+        rows = [row for row in load_keyword_rows(session) if row.id in wanted]
+    finally:
+        session.close()
+    return KeywordMatcher(rows) if rows else None
+
+
+def load_checkpoints(task_key):
+    session = get_session()
+    try:
+        result = session.execute(
+            select(BackfillCheckpoint).where(BackfillCheckpoint.task_key == task_key)
+        ).scalars().all()
+        return {
+            checkpoint.group_id: (checkpoint.last_message_id, checkpoint.scanned, checkpoint.matched, checkpoint.done)
+            for checkpoint in result
+        }
+    finally:
+        session.close()
+
+
+def filter_saved(session, records, since):
+    """
+    去掉回溯范围内已经保存过的命中（同一批内的重复也只保留第一条）
+    有指纹的按指纹判断，没有指纹的（文本过短或未开启去重）按群组名称 + 消息内容判断
+    """
+    fingerprints = {record['fingerprint'] for record in records if record['fingerprint']}
+    contents = {record['message_content'] for record in records if not record['fingerprint']}
+    table = MatchedMessage.__table__
+    conditions = []
+    if fingerprints:
+        conditions.append(table.c.fingerprint.in_(fingerprints))
+    if contents:
+        conditions.append(table.c.message_content.in_(contents))
+    saved_fingerprints, saved_contents = set(), set()
+    if conditions:
+        rows = session.execute(
+            select(table.c.fingerprint, table.c.group_name, table.c.message_content)
+            .where(table.c.message_date >= since, or_(*conditions))
+        ).all()
+        for fingerprint, group_name, content in rows:
+            saved_fingerprints.add(fingerprint)
+            saved_contents.add((group_name, content))
+
+    kept = []
+    for record in records:
+        if record['fingerprint']:
+            key, seen = record['fingerprint'], saved_fingerprints
+        else:
+            key, seen = (record['group_name'], record['message_content']), saved_contents
+        if key not in seen:
+            seen.add(key)
+            kept.append(record)
+    return kept
+
+
+def save_batch(task_key, group_id, records, last_message_id, scanned, matched, done, since):
+    """
+    在一个事务中写入一批命中记录并更新检查点，返回实际写入的记录数
+    matched: 该群组之前已写入的记录数；since: 回溯范围的起点（本地时间），只在这之后保存的记录中查重
+    """
+    session = get_session()
+    try:
+        if records:
+            records = filter_saved(session, records, since)
+        if records:
+            match_writer.insert_records(session, records)
+        checkpoint = session.execute(
+            select(BackfillCheckpoint).where(
+                BackfillCheckpoint.task_key == task_key, BackfillCheckpoint.group_id == group_id
+            )
+        ).scalar_one_or_none()
+        if checkpoint is None:
+            checkpoint = BackfillCheckpoint(task_key=task_key, group_id=group_id)
+            session.add(checkpoint)
+        checkpoint.last_message_id = last_message_id
+        checkpoint.scanned = scanned
+        checkpoint.matched = matched + len(records)
+        checkpoint.done = done
+        checkpoint.updated_at = datetime.now()
+        session.commit()
+        return len(records)
+    except Exception:
+        session.rollback()
+        raise
+    finally:
+        session.close()
+
+
+class FloodPacer:
+    """FloodWait 是账号级别的限制: 任一群组遇到后，所有群组都暂停到限制解除"""
+    def __init__(self):
+        self.resume_at = 0.0
+
+    def pause(self, seconds):
+        self.resume_at = max(self.resume_at, time.monotonic() + seconds)
+
+    async def wait(self):
+        delay = self.resume_at - time.monotonic()
+        if delay > 0:
+            await asyncio.sleep(delay)
+
+
+class BackfillJob:
+    def __init__(self, task_id, keyword_ids, days, tasks_dict, lock_obj):
+        self.task_id = task_id
+        self.keyword_ids = keyword_ids
+        self.days = days
+        self.tasks_dict = tasks_dict
+        self.lock = lock_obj
+        self.task_key = backfill_task_key(keyword_ids, days)
+        self.pacer = FloodPacer()
+
+    def log(self, message):
+        with self.lock:
+            task_log = self.tasks_dict[self.task_id]['log']
+            task_log.append(message)
+            del task_log[:-BACKFILL_MAX_LOG]
+
+    def update(self, **fields):
+        with self.lock:
+            self.tasks_dict[self.task_id].update(fields)
+
+    def update_group(self, group, **fields):
+        with self.lock:
+            task = self.tasks_dict[self.task_id]
+            task['groups'].setdefault(group.name or group.identifier, {}).update(fields)
+
+    def add_progress(self, scanned=0, matched=0, finished_groups=0):
+        with self.lock:
+            task = self.tasks_dict[self.task_id]
+            task['scanned'] += scanned
+            task['matched'] += matched
+            task['current'] += finished_groups
+
+    def stop_requested(self):
+        with self.lock:
+            return self.tasks_dict[self.task_id]['stop_requested']
+
+    async def run(self):
+        client = telegram_monitor.client_instance
+        if not (client and client.is_connected()):
+            self.update(status='error')
+            self.log('[ERROR] 监控客户端未连接，任务无法执行。')
+            return
+
+        loop = asyncio.get_running_loop()
+        matcher = await loop.run_in_executor(None, load_matcher, self.keyword_ids)
+        if matcher is None:
+            self.update(status='error')
+            self.log('[ERROR] 没有找到要回溯的关键词。')
+            return
+
+        groups = [group for group in telegram_monitor.group_index.records() if matcher.has_group(group.id)]
+        checkpoints = await loop.run_in_executor(None, load_checkpoints, self.task_key)
+        self.update(status='running', total=len(groups), task_key=self.task_key)
+        self.log(f'[INFO] 任务开始: {matcher.keyword_count} 个关键词，{len(groups)} 个群组，回溯最近 {self.days} 天。')
+
+        since = datetime.now(timezone.utc) - timedelta(days=self.days)
+        semaphore = asyncio.Semaphore(max(1, BACKFILL_CONCURRENCY))
+        await asyncio.gather(*(
+            self.scan_group(client, loop, semaphore, matcher, group, since, checkpoints.get(group.id))
+            for group in groups
+        ))
+
+        with self.lock:
+            task = self.tasks_dict[self.task_id]
+            if task['stop_requested']:
+                task['status'] = 'stopped'
+                task['log'].append('[INFO] 任务已停止，再次发起相同的回溯会从检查点继续。')
+            elif task['status'] == 'running':
+                task['status'] = 'completed'
+                task['log'].append(f"[INFO] 回溯完成: 扫描 {task['scanned']} 条消息，新保存 {task['matched']} 条命中"
+                                   f"（已保存过的消息已跳过）。")
+
+    async def scan_group(self, client, loop, semaphore, matcher, group, since, checkpoint):
+        last_message_id, scanned, matched, done = checkpoint or (None, 0, 0, False)
+        label = group.name or group.identifier
+        if done:
+            self.update_group(group, status='done', scanned=scanned, matched=matched)
+            self.add_progress(finished_groups=1)
+            self.log(f'[SKIP] 群组 "{label}" 已在之前的任务中回溯完成。')
+            return
+
+        async with semaphore:
+            if self.stop_requested():
+                return
+            if last_message_id:
+                self.log(f'[RESUME] 群组 "{label}" 从检查点继续（已扫描 {scanned} 条）。')
+            self.update_group(group, status='running', scanned=scanned, matched=matched)
+
+            try:
+                entity = await client.get_entity(entity_reference(group.identifier))
+            except Exception as e:
+                self.update_group(group, status='error')
+                self.add_progress(finished_groups=1)
+                self.log(f'[ERROR] 无法获取群组 "{label}": {e}')
+                return
+            group_name = group.name or getattr(entity, 'title', None) or label
+
+            pending = []
+            batch_scanned = 0
+            saved_since = since.astimezone().replace(tzinfo=None)
+            finished = stopped = failed = False
+            while not (finished or stopped or failed):
+                try:
+                    async for message in client.iter_messages(
+                            entity, offset_id=last_message_id or 0, wait_time=BACKFILL_WAIT_TIME):
+                        if message.date < since:
+                            break
+                        await self.pacer.wait()
+                        last_message_id = message.id
+                        batch_scanned += 1
+
+                        text = message.message
+                        if text:
+                            matched_keyword_text, hits = telegram_monitor.match_keywords(matcher, text, group.id)
+                            if matched_keyword_text:
+                                sender_name = telegram_monitor.get_sender_display_name(message.sender) or group_name
+                                # 指纹与实时监控的计算方式相同，已保存过的同一条消息在写入前跳过
+                                record = telegram_monitor.build_matched_message(
+                                    group_name, text, sender_name, matched_keyword_text, hits,
+                                    message_fingerprint(text, message.photo.id if message.photo else None,
+                                                        keyword_ids=[hit.keyword_id for hit in hits])
+                                )
+                                record['message_date'] = message.date.astimezone().replace(tzinfo=None)
+                                pending.append(record)
+
+                        if batch_scanned >= BACKFILL_BATCH_SIZE:
+                            scanned += batch_scanned
+                            saved = await loop.run_in_executor(
+                                None, save_batch, self.task_key, group.id, pending,
+                                last_message_id, scanned, matched, False, saved_since
+                            )
+                            matched += saved
+                            self.add_progress(batch_scanned, saved)
+                            self.update_group(group, scanned=scanned, matched=matched)
+                            pending, batch_scanned = [], 0
+                            if self.stop_requested():
+                                stopped = True
+                                break
+                    finished = not stopped
+                except FloodWaitError as e:
+                    # 从最后处理的消息继续（last_message_id 之后更旧的消息尚未处理）
+                    self.pacer.pause(e.seconds)
+                    self.log(f'[WAIT] 触发 Telegram 限流，全部群组暂停 {e.seconds} 秒...')
+                    await self.pacer.wait()
+                except Exception as e:
+                    failed = True
+                    self.update_group(group, status='error')
+                    self.log(f'[ERROR] 扫描群组 "{label}" 失败: {e}')
+
+            scanned += batch_scanned
+            saved = 0
+            try:
+                saved = await loop.run_in_executor(
+                    None, save_batch, self.task_key, group.id, pending,
+                    last_message_id, scanned, matched, finished, saved_since
+                )
+            except Exception as e:
+                self.log(f'[ERROR] 保存群组 "{label}" 的回溯结果失败: {e}')
+                self.update_group(group, status='error')
+                finished = False
+                failed = True
+            matched += saved
+            # 失败的群组与无法获取的群组一样计为已结束（状态为 error），任务进度才能到达 100%；
+            # 检查点未标记完成，再次发起相同的回溯时会重试
+            self.add_progress(batch_scanned, saved, finished_groups=1 if finished or failed else 0)
+            if finished:
+                self.update_group(group, status='done', scanned=scanned, matched=matched)
+                self.log(f'[SUCCESS] 群组 "{label}" 回溯完成: 扫描 {scanned} 条，新保存 {matched} 条命中。')
+            else:
+                self.update_group(group, scanned=scanned, matched=matched)
+
+
+def run_backfill(task_id, keyword_ids, days, tasks_dict, lock_obj):
+    """在后台线程中调用: 把回溯任务投递到监控客户端的事件循环并等待完成"""
+    loop = telegram_monitor.main_loop
+    if not loop:
+        with lock_obj:
+            task = tasks_dict[task_id]
+            task['status'] = 'error'
+            task['log'].append('[ERROR] 监控未启动，无法回溯历史消息。')
+        return
+
+    job = BackfillJob(task_id, keyword_ids, days, tasks_dict, lock_obj)
+    future = asyncio.run_coroutine_threadsafe(job.run(), loop)
+    try:
+        future.result()
+    except Exception as e:
+        with lock_obj:
+            task = tasks_dict[task_id]
+            task['status'] = 'error'
+            task['log'].append(f'[FATAL] 执行时发生致命错误: {e}')
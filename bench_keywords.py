@@ -0,0 +1,268 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+关键词引擎性能与扩展性测试
+对不同规模的关键词集合（默认 1千 / 1万 / 10万 / 100万，中英文混合）分别测量:
+    - 构建耗时: build_keyword_automaton（含规整）以及整个 KeywordMatcher
+    - 内存占用: 构建前后的进程常驻内存差值，以及自动机自身的节点内存
+    - 磁盘缓存: 序列化后的大小和加载耗时（启动时命中缓存走这条路径）
+    - 匹配吞吐量（MB/秒、条/秒）: 短聊天消息和长 OCR 文本两类语料，与线上一样调用 find_all（含规整和区间换算）
+
+每个规模在单独的子进程中测量，互不影响内存统计。结果写入 JSON 文件（含版本和环境信息），
+可以用 --compare 与之前版本的结果对比。
+
+用法:
+    python bench_keywords.py
+    python bench_keywords.py --sizes 1000 10000 --output before.json
+    python bench_keywords.py --output after.json --compare before.json
+"""
+import argparse
+import json
+import multiprocessing
+import os
+import pickle
+import platform
+import random
+import subprocess
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime
+
+import keyword_engine
+from keyword_engine import KeywordMatcher, KeywordRow, build_keyword_automaton
+from text_normalize import TABLE_SIGNATURE
+
+DEFAULT_SIZES = [1000, 10000, 100000, 1000000]
+
+# 常用汉字范围内的字（关键词和语料使用同一个字池，大词表下会有真实的“意外命中”）
+CJK_POOL = [chr(codepoint) for codepoint in range(0x4E00, 0x4E00 + 3500)]
+LETTERS = 'abcdefghijklmnopqrstuvwxyz'
+
+CORPORA = {
+    # 名称: (条数, 最短长度, 最长长度)
+    'chat': (20000, 10, 120),
+    'ocr': (200, 2000, 4000),
+}
+
+
+def random_keywords(rng, count):
+    """生成不重复的中英文混合关键词（约 60% 中文 2~6 字，其余为英文单词或词组）"""
+    keywords = set()
+    while len(keywords) < count:
+        if rng.random() < 0.6:
+            text = ''.join(rng.choice(CJK_POOL) for _ in range(rng.randint(2, 6)))
+        else:
+            words = [''.join(rng.choice(LETTERS) for _ in range(rng.randint(4, 10)))
+                     for _ in range(rng.choice((1, 1, 1, 2)))]
+            text = ' '.join(words)
+        keywords.add(text)
+    return sorted(keywords)
+
+
+def random_text(rng, length):
+    parts = []
+    size = 0
+    while size < length:
+        if rng.random() < 0.15:
+            part = ''.join(rng.choice(LETTERS) for _ in range(rng.randint(2, 8))) + ' '
+        else:
+            part = ''.join(rng.choice(CJK_POOL) for _ in range(rng.randint(1, 6)))
+        if rng.random() < 0.1:
+            part += rng.choice('，。！？、 ')
+        parts.append(part)
+        size += len(part)
+    return ''.join(parts)[:length]
+
+
+def generate_corpus(rng, keywords, count, min_length, max_length, hit_rate):
+    """生成语料；hit_rate 比例的文本中插入一个关键词"""
+    texts = []
+    for _ in range(count):
+        text = random_text(rng, rng.randint(min_length, max_length))
+        if rng.random() < hit_rate:
+            position = rng.randrange(len(text) + 1)
+            text = f"{text[:position]}{rng.choice(keywords)}{text[position:]}"
+        texts.append(text)
+    return texts
+
+
+def rss_bytes():
+    """当前进程常驻内存（Linux 读取 /proc，其他平台返回 None）"""
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError, AttributeError):
+        return None
+
+
+def scan(matcher, texts, repeat):
+    """返回 (最快一轮的耗时, 命中数)"""
+    best = None
+    hits = 0
+    for _ in range(repeat):
+        hits = 0
+        started = time.perf_counter()
+        for text in texts:
+            hits += len(matcher.find_all(text, 0))
+        elapsed = time.perf_counter() - started
+        best = elapsed if best is None else min(best, elapsed)
+    return best, hits
+
+
+def bench_size(size, seed, hit_rate, repeat):
+    """在子进程中运行: 测量一种关键词规模"""
+    rng = random.Random(seed)
+    texts = random_keywords(rng, size)
+    rows = [KeywordRow(index + 1, text, 1) for index, text in enumerate(texts)]
+    corpora = {
+        name: generate_corpus(random.Random(f"{seed}:{name}"), texts, count, min_length, max_length, hit_rate)
+        for name, (count, min_length, max_length) in CORPORA.items()
+    }
+
+    rss_before = rss_bytes()
+    started = time.perf_counter()
+    automaton = build_keyword_automaton(rows)
+    automaton_seconds = time.perf_counter() - started
+    matcher = KeywordMatcher(rows, automaton=automaton)
+    matcher.prewarm()
+    build_seconds = time.perf_counter() - started
+    rss_after = rss_bytes()
+
+    started = time.perf_counter()
+    data = pickle.dumps(automaton, protocol=pickle.HIGHEST_PROTOCOL)
+    dump_seconds = time.perf_counter() - started
+    started = time.perf_counter()
+    pickle.loads(data)
+    load_seconds = time.perf_counter() - started
+
+    stats = automaton.get_stats()
+    result = {
+        'keywords': size,
+        'build_seconds': round(build_seconds, 4),
+        'automaton_build_seconds': round(automaton_seconds, 4),
+        'rss_delta_bytes': rss_after - rss_before if rss_before is not None else None,
+        'automaton_node_bytes': stats['total_size'],
+        'automaton_nodes': stats['nodes_count'],
+        'cache_bytes': len(data),
+        'cache_dump_seconds': round(dump_seconds, 4),
+        'cache_load_seconds': round(load_seconds, 4),
+        'scan': {},
+    }
+    del data
+
+    for name, corpus in corpora.items():
+        size_bytes = sum(len(text.encode('utf-8')) for text in corpus)
+        elapsed, hits = scan(matcher, corpus, repeat)
+        result['scan'][name] = {
+            'texts': len(corpus),
+            'bytes': size_bytes,
+            'seconds': round(elapsed, 4),
+            'mb_per_second': round(size_bytes / elapsed / 1e6, 2),
+            'texts_per_second': round(len(corpus) / elapsed),
+            'hits': hits,
+        }
+    return result
+
+
+def environment():
+    try:
+        commit = subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True,
+                                cwd=os.path.dirname(os.path.abspath(__file__)), timeout=5).stdout.strip() or None
+    except (OSError, subprocess.SubprocessError):
+        commit = None
+    try:
+        from importlib.metadata import version
+        ahocorasick_version = version('pyahocorasick')
+    except Exception:
+        ahocorasick_version = None
+    return {
+        'timestamp': datetime.now().isoformat(timespec='seconds'),
+        'commit': commit,
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'cpu_count': os.cpu_count(),
+        'pyahocorasick': ahocorasick_version,
+        'automaton_format': keyword_engine.AUTOMATON_FORMAT,
+        'normalize_signature': TABLE_SIGNATURE,
+    }
+
+
+def format_bytes(value):
+    if value is None:
+        return '-'
+    for unit in ('B', 'KB', 'MB', 'GB'):
+        if abs(value) < 1024 or unit == 'GB':
+            return f"{value:.0f}{unit}" if unit == 'B' else f"{value:.1f}{unit}"
+        value /= 1024
+
+
+def print_result(result):
+    scan_text = ', '.join(
+        f"{name} {stats['mb_per_second']:.2f}MB/s ({stats['texts_per_second']} 条/秒, 命中 {stats['hits']})"
+        for name, stats in result['scan'].items()
+    )
+    print(f"{result['keywords']:>9} 个关键词: 构建 {result['build_seconds']:.2f}s, "
+          f"内存 +{format_bytes(result['rss_delta_bytes'])}（自动机节点 {format_bytes(result['automaton_node_bytes'])}）, "
+          f"缓存 {format_bytes(result['cache_bytes'])} 加载 {result['cache_load_seconds']:.2f}s")
+    print(f"{'':>11}匹配: {scan_text}")
+
+
+def print_comparison(results, baseline_path):
+    with open(baseline_path, encoding='utf-8') as f:
+        baseline = json.load(f)
+    old_results = {item['keywords']: item for item in baseline['results']}
+    print(f"\n与 {baseline_path}（{baseline['environment'].get('commit') or '未知版本'}）对比，>1 表示变快/变小:")
+    for result in results:
+        old = old_results.get(result['keywords'])
+        if old is None:
+            continue
+        parts = [f"构建 x{old['build_seconds'] / result['build_seconds']:.2f}"]
+        if old.get('rss_delta_bytes') and result.get('rss_delta_bytes'):
+            parts.append(f"内存 x{old['rss_delta_bytes'] / result['rss_delta_bytes']:.2f}")
+        for name, stats in result['scan'].items():
+            if name in old['scan']:
+                parts.append(f"{name} x{stats['mb_per_second'] / old['scan'][name]['mb_per_second']:.2f}")
+        print(f"{result['keywords']:>9} 个关键词: {', '.join(parts)}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description='关键词引擎性能与扩展性测试')
+    parser.add_argument('--sizes', type=int, nargs='+', default=DEFAULT_SIZES, help='关键词数量')
+    parser.add_argument('--hit-rate', type=float, default=0.05, help='插入关键词的文本比例')
+    parser.add_argument('--repeat', type=int, default=3, help='每种语料扫描的轮数（取最快一轮）')
+    parser.add_argument('--seed', type=int, default=42)
+    parser.add_argument('--output', default='bench_keywords.json', help='结果文件（JSON）')
+    parser.add_argument('--compare', help='之前版本的结果文件，对比构建耗时、内存和吞吐量')
+    args = parser.parse_args()
+
+    info = environment()
+    print(f"版本: {info['commit'] or '-'}, Python {info['python']}, pyahocorasick {info['pyahocorasick'] or '-'}")
+    print(f"语料: " + ', '.join(f"{name} {count} 条 {low}~{high} 字" for name, (count, low, high) in CORPORA.items())
+          + f", 命中率 {args.hit_rate:.0%}")
+
+    results = []
+    context = multiprocessing.get_context('spawn')
+    for size in args.sizes:
+        with ProcessPoolExecutor(max_workers=1, mp_context=context) as executor:
+            result = executor.submit(bench_size, size, args.seed, args.hit_rate, args.repeat).result()
+        print_result(result)
+        results.append(result)
+
+    report = {
+        'environment': info,
+        'parameters': {'hit_rate': args.hit_rate, 'repeat': args.repeat, 'seed': args.seed,
+                       'corpora': {name: dict(zip(('texts', 'min_length', 'max_length'), spec))
+                                   for name, spec in CORPORA.items()}},
+        'results': results,
+    }
+    with open(args.output, 'w', encoding='utf-8') as f:
+        json.dump(report, f, ensure_ascii=False, indent=2)
+    print(f"结果已写入 {args.output}")
+
+    if args.compare:
+        print_comparison(results, args.compare)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,118 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+通知发送管道吞吐量测试
+在本地启动一个模拟钉钉/企业微信机器人的 webhook 服务，对比:
+    - 旧方式: 逐条 requests.post（每次新建连接）
+    - 新方式: NotificationDispatcher（长连接 + 并发发送 + 令牌桶限速）
+
+模拟服务也用于 test_notifier.py（可以按顺序返回失败状态码，测试重试和保存未送达通知）。
+
+用法:
+    python bench_notifier.py --messages 500 --workers 4 --delay-ms 50
+    python bench_notifier.py --messages 60 --rate 20     # 验证每分钟20条的限速
+"""
+import argparse
+import json
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import requests
+
+from notifier import NotificationDispatcher, post_webhook
+
+
+class StubWebhookHandler(BaseHTTPRequestHandler):
+    """
+    模拟机器人 webhook: 固定延迟后返回 errcode=0
+    responses 中有状态码时按顺序先返回这些状态码（用完后恢复正常），request_times 记录每次请求的时间
+    """
+    delay = 0.0
+    received = 0
+    responses = []
+    request_times = []
+    lock = threading.Lock()
+
+    def do_POST(self):
+        length = int(self.headers.get('Content-Length', 0))
+        self.rfile.read(length)
+        if self.delay:
+            time.sleep(self.delay)
+        stub = type(self)
+        with stub.lock:
+            stub.received += 1
+            stub.request_times.append(time.monotonic())
+            status = stub.responses.pop(0) if stub.responses else 200
+        if status == 200:
+            body = json.dumps({'errcode': 0, 'errmsg': 'ok'}).encode('utf-8')
+        else:
+            body = json.dumps({'errcode': -1, 'errmsg': f'HTTP {status}'}).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def start_stub_server(delay=0.0, responses=()):
+    """启动模拟服务，返回 (server, webhook地址)；每个服务有独立的计数（server.RequestHandlerClass）"""
+    handler = type('StubWebhook', (StubWebhookHandler,), {
+        'delay': delay, 'received': 0, 'responses': list(responses), 'request_times': [],
+        'lock': threading.Lock(),
+    })
+    server = ThreadingHTTPServer(('127.0.0.1', 0), handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, f"http://127.0.0.1:{server.server_address[1]}/robot/send"
+
+
+def payload(i):
+    return {"msgtype": "markdown", "markdown": {"title": f"测试 {i}", "text": f"#### 压测消息 {i}"}}
+
+
+def bench_sequential(url, messages):
+    started = time.perf_counter()
+    for i in range(messages):
+        requests.post(url, json=payload(i), timeout=5)
+    return time.perf_counter() - started
+
+
+def bench_dispatcher(url, messages, workers, rate):
+    dispatcher = NotificationDispatcher(workers=workers, max_queue=messages + 1, rate_per_minute=rate,
+                                        replay_interval=0)
+    dispatcher.register_sender('stub', lambda job: post_webhook(job.webhook_url, payload(job.title)))
+    started = time.perf_counter()
+    for i in range(messages):
+        dispatcher.submit('stub', url, None, str(i), '')
+    while dispatcher.sent + dispatcher.persisted < messages:
+        time.sleep(0.01)
+    return time.perf_counter() - started, dispatcher.get_stats()
+
+
+def main():
+    parser = argparse.ArgumentParser(description='通知发送管道吞吐量测试')
+    parser.add_argument('--messages', type=int, default=500)
+    parser.add_argument('--workers', type=int, default=4)
+    parser.add_argument('--delay-ms', type=float, default=50, help='模拟 webhook 的响应延迟（毫秒）')
+    parser.add_argument('--rate', type=int, default=1000000, help='每分钟限速条数（默认不限速）')
+    args = parser.parse_args()
+
+    server, url = start_stub_server(args.delay_ms / 1000.0)
+    try:
+        if args.rate >= 1000000:
+            elapsed = bench_sequential(url, args.messages)
+            print(f"逐条 requests.post : {args.messages} 条, {elapsed:.2f}s, {args.messages / elapsed:.1f} 条/秒")
+
+        elapsed, stats = bench_dispatcher(url, args.messages, args.workers, args.rate)
+        print(f"NotificationDispatcher: {args.messages} 条, {elapsed:.2f}s, {args.messages / elapsed:.1f} 条/秒")
+        print(f"统计: {stats}")
+        print(f"模拟服务器共收到 {server.RequestHandlerClass.received} 次请求")
+    finally:
+        server.shutdown()
+
+
+if __name__ == '__main__':
+    main()
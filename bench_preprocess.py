@@ -0,0 +1,192 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+OCR 预处理效果测试
+在同一组图片上对比不同的 OCR_PREPROCESS 配置:
+    - 每张图片的平均/P95 耗时（另列出其中预处理本身的耗时）
+    - 关键词召回率: 图片中实际包含的关键词有多少被识别出来
+    - 被判定为没有文字而跳过的图片数（以及其中误跳过、实际包含关键词的图片数）
+
+未指定 --corpus 时按固定随机种子生成测试图片，模拟群里常见的三类图片:
+    大尺寸照片 + 少量文字、聊天截图（整屏文字）、没有文字的照片。
+指定 --corpus 时，图片同目录下的同名 .txt 文件为该图片中应识别出的关键词（每行一个）。
+
+用法:
+    python bench_preprocess.py --images 30
+    python bench_preprocess.py --corpus ./samples --configs none "grayscale,downscale"
+"""
+import argparse
+import os
+import random
+import shutil
+import tempfile
+import time
+
+import ocr_engine
+from bench_ocr import SAMPLE_LINES, list_corpus, load_font
+from ocr_engine import OCR_LANG, ocr_image
+from ocr_preprocess import OCR_PREPROCESS, draft_for_ocr, parse_steps, preprocess_image
+
+BENCH_KEYWORDS = ['USDT', '担保', '泄露', '出售', 'airdrop', '客服', 'VPN', '节点', 'database', 'leaked']
+
+DEFAULT_CONFIGS = [
+    'none',
+    'grayscale',
+    'grayscale,downscale',
+    OCR_PREPROCESS,
+    OCR_PREPROCESS + ',crop',
+]
+
+
+def photo_background(rng, size):
+    """类似照片的背景: 平滑渐变 + 色块 + 噪点（没有清晰的边缘）"""
+    from PIL import Image, ImageDraw, ImageFilter
+    width, height = size
+    base = Image.linear_gradient('L').resize(size)
+    image = Image.merge('RGB', (
+        base.point(lambda v: 60 + v // 3),
+        base.point(lambda v: 90 + v // 4),
+        base.point(lambda v: 140 - v // 5),
+    ))
+    draw = ImageDraw.Draw(image)
+    for _ in range(12):
+        x, y = rng.randrange(width), rng.randrange(height)
+        radius = rng.randrange(width // 12, width // 4)
+        color = tuple(rng.randrange(40, 220) for _ in range(3))
+        draw.ellipse((x - radius, y - radius, x + radius, y + radius), fill=color)
+    image = image.filter(ImageFilter.GaussianBlur(radius=width // 60))
+    noise = Image.effect_noise(size, 12).convert('RGB')
+    return Image.blend(image, noise, 0.08)
+
+
+def generate_corpus(directory, count, font_path):
+    """生成测试图片及对应的关键词标注"""
+    from PIL import Image, ImageDraw
+    rng = random.Random(42)
+    caption_font = load_font(font_path, 64)
+    screen_font = load_font(font_path, 34)
+    samples = []
+    for i in range(count):
+        kind = ('photo_text', 'screenshot', 'photo')[i % 3]
+        lines = []
+        if kind == 'screenshot':
+            lines = rng.sample(SAMPLE_LINES, 5)
+            image = Image.new('RGB', (1080, 120 + 90 * len(lines)), 'white')
+            draw = ImageDraw.Draw(image)
+            for row, line in enumerate(lines):
+                draw.text((50, 60 + row * 90), line, fill=(30, 30, 30), font=screen_font)
+        else:
+            image = photo_background(rng, (3000, 2250))
+            if kind == 'photo_text':
+                lines = [rng.choice(SAMPLE_LINES)]
+                x, y = rng.randrange(100, 1200), rng.randrange(100, 1900)
+                draw = ImageDraw.Draw(image)
+                box = draw.textbbox((x, y), lines[0], font=caption_font)
+                draw.rectangle((box[0] - 30, box[1] - 20, box[2] + 30, box[3] + 20), fill='white')
+                draw.text((x, y), lines[0], fill='black', font=caption_font)
+
+        path = os.path.join(directory, f"sample_{i:04d}.jpg")
+        image.save(path, quality=90)
+        expected = sorted(set(k for k in BENCH_KEYWORDS for line in lines if k.lower() in line.lower()))
+        samples.append((path, expected))
+    return samples
+
+
+def load_labelled_corpus(directory):
+    samples = []
+    for path in list_corpus(directory):
+        label_path = os.path.splitext(path)[0] + '.txt'
+        expected = []
+        if os.path.exists(label_path):
+            with open(label_path, encoding='utf-8') as f:
+                expected = [line.strip() for line in f if line.strip()]
+        samples.append((path, expected))
+    return samples
+
+
+def time_preprocess(path, steps):
+    """只测预处理（解码 + 预处理）耗时"""
+    from PIL import Image
+    started = time.perf_counter()
+    with Image.open(path) as image:
+        draft_for_ocr(image, steps)
+        image.load()
+        preprocess_image(image, steps)
+    return time.perf_counter() - started
+
+
+def run_config(samples, config, lang, backend):
+    steps = parse_steps(config)
+    ocr_engine._init_worker(lang, backend, steps)
+
+    latencies, preprocess_times = [], []
+    expected_total = found_total = skipped = wrong_skips = errors = 0
+    for path, expected in samples:
+        preprocess_times.append(time_preprocess(path, steps))
+        started = time.perf_counter()
+        text, error = ocr_image(path)
+        latencies.append(time.perf_counter() - started)
+        if error:
+            errors += 1
+            last_error = error
+            continue
+        if text == '' and 'skip_blank' in steps:
+            skipped += 1
+            wrong_skips += 1 if expected else 0
+        normalized = ''.join((text or '').split()).lower()
+        expected_total += len(expected)
+        found_total += sum(1 for keyword in expected if keyword.lower() in normalized)
+
+    latencies.sort()
+    result = {
+        'config': ','.join(steps) or 'none',
+        'avg': sum(latencies) / len(latencies),
+        'p95': latencies[min(len(latencies) - 1, int(len(latencies) * 0.95))],
+        'preprocess': sum(preprocess_times) / len(preprocess_times),
+        'recall': found_total / expected_total if expected_total else None,
+        'skipped': skipped,
+        'wrong_skips': wrong_skips,
+        'errors': errors,
+    }
+    if errors:
+        result['last_error'] = last_error
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser(description='OCR 预处理效果测试')
+    parser.add_argument('--corpus', help='图片目录（默认生成测试图片）')
+    parser.add_argument('--images', type=int, default=30, help='生成的测试图片数量')
+    parser.add_argument('--font', help='生成测试图片使用的字体文件')
+    parser.add_argument('--lang', default=OCR_LANG)
+    parser.add_argument('--backend', default='auto', choices=['auto', 'tesserocr', 'pytesseract'])
+    parser.add_argument('--configs', nargs='+', default=DEFAULT_CONFIGS, help='要对比的预处理配置')
+    args = parser.parse_args()
+
+    temp_dir = None
+    if args.corpus:
+        samples = load_labelled_corpus(args.corpus)
+    else:
+        temp_dir = tempfile.mkdtemp(prefix='bench_preprocess_')
+        samples = generate_corpus(temp_dir, args.images, args.font)
+    if not samples:
+        print("图片集为空")
+        return
+
+    try:
+        print(f"图片数: {len(samples)}, 语言: {args.lang}")
+        print(f"{'预处理配置':<44} {'平均耗时':>8} {'P95':>8} {'其中预处理':>10} {'召回率':>7} {'跳过':>5} {'误跳过':>6}")
+        for config in dict.fromkeys(args.configs):
+            r = run_config(samples, config, args.lang, args.backend)
+            recall = f"{r['recall']:.1%}" if r['recall'] is not None else '-'
+            print(f"{r['config']:<44} {r['avg'] * 1000:>7.0f}ms {r['p95'] * 1000:>6.0f}ms "
+                  f"{r['preprocess'] * 1000:>9.0f}ms {recall:>7} {r['skipped']:>5} {r['wrong_skips']:>6}")
+            if r['errors']:
+                print(f"    {r['errors']} 张识别失败: {r['last_error']}")
+    finally:
+        if temp_dir:
+            shutil.rmtree(temp_dir, ignore_errors=True)
+
+
+if __name__ == '__main__':
+    main()
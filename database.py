@@ -1,42 +1,93 @@
 import os
 import json
 import uuid
+import threading
+import time
+from collections import namedtuple
 from datetime import datetime, timedelta
 from flask_sqlalchemy import SQLAlchemy
 from sqlalchemy import create_engine
 from sqlalchemy.orm import sessionmaker
 
-db_config = None
+db_config = {}
 config_path = os.path.join(os.path.dirname(__file__), 'mysql.json')
 
-try:
-    with open(config_path, 'r') as f:
-        db_config = json.load(f)
-except FileNotFoundError:
-    print(f"错误: 数据库配置文件 'mysql.json' 未找到。")
-    print("请根据模板创建一个，并填入您的MySQL服务器信息。")
-    exit()
-except json.JSONDecodeError:
-    print(f"错误: 'mysql.json' 文件格式不正确，请检查是否为有效的JSON。")
-    exit()
-
-DB_URI = (
-    f"mysql+pymysql://{db_config['user']}:{db_config['password']}"
-    f"@{db_config['host']}:{db_config['port']}/{db_config['database']}"
-    "?charset=utf8mb4"
-)
+# 环境变量 DB_URI 可直接指定数据库连接（如基准测试使用本地 SQLite 文件: sqlite:////tmp/bench.sqlite），
+# 此时不读取 mysql.json
+DB_URI = os.environ.get('DB_URI')
+
+if not DB_URI:
+    try:
+        with open(config_path, 'r') as f:
+            db_config = json.load(f)
+    except FileNotFoundError:
+        print(f"错误: 数据库配置文件 'mysql.json' 未找到。")
+        print("请根据模板创建一个，并填入您的MySQL服务器信息。")
+        exit()
+    except json.JSONDecodeError:
+        print(f"错误: 'mysql.json' 文件格式不正确，请检查是否为有效的JSON。")
+        exit()
+
+    DB_URI = (
+        f"mysql+pymysql://{db_config['user']}:{db_config['password']}"
+        f"@{db_config['host']}:{db_config['port']}/{db_config['database']}"
+        "?charset=utf8mb4"
+    )
 
 basedir = os.path.abspath(os.path.dirname(__file__))
 instance_path = os.path.join(basedir, 'instance')
 os.makedirs(instance_path, exist_ok=True)
 db_path = os.path.join(instance_path, 'monitoring.sqlite')
 
+# 性能优化: 数据库连接池配置（可在 mysql.json 中覆盖）
+DB_POOL_OPTIONS = {
+    'pool_size': int(db_config.get('pool_size', 10)),
+    'max_overflow': int(db_config.get('max_overflow', 20)),
+    'pool_recycle': int(db_config.get('pool_recycle', 3600)),
+    'pool_pre_ping': bool(db_config.get('pool_pre_ping', True)),
+    'pool_timeout': int(db_config.get('pool_timeout', 30)),
+}
+
 db = SQLAlchemy()
 
+# 全进程共享的数据库引擎（监控线程、OCR线程、Web 共用同一个连接池）
+_shared_engine = None
+_session_factory = None
+_engine_lock = threading.Lock()
+
+def bind_engine(engine):
+    """
+    注册共享引擎（app.py 启动时传入 Flask-SQLAlchemy 的引擎，使所有模块共用一个连接池）
+    """
+    global _shared_engine, _session_factory
+    with _engine_lock:
+        _shared_engine = engine
+        _session_factory = sessionmaker(bind=engine)
+
+def get_engine():
+    """获取共享引擎；未注册时按连接池配置懒加载创建一个（独立脚本使用）"""
+    global _shared_engine, _session_factory
+    if _shared_engine is None:
+        with _engine_lock:
+            if _shared_engine is None:
+                _shared_engine = create_engine(DB_URI, **DB_POOL_OPTIONS)
+                _session_factory = sessionmaker(bind=_shared_engine)
+    return _shared_engine
+
 def get_session():
-    engine = create_engine(DB_URI)
-    Session = sessionmaker(bind=engine)
-    return Session()
+    get_engine()
+    return _session_factory()
+
+def get_pool_status():
+    """返回连接池统计信息，用于监控连接使用情况"""
+    pool = get_engine().pool
+    status = {'pool_class': type(pool).__name__}
+    for name in ('size', 'checkedin', 'checkedout', 'overflow'):
+        method = getattr(pool, name, None)
+        if callable(method):
+            status[name] = method()
+    status['options'] = DB_POOL_OPTIONS
+    return status
 
 class Config(db.Model):
     __tablename__ = 'config'
@@ -51,6 +102,68 @@ class Config(db.Model):
 
     __table_args__ = {'mysql_charset': 'utf8mb4', 'mysql_collate': 'utf8mb4_unicode_ci'}
 
+# 配置的只读快照（不可变，可在任意线程中共享）
+CONFIG_FIELDS = ('id', 'api_id', 'api_hash', 'phone_number', 'dingtalk_webhook',
+                 'dingtalk_secret', 'notification_type', 'wecom_webhook')
+ConfigSnapshot = namedtuple('ConfigSnapshot', CONFIG_FIELDS)
+
+CONFIG_CACHE_TTL = float(os.environ.get('CONFIG_CACHE_TTL', 0))  # 秒，兜底过期时间（0表示只在显式失效时重新加载）
+
+_CONFIG_MISSING = object()
+
+
+class ConfigCache:
+    """
+    进程内配置缓存
+    读取路径只读一次引用，不加锁；配置修改后由保存配置的接口调用 invalidate()，
+    下次读取时重新查询并整体替换快照。
+    """
+    def __init__(self, ttl=CONFIG_CACHE_TTL):
+        self.ttl = ttl
+        self._entry = (_CONFIG_MISSING, 0.0)  # (快照或None, 过期时间)
+        self._load_lock = threading.Lock()
+        self._generation = 0
+        self.hits = 0
+        self.loads = 0
+
+    def get(self):
+        """返回 ConfigSnapshot，未配置时返回 None"""
+        snapshot, expires_at = self._entry
+        if snapshot is not _CONFIG_MISSING and (not self.ttl or time.monotonic() < expires_at):
+            self.hits += 1
+            return snapshot
+        return self._load()
+
+    def _load(self):
+        with self._load_lock:
+            # 等锁期间可能已被其他线程加载
+            snapshot, expires_at = self._entry
+            if snapshot is not _CONFIG_MISSING and (not self.ttl or time.monotonic() < expires_at):
+                return snapshot
+            generation = self._generation
+            session = get_session()
+            try:
+                row = session.query(Config).first()
+                snapshot = ConfigSnapshot(*(getattr(row, name) for name in CONFIG_FIELDS)) if row else None
+            finally:
+                session.close()
+            self.loads += 1
+            # 查询期间配置被修改过，则不缓存这次可能过时的结果
+            if generation == self._generation:
+                self._entry = (snapshot, time.monotonic() + self.ttl)
+            return snapshot
+
+    def invalidate(self):
+        """配置已修改，丢弃当前快照"""
+        self._generation += 1
+        self._entry = (_CONFIG_MISSING, 0.0)
+
+    def get_stats(self):
+        return {'hits': self.hits, 'loads': self.loads, 'ttl': self.ttl}
+
+
+config_cache = ConfigCache()
+
 group_keyword_association = db.Table('group_keyword_association',
     db.Column('group_id', db.Integer, db.ForeignKey('monitored_group.id'), primary_key=True),
     db.Column('keyword_id', db.Integer, db.ForeignKey('keyword.id'), primary_key=True)
@@ -62,6 +175,7 @@ class MonitoredGroup(db.Model):
     group_identifier = db.Column(db.String(191), unique=True, nullable=False)
     group_name = db.Column(db.String(255), nullable=True)
     logo_path = db.Column(db.String(255), nullable=True)
+    priority = db.Column(db.Integer, nullable=False, default=0, server_default='0')  # OCR队列优先级（重要群组优先识别）
     keywords = db.relationship('Keyword', secondary=group_keyword_association, back_populates='groups')
 
     __table_args__ = {'mysql_charset': 'utf8mb4', 'mysql_collate': 'utf8mb4_unicode_ci'}
@@ -70,6 +184,8 @@ class Keyword(db.Model):
     __tablename__ = 'keyword'
     id = db.Column(db.Integer, primary_key=True)
     text = db.Column(db.String(191), unique=True, nullable=False)
+    notify_immediately = db.Column(db.Boolean, nullable=False, default=False)  # 命中后立即通知，不合并到摘要
+    keyword_type = db.Column(db.String(10), nullable=False, default='literal', server_default='literal')  # literal / regex / rule
     groups = db.relationship('MonitoredGroup', secondary=group_keyword_association, back_populates='keywords')
 
     __table_args__ = {'mysql_charset': 'utf8mb4', 'mysql_collate': 'utf8mb4_unicode_ci'}
@@ -82,10 +198,66 @@ class MatchedMessage(db.Model):
     sender = db.Column(db.String(255), nullable=True)
     message_date = db.Column(db.DateTime, nullable=False)
     matched_keyword = db.Column(db.String(100), nullable=False)
+    # 跨群组重复消息合并: 内容指纹、出现次数、重复出现的其他群组（JSON 列表）
+    fingerprint = db.Column(db.String(16), nullable=True, index=True)
+    occurrence_count = db.Column(db.Integer, nullable=False, default=1, server_default='1')
+    duplicate_groups = db.Column(db.Text, nullable=True)
+    spans = db.relationship('MatchedKeywordSpan', backref='message', lazy='selectin',
+                            cascade='all, delete-orphan', passive_deletes=True,
+                            order_by='MatchedKeywordSpan.start')
+
+    @property
+    def duplicate_group_list(self):
+        return json.loads(self.duplicate_groups) if self.duplicate_groups else []
+
+    __table_args__ = {'mysql_charset': 'utf8mb4', 'mysql_collate': 'utf8mb4_unicode_ci'}
+
+# 新增MatchedKeywordSpan模型，记录一条消息中每个关键词的命中位置（用于统计和高亮）
+class MatchedKeywordSpan(db.Model):
+    __tablename__ = 'matched_keyword_span'
+    id = db.Column(db.Integer, primary_key=True)
+    message_id = db.Column(db.Integer, db.ForeignKey('matched_message.id', ondelete='CASCADE'), nullable=False, index=True)
+    keyword_id = db.Column(db.Integer, nullable=True, index=True)  # 关键词删除后保留统计，故不加外键
+    keyword_text = db.Column(db.String(191), nullable=False)
+    start = db.Column('start_pos', db.Integer, nullable=False)  # 命中区间 [start, end)
+    end = db.Column('end_pos', db.Integer, nullable=False)
+
+    __table_args__ = {'mysql_charset': 'utf8mb4', 'mysql_collate': 'utf8mb4_unicode_ci'}
+
+
+# 新增FailedNotification模型，保存重试后仍无法送达的通知（不保存签名密钥）
+class FailedNotification(db.Model):
+    __tablename__ = 'failed_notification'
+    id = db.Column(db.Integer, primary_key=True)
+    channel = db.Column(db.String(20), nullable=False)
+    webhook_url = db.Column(db.String(255), nullable=True)
+    title = db.Column(db.String(255), nullable=False)
+    message = db.Column(db.Text, nullable=False)
+    error = db.Column(db.String(500), nullable=True)
+    attempts = db.Column(db.Integer, default=0)
+    created_at = db.Column(db.DateTime, nullable=False)
 
     __table_args__ = {'mysql_charset': 'utf8mb4', 'mysql_collate': 'utf8mb4_unicode_ci'}
 
 
+# 新增BackfillCheckpoint模型，历史消息回溯任务每个群组的进度（中断后从这里继续）
+class BackfillCheckpoint(db.Model):
+    __tablename__ = 'backfill_checkpoint'
+    id = db.Column(db.Integer, primary_key=True)
+    task_key = db.Column(db.String(40), nullable=False)  # 关键词集合 + 回溯范围的哈希
+    group_id = db.Column(db.Integer, nullable=False)
+    last_message_id = db.Column(db.BigInteger, nullable=True)  # 已处理到的最旧消息ID（从新到旧扫描）
+    scanned = db.Column(db.Integer, nullable=False, default=0)
+    matched = db.Column(db.Integer, nullable=False, default=0)
+    done = db.Column(db.Boolean, nullable=False, default=False)
+    updated_at = db.Column(db.DateTime, nullable=False)
+
+    __table_args__ = (
+        db.UniqueConstraint('task_key', 'group_id', name='uq_backfill_task_group'),
+        {'mysql_charset': 'utf8mb4', 'mysql_collate': 'utf8mb4_unicode_ci'},
+    )
+
+
 # 新增User模型，用于存储用户信息
 class User(db.Model):
     __tablename__ = 'user'
@@ -108,11 +280,28 @@ class Session(db.Model):
     __table_args__ = {'mysql_charset': 'utf8mb4', 'mysql_collate': 'utf8mb4_unicode_ci'}
 
 
+# 需要自动补齐的字段: (表名, 字段名, 字段定义)
+UPGRADE_COLUMNS = [
+    ('config', 'notification_type', "VARCHAR(20) DEFAULT 'none' AFTER dingtalk_secret"),
+    ('config', 'wecom_webhook', "VARCHAR(255) NULL AFTER notification_type"),
+    ('keyword', 'notify_immediately', "TINYINT(1) NOT NULL DEFAULT 0"),
+    ('keyword', 'keyword_type', "VARCHAR(10) NOT NULL DEFAULT 'literal'"),
+    ('matched_message', 'fingerprint', "VARCHAR(16) NULL, ADD INDEX ix_matched_message_fingerprint (fingerprint)"),
+    ('matched_message', 'occurrence_count', "INT NOT NULL DEFAULT 1"),
+    ('matched_message', 'duplicate_groups', "TEXT NULL"),
+    ('monitored_group', 'priority', "INT NOT NULL DEFAULT 0"),
+]
+
 def auto_upgrade_database():
     """
     自动升级数据库结构
     检查并添加缺失的字段，确保数据库结构与模型定义一致
     """
+    if not db_config:
+        # 通过 DB_URI 指定的数据库（如测试用 SQLite）由 create_all 建表，不做 MySQL 字段升级
+        print("[数据库] 使用 DB_URI 指定的数据库，跳过结构升级检查")
+        return
+
     import pymysql
     
     try:
@@ -129,52 +318,29 @@ def auto_upgrade_database():
         print("[数据库] 开始检查数据库结构...")
         
         with connection.cursor() as cursor:
-            # 检查 notification_type 字段是否存在
-            cursor.execute("""
-                SELECT COUNT(*) 
-                FROM information_schema.COLUMNS 
-                WHERE TABLE_SCHEMA = %s 
-                AND TABLE_NAME = 'config' 
-                AND COLUMN_NAME = 'notification_type'
-            """, (db_config['database'],))
-            
-            notification_type_exists = cursor.fetchone()[0] > 0
-            
-            # 检查 wecom_webhook 字段是否存在
-            cursor.execute("""
-                SELECT COUNT(*) 
-                FROM information_schema.COLUMNS 
-                WHERE TABLE_SCHEMA = %s 
-                AND TABLE_NAME = 'config' 
-                AND COLUMN_NAME = 'wecom_webhook'
-            """, (db_config['database'],))
-            
-            wecom_webhook_exists = cursor.fetchone()[0] > 0
-            
-            # 添加 notification_type 字段
-            if not notification_type_exists:
-                print("[数据库] → 添加字段: notification_type")
-                cursor.execute("""
-                    ALTER TABLE config 
-                    ADD COLUMN notification_type VARCHAR(20) DEFAULT 'none'
-                    AFTER dingtalk_secret
-                """)
-                print("[数据库] ✓ 字段 notification_type 添加成功")
-            
-            # 添加 wecom_webhook 字段
-            if not wecom_webhook_exists:
-                print("[数据库] → 添加字段: wecom_webhook")
+            added_columns = 0
+            for table_name, column_name, column_definition in UPGRADE_COLUMNS:
+                # 检查字段是否存在
                 cursor.execute("""
-                    ALTER TABLE config 
-                    ADD COLUMN wecom_webhook VARCHAR(255) NULL
-                    AFTER notification_type
-                """)
-                print("[数据库] ✓ 字段 wecom_webhook 添加成功")
+                    SELECT COUNT(*) 
+                    FROM information_schema.COLUMNS 
+                    WHERE TABLE_SCHEMA = %s 
+                    AND TABLE_NAME = %s 
+                    AND COLUMN_NAME = %s
+                """, (db_config['database'], table_name, column_name))
+
+                if cursor.fetchone()[0] > 0:
+                    continue
+
+                print(f"[数据库] → 添加字段: {table_name}.{column_name}")
+                cursor.execute(f"ALTER TABLE {table_name} ADD COLUMN {column_name} {column_definition}")
+                print(f"[数据库] ✓ 字段 {table_name}.{column_name} 添加成功")
+                added_columns += 1
             
             # 提交更改
             connection.commit()
             
-            if not notification_type_exists or not wecom_webhook_exists:
+            if added_columns:
                 print("[数据库] ✓ 数据库结构升级完成")
             else:
                 print("[数据库] ✓ 数据库结构已是最新版本")
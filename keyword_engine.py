@@ -0,0 +1,550 @@
+"""
+关键词匹配引擎
+所有群组共用一个 Aho-Corasick 自动机，每个关键词的负载里带上订阅它的群组集合（位图），
+匹配时按当前群组过滤命中结果。内存只与不同关键词的数量相关，而不是 关键词数 × 群组数。
+"""
+import hashlib
+import os
+import pickle
+import re
+import threading
+import time
+from collections import namedtuple
+from datetime import datetime
+
+import ahocorasick
+from sqlalchemy import select
+
+from database import Keyword, group_keyword_association, instance_path
+from keyword_rules import RuleSyntaxError, parse_rule
+from text_normalize import TABLE_SIGNATURE, NormalizedText, normalize, stripped_symbols
+
+try:
+    from re import _parser as sre_parse  # Python 3.11+
+except ImportError:
+    import sre_parse
+
+# 自动机负载格式版本（负载结构变化时递增，使旧的磁盘缓存失效）
+AUTOMATON_FORMAT = 6
+
+# 关键词类型
+KEYWORD_LITERAL = 'literal'
+KEYWORD_REGEX = 'regex'
+KEYWORD_RULE = 'rule'
+
+# 正则关键词的预筛选字面量（规整后）至少要有这么长，太短的几乎每条消息都会命中，起不到筛选作用
+REGEX_MIN_LITERAL = 2
+# 是否允许没有预筛选字面量的正则（如 1[3-9]\d{9}）: 这类正则要在事件循环中对每条消息执行，默认不允许
+REGEX_ALLOW_UNFILTERED = os.environ.get('REGEX_ALLOW_UNFILTERED', '0') not in ('0', 'false', 'False')
+
+# 预编译自动机的磁盘缓存目录（按关键词集合的哈希命名）
+AUTOMATON_CACHE_DIR = os.path.join(instance_path, 'automaton_cache')
+AUTOMATON_CACHE_KEEP = 3  # 保留最近的几个版本
+
+# 从数据库加载的关键词记录: group_mask 为订阅该关键词的群组位图
+KeywordRow = namedtuple('KeywordRow', ['id', 'text', 'group_mask', 'notify_immediately', 'keyword_type'],
+                        defaults=(False, KEYWORD_LITERAL))
+
+# 一次命中: [start, end) 为命中文本在原始消息中的区间
+KeywordHit = namedtuple('KeywordHit', ['keyword_id', 'keyword_text', 'start', 'end'])
+
+# 编译好的正则关键词
+RegexKeyword = namedtuple('RegexKeyword', ['id', 'text', 'pattern', 'group_mask'])
+
+
+def group_mask(group_ids):
+    """把群组ID集合编码成整数位图（第 group_id 位为1表示订阅）"""
+    group_ids = list(group_ids)
+    if not group_ids:
+        return 0
+    bits = bytearray(max(group_ids) // 8 + 1)
+    for group_id in group_ids:
+        bits[group_id >> 3] |= 1 << (group_id & 7)
+    return int.from_bytes(bits, 'little')
+
+
+def load_keyword_rows(session):
+    """
+    一次查询加载全部关键词及其订阅群组
+    按关键词ID排序流式读取，每个关键词的群组列表读完立即压缩成位图，
+    订阅群组完全相同的关键词共用同一个位图对象
+    """
+    result = session.execute(
+        select(Keyword.id, Keyword.text, Keyword.notify_immediately, Keyword.keyword_type,
+               group_keyword_association.c.group_id)
+        .select_from(Keyword)
+        .outerjoin(group_keyword_association, group_keyword_association.c.keyword_id == Keyword.id)
+        .order_by(Keyword.id)
+        .execution_options(yield_per=5000)
+    )
+
+    keywords = []
+    masks = {}
+    current_id, current_text, current_immediate, current_type, current_groups = None, None, False, None, []
+
+    def flush():
+        mask = group_mask(current_groups)
+        keywords.append(KeywordRow(
+            current_id, current_text, masks.setdefault(mask, mask), bool(current_immediate),
+            current_type or KEYWORD_LITERAL
+        ))
+
+    for keyword_id, text, immediate, keyword_type, group_id in result:
+        if keyword_id != current_id:
+            if current_id is not None:
+                flush()
+            current_id, current_text, current_immediate, current_type, current_groups = (
+                keyword_id, text, immediate, keyword_type, []
+            )
+        if group_id is not None:
+            current_groups.append(group_id)
+    if current_id is not None:
+        flush()
+    return keywords
+
+
+def compile_keyword_pattern(text):
+    """编译正则关键词（不区分大小写，与普通关键词一致）；语法错误时抛出 re.error"""
+    return re.compile(text, re.IGNORECASE)
+
+
+def _literal_factor(parsed):
+    """
+    从解析后的正则中找出“必然出现”的字面量集合: 任何匹配都至少包含集合中的一个字符串
+    连续的字面字符组成候选；必经的分组、至少重复一次的子模式递归查找；
+    分支的每个选项都有候选时，合并为一个集合。返回最长（最短元素最长）的候选，没有则返回 None
+    """
+    candidates = []
+    run = []
+
+    def flush_run():
+        if run:
+            candidates.append(frozenset([''.join(run)]))
+            run.clear()
+
+    for op, av in parsed:
+        name = str(op)
+        if name == 'LITERAL':
+            run.append(chr(av))
+            continue
+        flush_run()
+        sub = None
+        if name == 'SUBPATTERN':
+            sub = _literal_factor(av[-1])
+        elif name == 'ATOMIC_GROUP':
+            sub = _literal_factor(av)
+        elif name in ('MAX_REPEAT', 'MIN_REPEAT', 'POSSESSIVE_REPEAT') and av[0] >= 1:
+            sub = _literal_factor(av[2])
+        elif name == 'BRANCH':
+            options = [_literal_factor(branch) for branch in av[1]]
+            if options and all(options):
+                sub = frozenset().union(*options)
+        if sub:
+            candidates.append(sub)
+    flush_run()
+
+    scored = []
+    for candidate in candidates:
+        normalized = frozenset(normalize(literal) for literal in candidate)
+        scored.append((min(len(literal) for literal in normalized), -len(normalized), normalized))
+    if not scored:
+        return None
+    return max(scored, key=lambda item: item[:2])[2]
+
+
+def required_literals(text):
+    """
+    正则关键词的预筛选字面量（规整后），消息中没有出现其中任何一个时正则不可能匹配
+    找不到足够长的字面量时返回 None（该正则需要对每条消息执行）
+    """
+    try:
+        factor = _literal_factor(sre_parse.parse(text, re.IGNORECASE))
+    except Exception:
+        return None
+    if not factor or min(len(literal) for literal in factor) < REGEX_MIN_LITERAL:
+        return None
+    return factor
+
+
+def _add_prefilter(automaton, key, regex_id=None, is_term=False):
+    """在自动机中登记一个预筛选字面量（正则的必需字面量或规则中的词），保留该键已有的负载"""
+    keyword_id, keyword_text, mask, _, regex_ids, term, merged = automaton.get(key, (None, None, 0, 0, (), False, ()))
+    if regex_id is not None:
+        regex_ids += (regex_id,)
+    automaton.add_word(key, (keyword_id, keyword_text, mask, len(key), regex_ids, term or is_term, merged))
+
+
+def build_keyword_automaton(keywords):
+    """
+    为一组关键词构建Aho-Corasick自动机
+    性能优化: 将多个关键词编译成状态机,实现O(n)时间复杂度的多模式匹配
+    关键词与消息使用同一张规整转换表（见 text_normalize），全角/繁体/插入标点等变体不必再单独添加
+    正则关键词不直接放入自动机，而是放入它的必需字面量作为预筛选: 命中后才执行完整的正则匹配
+    组合规则中的每个词也放入自动机，同一次扫描得到它们的命中位置
+
+    Args:
+        keywords: KeywordRow 列表（text + group_mask）
+
+    Returns:
+        automaton: 构建好的AC自动机，负载为
+                   (关键词ID, 关键词文本, 群组位图, 规整后长度, 触发的正则关键词ID, 是否为规则中的词, 同键关键词)
+                   只用于预筛选的字面量，关键词ID和文本为 None、群组位图为 0；
+                   多个关键词规整后相同时，群组位图为它们的并集，同键关键词为全部的 (ID, 文本, 群组位图)，
+                   否则为空元组
+    """
+    automaton = ahocorasick.Automaton()
+    masks = {}  # 订阅群组完全相同的关键词共用同一个位图对象
+
+    for keyword in keywords:
+        mask = keyword.group_mask
+        if not mask:
+            continue
+
+        if keyword.keyword_type == KEYWORD_REGEX:
+            for key in required_literals(keyword.text) or ():
+                _add_prefilter(automaton, key, regex_id=keyword.id)
+            continue
+
+        if keyword.keyword_type == KEYWORD_RULE:
+            try:
+                rule = parse_rule(keyword.text)
+            except RuleSyntaxError:
+                continue  # KeywordMatcher 中会提示
+            for key in rule.terms:
+                _add_prefilter(automaton, key, is_term=True)
+            continue
+
+        key = normalize(keyword.text)
+        if not key:
+            print(f"[关键词引擎] 关键词 '{keyword.text}' 规整后为空（只包含标点或符号），已忽略")
+            continue
+        symbols = stripped_symbols(keyword.text)
+        if symbols:
+            # 开启删除标点之前添加的关键词: 含义已改变（c# → c），提示管理员修改
+            print(f"[关键词引擎] 关键词 '{keyword.text}' 中的 {symbols} 在匹配时被忽略，实际按 '{key}' 匹配，"
+                  f"可能产生误报")
+        mask = masks.setdefault(mask, mask)
+        existing = automaton.get(key, None)
+        regex_ids, is_term, merged = (), False, ()
+        if existing is not None:
+            regex_ids, is_term = existing[4], existing[5]
+        if existing is not None and existing[0] is not None:
+            # 规整后相同的关键词（大小写、全角半角、繁简不同）: 各自保留ID和订阅群组，命中时分别返回，
+            # 立即通知标记和命中区间都记到各自的关键词上；位图取并集用于快速过滤
+            keyword_id, keyword_text, existing_mask = existing[:3]
+            merged = (existing[6] or ((keyword_id, keyword_text, existing_mask),)) + ((keyword.id, keyword.text, mask),)
+            mask = masks.setdefault(mask | existing_mask, mask | existing_mask)
+        else:
+            keyword_id, keyword_text = keyword.id, keyword.text
+        automaton.add_word(key, (keyword_id, keyword_text, mask, len(key), regex_ids, is_term, merged))
+
+    # 构建失败指针,完成自动机
+    automaton.make_automaton()
+
+    return automaton
+
+
+def keyword_set_hash(keywords):
+    """关键词集合（含订阅群组）的版本哈希，内容不变时哈希不变"""
+    digest = hashlib.sha1(f"format:{AUTOMATON_FORMAT}\nnormalize:{TABLE_SIGNATURE}\n".encode('utf-8'))
+    for keyword in sorted(keywords, key=lambda k: k.id):
+        digest.update(
+            f"{keyword.id}\t{keyword.text}\t{keyword.group_mask:x}\t{int(keyword.notify_immediately)}\t"
+            f"{keyword.keyword_type}\n".encode('utf-8')
+        )
+    return digest.hexdigest()
+
+
+def automaton_cache_path(keyword_hash):
+    return os.path.join(AUTOMATON_CACHE_DIR, f"{keyword_hash}.ac")
+
+
+def load_cached_automaton(keyword_hash):
+    """从磁盘加载预编译的自动机，不存在或损坏时返回 None"""
+    path = automaton_cache_path(keyword_hash)
+    if not os.path.exists(path):
+        return None
+    try:
+        with open(path, 'rb') as f:
+            return pickle.load(f)
+    except Exception as e:
+        print(f"[关键词引擎] 读取自动机缓存失败，将重新构建: {e}")
+        return None
+
+
+def save_cached_automaton(keyword_hash, automaton):
+    """把自动机序列化到磁盘（先写临时文件再改名，避免读到写了一半的文件）"""
+    os.makedirs(AUTOMATON_CACHE_DIR, exist_ok=True)
+    path = automaton_cache_path(keyword_hash)
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, 'wb') as f:
+        pickle.dump(automaton, f, protocol=pickle.HIGHEST_PROTOCOL)
+    os.replace(tmp_path, path)
+
+    # 清理旧版本，只保留最近的几个
+    cached = sorted(
+        (os.path.join(AUTOMATON_CACHE_DIR, name) for name in os.listdir(AUTOMATON_CACHE_DIR)
+         if name.endswith('.ac')),
+        key=os.path.getmtime, reverse=True
+    )
+    for old_path in cached[AUTOMATON_CACHE_KEEP:]:
+        try:
+            os.remove(old_path)
+        except OSError:
+            pass
+
+
+class KeywordMatcher:
+    """
+    关键词匹配快照（构建后只读，可在多个线程中并发使用）
+    """
+    def __init__(self, keywords, version=0, keyword_hash=None, automaton=None):
+        self.version = version
+        self.keyword_hash = keyword_hash
+        self.automaton = automaton if automaton is not None else build_keyword_automaton(keywords)
+        self.keyword_count = sum(1 for k in keywords if k.group_mask)
+        self.groups_mask = 0
+        for mask in {id(k.group_mask): k.group_mask for k in keywords}.values():
+            self.groups_mask |= mask
+        self.group_count = bin(self.groups_mask).count('1')
+        self.immediate_ids = frozenset(k.id for k in keywords if k.notify_immediately)
+
+        # 正则关键词每个版本只编译一次；没有可用预筛选字面量的正则对每条消息都要执行（需 REGEX_ALLOW_UNFILTERED）
+        self.regexes = {}
+        unfiltered = []
+        ignored = []
+        for keyword in keywords:
+            if keyword.keyword_type != KEYWORD_REGEX or not keyword.group_mask:
+                continue
+            try:
+                pattern = compile_keyword_pattern(keyword.text)
+            except re.error as e:
+                print(f"[关键词引擎] 正则关键词 '{keyword.text}' 无效，已忽略: {e}")
+                continue
+            if required_literals(keyword.text) is None:
+                if not REGEX_ALLOW_UNFILTERED:
+                    ignored.append(keyword.text)
+                    continue
+                unfiltered.append(keyword.id)
+            self.regexes[keyword.id] = RegexKeyword(keyword.id, keyword.text, pattern, keyword.group_mask)
+        self.unfiltered_regex_ids = tuple(unfiltered)
+        if ignored:
+            print(f"[关键词引擎] {len(ignored)} 个正则关键词没有至少 {REGEX_MIN_LITERAL} 个字的固定文字，已忽略"
+                  f"（设置 REGEX_ALLOW_UNFILTERED=1 可对每条消息执行）: {', '.join(ignored[:5])}")
+        if unfiltered:
+            print(f"[关键词引擎] {len(unfiltered)} 个正则关键词没有可用于预筛选的字面量，将对每条消息执行: "
+                  f"{', '.join(self.regexes[i].text for i in unfiltered[:5])}")
+
+        # 组合规则: 按词索引，只有命中了规则中某个词时才对该规则求值
+        self.rules = {}
+        rules_by_term = {}
+        for keyword in keywords:
+            if keyword.keyword_type != KEYWORD_RULE or not keyword.group_mask:
+                continue
+            try:
+                rule = parse_rule(keyword.text, keyword.id, keyword.group_mask)
+            except RuleSyntaxError as e:
+                print(f"[关键词引擎] 规则 '{keyword.text}' 无效，已忽略: {e}")
+                continue
+            self.rules[keyword.id] = rule
+            for term in rule.terms:
+                rules_by_term.setdefault(term, []).append(keyword.id)
+        self.rules_by_term = {term: tuple(ids) for term, ids in rules_by_term.items()}
+
+    def has_group(self, group_id):
+        """该群组是否配置了关键词"""
+        return bool(self.groups_mask >> group_id & 1)
+
+    def iter_matches(self, text, group_id):
+        """
+        逐个返回当前群组订阅的命中关键词（KeywordHit），单次扫描，O(消息长度 + 命中数)
+        在规整后的文本上匹配，命中区间换算回原文位置；
+        正则关键词只在预筛选字面量命中后才执行完整匹配，同样在规整后的文本上执行
+        （预筛选字面量是在规整后的文本中找到的，全角/繁体等变体在原文上会匹配失败）；
+        规整后的文本中没有匹配时再在原文上执行，兼容正则本身含有会被规整的字符（如繁体字）的情况
+        """
+        if not self.has_group(group_id):
+            return
+        normalized = NormalizedText(text)
+        triggered = set()
+        term_hits = {}  # {规则中的词: [(start, end), ...]}（规整后文本中的位置）
+        for end_index, (keyword_id, keyword_text, mask, length, regex_ids, is_term, merged) in self.automaton.iter(normalized.text):
+            if mask >> group_id & 1:
+                start, end = normalized.original_span(end_index - length + 1, end_index + 1)
+                if merged:
+                    # 规整后相同的多个关键词: 当前群组订阅的每一个都算命中
+                    for merged_id, merged_text, merged_mask in merged:
+                        if merged_mask >> group_id & 1:
+                            yield KeywordHit(merged_id, merged_text, start, end)
+                else:
+                    yield KeywordHit(keyword_id, keyword_text, start, end)
+            if regex_ids:
+                triggered.update(regex_ids)
+            if is_term:
+                term = normalized.text[end_index - length + 1:end_index + 1]
+                term_hits.setdefault(term, []).append((end_index - length + 1, end_index + 1))
+
+        if term_hits:
+            yield from self._match_rules(normalized, term_hits, group_id)
+
+        for regex_id in sorted(triggered) + list(self.unfiltered_regex_ids):
+            regex = self.regexes.get(regex_id)
+            if regex is None or not regex.group_mask >> group_id & 1:
+                continue
+            matched = False
+            for match in regex.pattern.finditer(normalized.text):
+                if match.end() > match.start():
+                    matched = True
+                    start, end = normalized.original_span(match.start(), match.end())
+                    yield KeywordHit(regex.id, regex.text, start, end)
+            if matched or normalized.text == text:
+                continue
+            for match in regex.pattern.finditer(text):
+                if match.end() > match.start():
+                    yield KeywordHit(regex.id, regex.text, match.start(), match.end())
+
+    def _match_rules(self, normalized, term_hits, group_id):
+        """对命中了至少一个词的规则求值；规则成立时，以其中（非 NOT）词的每次出现作为命中区间"""
+        candidates = set()
+        for term in term_hits:
+            candidates.update(self.rules_by_term.get(term, ()))
+        for rule_id in sorted(candidates):
+            rule = self.rules[rule_id]
+            if not rule.group_mask >> group_id & 1 or not rule.matches(term_hits):
+                continue
+            for term in rule.positive_terms:
+                for start, end in term_hits.get(term, ()):
+                    start, end = normalized.original_span(start, end)
+                    yield KeywordHit(rule.id, rule.text, start, end)
+
+    def find_all(self, text, group_id):
+        """返回全部命中（含每次出现的区间），按出现位置排序"""
+        return sorted(self.iter_matches(text, group_id), key=lambda hit: (hit.start, hit.end))
+
+    def prewarm(self):
+        """遍历一遍自动机的全部节点，让首条消息不必承担缺页开销"""
+        if self.keyword_count:
+            self.automaton.get_stats()
+            for _ in self.automaton.iter('prewarm 预热'):
+                pass
+
+    def first_hit(self, text, group_id):
+        """返回第一个命中（KeywordHit），未命中返回 None"""
+        for hit in self.iter_matches(text, group_id):
+            return hit
+        return None
+
+    def first_match(self, text, group_id):
+        """返回第一个命中的关键词文本，未命中返回 None"""
+        hit = self.first_hit(text, group_id)
+        return hit.keyword_text if hit else None
+
+    def is_immediate(self, hits):
+        """命中的关键词中是否有设置为立即通知的"""
+        return any(hit.keyword_id in self.immediate_ids for hit in hits)
+
+
+class KeywordEngine:
+    """
+    管理当前生效的关键词匹配快照
+    关键词变更时由后台线程重新构建自动机，构建完成后整体替换引用（原子切换），
+    消息处理线程只读取 snapshot，永远不会因为构建自动机而阻塞。
+    """
+    def __init__(self, loader):
+        """
+        Args:
+            loader: 无参函数，返回 KeywordRow 列表（在后台线程中调用）
+        """
+        self._loader = loader
+        self._snapshot = KeywordMatcher([])
+        self._rebuild_event = threading.Event()
+        self._thread = None
+        self._thread_lock = threading.Lock()
+        self._build_lock = threading.Lock()  # 只串行化构建过程，读取快照不加锁
+        self.rebuilding = False
+        self.last_rebuild_duration = None
+        self.last_rebuild_at = None
+        self.last_error = None
+        self.loaded_from_cache = False
+
+    @property
+    def snapshot(self):
+        """当前生效的匹配器（只读快照）"""
+        return self._snapshot
+
+    def rebuild_now(self):
+        """同步构建并切换快照（启动时调用）"""
+        with self._build_lock:
+            self.rebuilding = True
+            try:
+                started = time.perf_counter()
+                keywords = self._loader()
+                keyword_hash = keyword_set_hash(keywords)
+                if keyword_hash == self._snapshot.keyword_hash:
+                    return self._snapshot
+
+                # 性能优化: 关键词集合未变化时直接加载磁盘上的预编译自动机
+                automaton = load_cached_automaton(keyword_hash)
+                from_cache = automaton is not None
+                matcher = KeywordMatcher(
+                    keywords, version=self._snapshot.version + 1,
+                    keyword_hash=keyword_hash, automaton=automaton
+                )
+                matcher.prewarm()
+                self.last_rebuild_duration = time.perf_counter() - started
+                self.last_rebuild_at = datetime.now()
+                self.last_error = None
+                self.loaded_from_cache = from_cache
+                self._snapshot = matcher
+                print(f"[关键词引擎] 自动机 v{matcher.version} {'从缓存加载' if from_cache else '构建完成'}: "
+                      f"{matcher.keyword_count} 个关键词, {matcher.group_count} 个群组, "
+                      f"耗时 {self.last_rebuild_duration:.3f}s")
+
+                if not from_cache and matcher.keyword_count:
+                    try:
+                        save_cached_automaton(keyword_hash, matcher.automaton)
+                    except Exception as e:
+                        print(f"[关键词引擎] 保存自动机缓存失败: {e}")
+                return matcher
+            finally:
+                self.rebuilding = False
+
+    def request_rebuild(self):
+        """请求后台重建（多次请求会合并为一次），立即返回"""
+        self._ensure_worker()
+        self._rebuild_event.set()
+
+    def _ensure_worker(self):
+        with self._thread_lock:
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(
+                    target=self._worker, name="KeywordRebuild", daemon=True
+                )
+                self._thread.start()
+
+    def _worker(self):
+        while True:
+            self._rebuild_event.wait()
+            self._rebuild_event.clear()
+            try:
+                self.rebuild_now()
+            except Exception as e:
+                self.last_error = str(e)
+                print(f"[关键词引擎] 后台重建失败，继续使用 v{self._snapshot.version}: {e}")
+
+    def get_stats(self):
+        snapshot = self._snapshot
+        return {
+            'version': snapshot.version,
+            'keyword_hash': snapshot.keyword_hash,
+            'loaded_from_cache': self.loaded_from_cache,
+            'keyword_count': snapshot.keyword_count,
+            'regex_count': len(snapshot.regexes),
+            'regex_unfiltered': len(snapshot.unfiltered_regex_ids),
+            'rule_count': len(snapshot.rules),
+            'group_count': snapshot.group_count,
+            'rebuilding': self.rebuilding or self._rebuild_event.is_set(),
+            'last_rebuild_duration': self.last_rebuild_duration,
+            'last_rebuild_at': self.last_rebuild_at.strftime('%Y-%m-%d %H:%M:%S') if self.last_rebuild_at else None,
+            'last_error': self.last_error,
+        }
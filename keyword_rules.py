@@ -0,0 +1,197 @@
+"""
+组合关键词规则
+单个词容易误报（“数据”到处都是），规则把多个词组合起来，例如:
+    数据 AND 出售 NOT 招聘
+    (USDT OR 泰达币) AND NEAR/10(担保, 交易)
+语法:
+    AND / OR / NOT（大写），相邻的项之间省略 AND 也视为 AND，NOT 优先级最高、OR 最低，可以用括号分组
+    NEAR/n(词1, 词2): 两个词都出现且间隔不超过 n 个字符（规整后），省略 /n 时为 RULE_NEAR_DEFAULT
+    含空格或特殊字符的词用双引号括起来
+规则中的每个词作为字面量放进关键词自动机，一次扫描得到全部词的命中位置后再求值，
+只有命中了某个词的规则才会被求值，耗时与命中数相关，而与规则总数无关。
+"""
+import os
+import re
+
+from text_normalize import normalize, stripped_symbols
+
+RULE_NEAR_DEFAULT = int(os.environ.get('RULE_NEAR_DEFAULT', 10))
+
+_TOKEN = re.compile(r'\s*(?:(\()|(\))|(,)|"([^"]*)"|(NEAR(?:/(\d+))?)(?=\s*\()|([^\s(),"]+))')
+_OPERATORS = ('AND', 'OR', 'NOT')
+
+
+class RuleSyntaxError(ValueError):
+    pass
+
+
+def tokenize(text):
+    tokens = []
+    pos = 0
+    text = text.strip()
+    while pos < len(text):
+        match = _TOKEN.match(text, pos)
+        if not match or match.end() == pos:
+            raise RuleSyntaxError(f"无法解析: {text[pos:]}")
+        pos = match.end()
+        open_paren, close_paren, comma, quoted, near, near_distance, word = match.groups()
+        if open_paren:
+            tokens.append(('(', None))
+        elif close_paren:
+            tokens.append((')', None))
+        elif comma:
+            tokens.append((',', None))
+        elif near:
+            tokens.append(('NEAR', int(near_distance) if near_distance else RULE_NEAR_DEFAULT))
+        elif quoted is not None:
+            tokens.append(('TERM', quoted))
+        elif word in _OPERATORS:
+            tokens.append((word, None))
+        else:
+            tokens.append(('TERM', word))
+    return tokens
+
+
+class _Parser:
+    """递归下降解析，结果为嵌套元组: ('term', 词) / ('and', [...]) / ('or', [...]) / ('not', 子式) / ('near', n, 词1, 词2)"""
+    def __init__(self, tokens):
+        self.tokens = tokens
+        self.pos = 0
+
+    def peek(self):
+        return self.tokens[self.pos][0] if self.pos < len(self.tokens) else None
+
+    def take(self, kind):
+        if self.peek() != kind:
+            found = self.peek() or '结尾'
+            raise RuleSyntaxError(f"此处应为 {kind}，实际为 {found}")
+        token = self.tokens[self.pos]
+        self.pos += 1
+        return token[1]
+
+    def parse(self):
+        if not self.tokens:
+            raise RuleSyntaxError("规则为空")
+        node = self.parse_or()
+        if self.pos != len(self.tokens):
+            raise RuleSyntaxError(f"多余的 {self.peek()}")
+        return node
+
+    def parse_or(self):
+        items = [self.parse_and()]
+        while self.peek() == 'OR':
+            self.pos += 1
+            items.append(self.parse_and())
+        return items[0] if len(items) == 1 else ('or', items)
+
+    def parse_and(self):
+        items = [self.parse_not()]
+        while self.peek() in ('AND', 'NOT', 'TERM', 'NEAR', '('):
+            if self.peek() == 'AND':
+                self.pos += 1
+            items.append(self.parse_not())
+        return items[0] if len(items) == 1 else ('and', items)
+
+    def parse_not(self):
+        if self.peek() == 'NOT':
+            self.pos += 1
+            return ('not', self.parse_not())
+        return self.parse_primary()
+
+    def parse_primary(self):
+        kind = self.peek()
+        if kind == '(':
+            self.pos += 1
+            node = self.parse_or()
+            self.take(')')
+            return node
+        if kind == 'NEAR':
+            distance = self.take('NEAR')
+            self.take('(')
+            first = self.term(self.take('TERM'))
+            self.take(',')
+            second = self.term(self.take('TERM'))
+            self.take(')')
+            return ('near', distance, first, second)
+        return ('term', self.term(self.take('TERM')))
+
+    @staticmethod
+    def term(text):
+        symbols = stripped_symbols(text)
+        if symbols:
+            raise RuleSyntaxError(f"“{text}” 中的 {symbols} 在匹配时会被忽略，请去掉这些字符")
+        key = normalize(text)
+        if not key:
+            raise RuleSyntaxError(f"“{text}” 规整后为空（只包含符号）")
+        return key
+
+
+def evaluate(node, hits):
+    """
+    对一次扫描得到的词命中求值
+    hits: {规整后的词: [(start, end), ...]}（规整后文本中的位置）
+    """
+    kind = node[0]
+    if kind == 'term':
+        return node[1] in hits
+    if kind == 'and':
+        return all(evaluate(item, hits) for item in node[1])
+    if kind == 'or':
+        return any(evaluate(item, hits) for item in node[1])
+    if kind == 'not':
+        return not evaluate(node[1], hits)
+    _, distance, first, second = node
+    first_hits, second_hits = hits.get(first), hits.get(second)
+    if not first_hits or not second_hits:
+        return False
+    for a_start, a_end in first_hits:
+        for b_start, b_end in second_hits:
+            if max(b_start - a_end, a_start - b_end, 0) <= distance:
+                return True
+    return False
+
+
+def _collect_terms(node, positive, terms, negative):
+    kind = node[0]
+    if kind == 'term':
+        terms.add(node[1])
+        if not negative:
+            positive.add(node[1])
+    elif kind in ('and', 'or'):
+        for item in node[1]:
+            _collect_terms(item, positive, terms, negative)
+    elif kind == 'not':
+        _collect_terms(node[1], positive, terms, not negative)
+    else:
+        terms.update(node[2:])
+        if not negative:
+            positive.update(node[2:])
+
+
+class KeywordRule:
+    """
+    编译好的规则
+    terms: 规则用到的全部词；positive_terms: 不在 NOT 下的词（命中时用于高亮）
+    """
+    __slots__ = ('id', 'text', 'tree', 'terms', 'positive_terms', 'group_mask')
+
+    def __init__(self, text, rule_id=None, group_mask=0):
+        self.id = rule_id
+        self.text = text
+        self.tree = _Parser(tokenize(text)).parse()
+        positive, terms = set(), set()
+        _collect_terms(self.tree, positive, terms, False)
+        self.terms = frozenset(terms)
+        self.positive_terms = frozenset(positive)
+        self.group_mask = group_mask
+        # 只在命中规则中某个词时才求值，因此没有任何命中也成立的规则（如只有 NOT）不允许
+        if evaluate(self.tree, {}):
+            raise RuleSyntaxError("规则至少需要一个必须出现的词（不能只有 NOT）")
+
+    def matches(self, hits):
+        return evaluate(self.tree, hits)
+
+
+def parse_rule(text, rule_id=None, group_mask=0):
+    """解析规则，语法错误时抛出 RuleSyntaxError"""
+    return KeywordRule(text, rule_id, group_mask)
@@ -0,0 +1,273 @@
+"""
+匹配消息异步批量写入
+消息处理线程（asyncio 事件循环 / OCR 线程）只把待保存的记录放进有界队列，
+由独立的写入线程按数量或时间批量写入数据库（多行 INSERT），数据库慢不会拖慢消息接收。
+重复消息（见 message_dedup）只累加到已保存记录的出现次数和群组列表上。
+"""
+import json
+import os
+import queue
+import threading
+import time
+from collections import Counter, namedtuple
+from datetime import datetime, timedelta
+
+from sqlalchemy import insert, select, text, update
+from sqlalchemy.exc import DBAPIError, OperationalError
+
+from database import MatchedMessage, MatchedKeywordSpan, get_session
+from message_dedup import DEDUP_MAX_GROUPS, DEDUP_TTL
+
+WRITER_QUEUE_SIZE = int(os.environ.get('WRITER_QUEUE_SIZE', 10000))
+WRITER_BATCH_SIZE = int(os.environ.get('WRITER_BATCH_SIZE', 500))
+WRITER_FLUSH_INTERVAL = float(os.environ.get('WRITER_FLUSH_INTERVAL', 0.2))  # 秒
+WRITER_MAX_RETRIES = int(os.environ.get('WRITER_MAX_RETRIES', 5))
+
+_STOP = object()
+
+# 重复消息记录: (指纹, 群组名称)，与普通记录走同一个队列，保证原记录先写入
+DuplicateHit = namedtuple('DuplicateHit', ['fingerprint', 'group_name'])
+
+
+def _is_transient(error):
+    """连接断开、锁等待超时、死锁等可重试的数据库错误"""
+    if isinstance(error, OperationalError):
+        return True
+    return isinstance(error, DBAPIError) and error.connection_invalidated
+
+
+class MatchWriter:
+    def __init__(self, max_queue=WRITER_QUEUE_SIZE, batch_size=WRITER_BATCH_SIZE,
+                 flush_interval=WRITER_FLUSH_INTERVAL, max_retries=WRITER_MAX_RETRIES):
+        self.queue = queue.Queue(maxsize=max_queue)
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.max_retries = max_retries
+        self._thread = None
+        self._thread_lock = threading.Lock()
+        self._id_steps = {}  # {引擎: 自增步长}，无法确定时为 None（改为逐行插入）
+
+        # 统计信息
+        self.written = 0
+        self.dropped = 0
+        self.failed = 0
+        self.retries = 0
+        self.batches = 0
+        self.last_flush_latency = None
+        self.max_flush_latency = 0.0
+        self._total_flush_latency = 0.0
+
+    def start(self):
+        with self._thread_lock:
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(target=self._run, name="MatchWriter", daemon=True)
+                self._thread.start()
+
+    def stop(self, timeout=5):
+        """写完队列中剩余的记录后停止"""
+        thread = self._thread
+        if thread and thread.is_alive():
+            try:
+                self.queue.put(_STOP, timeout=timeout)
+            except queue.Full:
+                pass
+            thread.join(timeout=timeout)
+
+    def submit(self, record):
+        """
+        提交一条待保存的匹配记录（不阻塞）
+        record: dict，字段同 MatchedMessage，另有 'spans': [(keyword_id, keyword_text, start, end), ...]
+        返回: 是否成功入队
+        """
+        self.start()
+        try:
+            self.queue.put_nowait(record)
+            return True
+        except queue.Full:
+            self.dropped += 1
+            print(f"[写入队列] 队列已满({self.queue.maxsize})，丢弃一条匹配记录（累计丢弃 {self.dropped} 条）")
+            return False
+
+    def submit_duplicate(self, fingerprint, group_name):
+        """提交一次重复出现（累加到指纹相同的已保存记录上）"""
+        return self.submit(DuplicateHit(fingerprint, group_name))
+
+    def _run(self):
+        while True:
+            record = self.queue.get()
+            if record is _STOP:
+                return
+            batch = [record]
+            deadline = time.monotonic() + self.flush_interval
+            stop_requested = False
+
+            # 凑够一批或到达时间窗口后写入
+            while len(batch) < self.batch_size:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                try:
+                    record = self.queue.get(timeout=remaining)
+                except queue.Empty:
+                    break
+                if record is _STOP:
+                    stop_requested = True
+                    break
+                batch.append(record)
+
+            self._flush_with_retry(batch)
+            if stop_requested:
+                # 停止前把队列里剩余的记录写完
+                remaining_records = []
+                while True:
+                    try:
+                        remaining_records.append(self.queue.get_nowait())
+                    except queue.Empty:
+                        break
+                for start in range(0, len(remaining_records), self.batch_size):
+                    self._flush_with_retry(remaining_records[start:start + self.batch_size])
+                return
+
+    def _flush_with_retry(self, batch):
+        for attempt in range(self.max_retries + 1):
+            started = time.perf_counter()
+            try:
+                self.flush(batch)
+            except Exception as e:
+                if _is_transient(e) and attempt < self.max_retries:
+                    self.retries += 1
+                    delay = min(0.5 * 2 ** attempt, 10)
+                    print(f"[写入队列] 写入失败，{delay:.1f}秒后重试({attempt + 1}/{self.max_retries}): {e}")
+                    time.sleep(delay)
+                    continue
+                self.failed += len(batch)
+                print(f"[写入队列] 写入失败，放弃 {len(batch)} 条记录: {e}")
+                return
+
+            latency = time.perf_counter() - started
+            self.batches += 1
+            self.written += len(batch)
+            self.last_flush_latency = latency
+            self.max_flush_latency = max(self.max_flush_latency, latency)
+            self._total_flush_latency += latency
+            return
+
+    def flush(self, batch):
+        """在一个事务中写入一批记录: 匹配消息用一条多行 INSERT，命中区间再用一条多行 INSERT"""
+        records = [record for record in batch if not isinstance(record, DuplicateHit)]
+        duplicates = [record for record in batch if isinstance(record, DuplicateHit)]
+        session = get_session()
+        try:
+            if records:
+                self.insert_records(session, records)
+            if duplicates:
+                self._apply_duplicates(session, duplicates)
+            session.commit()
+        except Exception:
+            session.rollback()
+            raise
+        finally:
+            session.close()
+
+    def insert_records(self, session, records):
+        """在调用方的事务中批量插入匹配记录及命中区间（不提交；历史回溯也复用这里）"""
+        rows = [
+            {key: value for key, value in record.items() if key != 'spans'}
+            for record in records
+        ]
+        step = self._id_step(session)
+        if step is None:
+            # 无法确定自增ID的分配方式: 逐行插入，逐条取回ID
+            message_ids = [
+                session.execute(insert(MatchedMessage.__table__).values(row)).inserted_primary_key[0]
+                for row in rows
+            ]
+        else:
+            result = session.execute(insert(MatchedMessage.__table__).values(rows))
+            first_id = self._first_inserted_id(result, len(rows), session.bind.dialect.name, step)
+            message_ids = [first_id + offset * step for offset in range(len(rows))]
+
+        span_rows = []
+        for message_id, record in zip(message_ids, records):
+            for keyword_id, keyword_text, start, end in record.get('spans') or ():
+                span_rows.append({
+                    'message_id': message_id,
+                    'keyword_id': keyword_id,
+                    'keyword_text': keyword_text,
+                    'start_pos': start,
+                    'end_pos': end,
+                })
+        if span_rows:
+            session.execute(insert(MatchedKeywordSpan.__table__).values(span_rows))
+
+    def _apply_duplicates(self, session, duplicates):
+        """把同一批内的重复出现按指纹汇总后，累加到窗口期内指纹相同的记录上"""
+        counts = Counter(dup.fingerprint for dup in duplicates)
+        groups = {}
+        for dup in duplicates:
+            groups.setdefault(dup.fingerprint, []).append(dup.group_name)
+
+        since = datetime.now() - timedelta(seconds=DEDUP_TTL + 60)
+        table = MatchedMessage.__table__
+        rows = session.execute(
+            select(table.c.id, table.c.fingerprint, table.c.group_name, table.c.duplicate_groups)
+            .where(table.c.fingerprint.in_(list(counts)), table.c.message_date >= since)
+        ).all()
+
+        for message_id, fingerprint, group_name, duplicate_groups in rows:
+            merged = json.loads(duplicate_groups) if duplicate_groups else []
+            for name in groups[fingerprint]:
+                if name != group_name and name not in merged and len(merged) < DEDUP_MAX_GROUPS:
+                    merged.append(name)
+            session.execute(
+                update(table).where(table.c.id == message_id).values(
+                    occurrence_count=table.c.occurrence_count + counts[fingerprint],
+                    duplicate_groups=json.dumps(merged, ensure_ascii=False) if merged else None,
+                )
+            )
+
+    def _id_step(self, session):
+        """
+        多行 INSERT 中相邻两行自增ID的差值（每个引擎只查询一次）
+        MySQL 多主集群（Galera、组复制）会把 auto_increment_increment 设为大于1，
+        同一条语句插入的ID按步长递增而不是连续；查询失败时返回 None
+        """
+        engine = session.bind
+        if engine not in self._id_steps:
+            step = 1
+            if engine.dialect.name == 'mysql':
+                try:
+                    step = int(session.execute(text('SELECT @@auto_increment_increment')).scalar())
+                except Exception as e:
+                    print(f"[写入队列] 无法读取 auto_increment_increment，改为逐行插入: {e}")
+                    step = None
+            self._id_steps[engine] = step
+        return self._id_steps[engine]
+
+    @staticmethod
+    def _first_inserted_id(result, row_count, dialect_name, step=1):
+        """
+        多行 INSERT 的第一个自增ID
+        MySQL 的 LAST_INSERT_ID() 返回本条语句插入的第一行ID，同一条“简单插入”语句生成的ID按 step 递增；
+        SQLite 的 lastrowid 是最后一行的ID
+        """
+        if dialect_name == 'sqlite':
+            return result.lastrowid - (row_count - 1) * step
+        return result.lastrowid
+
+    def get_stats(self):
+        return {
+            'queue_depth': self.queue.qsize(),
+            'queue_capacity': self.queue.maxsize,
+            'written': self.written,
+            'dropped': self.dropped,
+            'failed': self.failed,
+            'retries': self.retries,
+            'batches': self.batches,
+            'last_flush_latency': self.last_flush_latency,
+            'avg_flush_latency': self._total_flush_latency / self.batches if self.batches else None,
+            'max_flush_latency': self.max_flush_latency,
+        }
+
+
+match_writer = MatchWriter()
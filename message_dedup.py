@@ -0,0 +1,131 @@
+"""
+跨群组重复消息抑制
+同一条公告/广告常在几秒内被转发到几十个监控群组。命中关键词的消息按规整后的文本和图片ID
+以及命中的关键词计算指纹，在 TTL 时间窗口内再次出现的相同指纹视为重复: 不再单独保存、推送和通知，
+只把出现次数和群组累加到第一次保存的那条记录上。
+
+指纹保存在按时间分桶的集合中，整桶过期淘汰，总条数有上限，内存有界。
+"""
+import hashlib
+import os
+import re
+import threading
+import time
+from collections import deque
+
+from text_normalize import normalize
+
+DEDUP_ENABLED = os.environ.get('DEDUP_ENABLED', '1') not in ('0', 'false', 'False')
+DEDUP_TTL = float(os.environ.get('DEDUP_TTL', 600))                  # 秒，指纹保留时长
+DEDUP_BUCKETS = int(os.environ.get('DEDUP_BUCKETS', 10))             # 时间分桶数（过期精度为 TTL/桶数）
+DEDUP_MAX_ENTRIES = int(os.environ.get('DEDUP_MAX_ENTRIES', 500000))  # 指纹总数上限
+DEDUP_MIN_TEXT_LENGTH = int(os.environ.get('DEDUP_MIN_TEXT_LENGTH', 10))  # 纯文本消息短于此长度不去重（避免“好的”之类被合并）
+DEDUP_MAX_GROUPS = 100  # 每条记录最多保存的重复群组数
+
+_WHITESPACE = re.compile(r'\s+')
+
+
+def normalize_text(text):
+    """去除空白差异，并按关键词匹配的规则规整（转发时常被加减空格/换行、零宽字符）"""
+    return _WHITESPACE.sub('', normalize(text or ''))
+
+
+def message_fingerprint(text, photo_id=None, source='text', keyword_ids=()):
+    """
+    消息内容指纹（16位十六进制），未开启去重、或没有图片且文本过短时返回 None（不参与去重）
+    图片以 Telegram 的 photo id 标识: 转发的图片与原图共用同一个文件ID
+    source 区分文本命中和图片识别命中（同一条消息可能各保存一条记录）
+    keyword_ids 为命中的关键词ID: 转发到订阅了其他关键词（如立即通知的关键词）的群组时，
+    命中的关键词不同，不会被合并到第一条记录上而漏掉通知
+    """
+    if not DEDUP_ENABLED:
+        return None
+    normalized = normalize_text(text)
+    if photo_id is None and len(normalized) < DEDUP_MIN_TEXT_LENGTH:
+        return None
+    digest = hashlib.blake2b(digest_size=8)
+    digest.update(f"{source}\0".encode('utf-8'))
+    digest.update(normalized.encode('utf-8'))
+    if photo_id is not None:
+        digest.update(f"\0photo:{photo_id}".encode('utf-8'))
+    if keyword_ids:
+        digest.update(f"\0keywords:{','.join(sorted({str(keyword_id) for keyword_id in keyword_ids}))}".encode('utf-8'))
+    return digest.hexdigest()
+
+
+class FingerprintSet:
+    """
+    带过期时间的指纹集合（时间分桶）
+    每个桶覆盖 TTL/桶数 秒，新桶打开时最旧的桶整体丢弃；
+    条数超过上限时提前丢弃最旧的桶。
+    """
+    def __init__(self, ttl=DEDUP_TTL, buckets=DEDUP_BUCKETS, max_entries=DEDUP_MAX_ENTRIES):
+        self.ttl = ttl
+        self.bucket_count = max(1, buckets)
+        self.bucket_span = ttl / self.bucket_count
+        self.max_entries = max_entries
+        self._buckets = deque([set()])
+        self._bucket_started = time.monotonic()
+        self._size = 0
+        self._lock = threading.Lock()
+
+        # 统计信息
+        self.checked = 0
+        self.duplicates = 0
+        self.evicted = 0
+
+    def _rotate(self, now):
+        while now - self._bucket_started >= self.bucket_span:
+            self._bucket_started += self.bucket_span
+            self._buckets.append(set())
+            if len(self._buckets) > self.bucket_count:
+                self._size -= len(self._buckets.popleft())
+            if now - self._bucket_started >= self.ttl:
+                # 长时间没有消息: 全部过期
+                self._buckets = deque([set()])
+                self._bucket_started = now
+                self._size = 0
+                return
+
+    def seen(self, fingerprint):
+        """检查指纹是否在窗口期内出现过（不记录）。返回 True 表示重复"""
+        with self._lock:
+            self.checked += 1
+            self._rotate(time.monotonic())
+            for bucket in self._buckets:
+                if fingerprint in bucket:
+                    self.duplicates += 1
+                    return True
+            return False
+
+    def add(self, fingerprint):
+        """记录指纹（调用方先用 seen() 检查过，且消息已成功提交保存）"""
+        with self._lock:
+            self._rotate(time.monotonic())
+            # 超过上限: 提前丢弃最旧的桶
+            while self._size and self._size >= self.max_entries:
+                dropped = self._buckets.popleft()
+                self._size -= len(dropped)
+                self.evicted += len(dropped)
+                if not self._buckets:
+                    self._buckets.append(set())
+
+            self._buckets[-1].add(fingerprint)
+            self._size += 1
+
+    def __len__(self):
+        return self._size
+
+    def get_stats(self):
+        return {
+            'enabled': DEDUP_ENABLED,
+            'ttl': self.ttl,
+            'size': self._size,
+            'max_entries': self.max_entries,
+            'checked': self.checked,
+            'duplicates': self.duplicates,
+            'evicted_early': self.evicted,
+        }
+
+
+duplicate_filter = FingerprintSet()
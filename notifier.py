@@ -0,0 +1,630 @@
+"""
+通知发送管道（钉钉 / 企业微信）
+消息处理线程只把通知放进队列立即返回，由后台发送线程负责:
+    - 复用 HTTP 长连接（requests.Session 连接池）
+    - 按 webhook 令牌桶限速（钉钉/企业微信机器人均为每分钟20条）
+    - 失败后指数退避重试，最终仍无法送达的通知保存到数据库，由补发线程定期重新提交
+"""
+import base64
+import hashlib
+import heapq
+import hmac
+import itertools
+import os
+import queue
+import threading
+import time
+import urllib.parse
+from collections import Counter, namedtuple
+from datetime import datetime, timedelta
+from urllib.parse import urlparse
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from database import FailedNotification, config_cache, get_session
+
+NOTIFY_WORKERS = int(os.environ.get('NOTIFY_WORKERS', 4))           # 并发发送线程数
+NOTIFY_QUEUE_SIZE = int(os.environ.get('NOTIFY_QUEUE_SIZE', 5000))
+NOTIFY_TIMEOUT = float(os.environ.get('NOTIFY_TIMEOUT', 5))          # 单次请求超时（秒）
+NOTIFY_MAX_ATTEMPTS = int(os.environ.get('NOTIFY_MAX_ATTEMPTS', 5))
+NOTIFY_RATE_PER_MINUTE = int(os.environ.get('NOTIFY_RATE_PER_MINUTE', 20))  # 每个机器人每分钟最多发送条数
+NOTIFY_MAX_DELAYED = int(os.environ.get('NOTIFY_MAX_DELAYED', 2000))          # 延迟队列（限流/重试中）上限，超出的保存到数据库
+NOTIFY_REPLAY_INTERVAL = float(os.environ.get('NOTIFY_REPLAY_INTERVAL', 300))  # 补发未送达通知的间隔（秒），0 表示不补发
+NOTIFY_REPLAY_BATCH = int(os.environ.get('NOTIFY_REPLAY_BATCH', 100))         # 每轮最多补发条数
+NOTIFY_REPLAY_MAX_AGE = float(os.environ.get('NOTIFY_REPLAY_MAX_AGE', 24))    # 超过该时长（小时）的未送达通知不再补发
+
+# 摘要模式: 时间窗口内的命中合并成一条摘要通知（窗口为0则逐条发送）
+ALERT_DIGEST_WINDOW = float(os.environ.get('ALERT_DIGEST_WINDOW', 60))   # 秒
+ALERT_DIGEST_BY = os.environ.get('ALERT_DIGEST_BY', 'keyword')            # keyword / group / keyword_group
+ALERT_DIGEST_SAMPLES = int(os.environ.get('ALERT_DIGEST_SAMPLES', 3))     # 摘要中展示的示例消息条数
+
+# 共享 HTTP 会话: 保持长连接，避免每条通知都重新握手
+http_session = requests.Session()
+http_session.mount('https://', HTTPAdapter(pool_connections=4, pool_maxsize=NOTIFY_WORKERS))
+http_session.mount('http://', HTTPAdapter(pool_connections=4, pool_maxsize=NOTIFY_WORKERS))
+
+# 发送结果: retryable 表示网络错误/限流等可重试的失败
+DeliveryResult = namedtuple('DeliveryResult', ['ok', 'retryable', 'detail'])
+
+# 机器人限流错误码（钉钉: 130101 发送太快; 企业微信: 45009 接口调用超过限制）
+RATE_LIMIT_ERRCODES = {130101, 45009}
+
+
+def is_safe_url(url):
+    try:
+        parsed_url = urlparse(url)
+        if parsed_url.scheme not in ['http', 'https']:
+            return False
+        # 限制为钉钉的官方域名
+        allowed_domains = ['oapi.dingtalk.com']
+        if parsed_url.netloc not in allowed_domains:
+            return False
+        return True
+    except Exception:
+        return False
+
+
+def post_webhook(url, data):
+    """向机器人 webhook 发送 JSON，并把结果归类为成功 / 可重试失败 / 不可重试失败"""
+    headers = {'Content-Type': 'application/json;charset=utf-8'}
+    try:
+        response = http_session.post(url, headers=headers, json=data, timeout=NOTIFY_TIMEOUT)
+    except requests.RequestException as e:
+        return DeliveryResult(False, True, f"发生异常: {e}")
+
+    if response.status_code != 200:
+        retryable = response.status_code == 429 or response.status_code >= 500
+        return DeliveryResult(False, retryable, f"HTTP状态码: {response.status_code}")
+    try:
+        result = response.json()
+    except ValueError:
+        return DeliveryResult(False, True, f"响应格式错误: {response.text[:200]}")
+    if result.get("errcode") == 0:
+        return DeliveryResult(True, False, "ok")
+    return DeliveryResult(
+        False, result.get("errcode") in RATE_LIMIT_ERRCODES,
+        f"{result.get('errcode')}: {result.get('errmsg', '未知错误')}"
+    )
+
+
+def deliver_dingtalk(webhook_url, secret, title, message):
+    if not webhook_url:
+        return DeliveryResult(False, False, "钉钉Webhook未配置。")
+    if not is_safe_url(webhook_url):
+        return DeliveryResult(False, False, f"检测到不安全的Webhook URL: {webhook_url}")
+
+    if secret:
+        timestamp = str(round(time.time() * 1000))
+        secret_enc = secret.encode('utf-8')
+        string_to_sign = '{}\n{}'.format(timestamp, secret)
+        string_to_sign_enc = string_to_sign.encode('utf-8')
+        hmac_code = hmac.new(secret_enc, string_to_sign_enc, digestmod=hashlib.sha256).digest()
+        sign = urllib.parse.quote_plus(base64.b64encode(hmac_code))
+        webhook_url = f"{webhook_url}&timestamp={timestamp}&sign={sign}"
+
+    data = {
+        "msgtype": "markdown",
+        "markdown": {
+            "title": title,
+            "text": message
+        }
+    }
+    return post_webhook(webhook_url, data)
+
+
+def deliver_wecom(webhook_url, title, message):
+    if not webhook_url:
+        return DeliveryResult(False, False, "企业微信Webhook未配置。")
+
+    # 安全检查：验证URL格式
+    try:
+        parsed_url = urlparse(webhook_url)
+        if parsed_url.scheme not in ['http', 'https']:
+            return DeliveryResult(False, False, "企业微信Webhook URL协议不正确（必须是http/https）")
+        # 限制为企业微信的官方域名
+        allowed_domains = ['qyapi.weixin.qq.com']
+        if parsed_url.netloc not in allowed_domains:
+            return DeliveryResult(False, False, f"检测到不安全的Webhook URL: {webhook_url}")
+    except Exception as e:
+        return DeliveryResult(False, False, f"Webhook URL格式错误: {e}")
+
+    # 构造企业微信markdown消息格式
+    data = {
+        "msgtype": "markdown",
+        "markdown": {
+            "content": f"### {title}\n{message}"
+        }
+    }
+    return post_webhook(webhook_url, data)
+
+
+def send_to_dingtalk(webhook_url, secret, title, message, is_test=False):
+    """同步发送钉钉通知（配置页测试按钮使用）"""
+    result = deliver_dingtalk(webhook_url, secret, title, message)
+    if result.ok:
+        print("成功发送钉钉通知。")
+        if is_test: return "测试消息发送成功！"
+    else:
+        print(f"发送钉钉通知失败: {result.detail}")
+        if is_test: return f"发送失败: {result.detail}"
+
+
+def send_to_wecom(webhook_url, title, message, is_test=False):
+    """
+    同步发送消息到企业微信机器人（配置页测试按钮使用）
+
+    参数:
+        webhook_url: 企业微信机器人webhook地址
+        title: 消息标题
+        message: 消息内容（markdown格式）
+        is_test: 是否为测试消息
+
+    返回:
+        如果is_test=True，返回发送结果信息字符串
+    """
+    result = deliver_wecom(webhook_url, title, message)
+    if result.ok:
+        print("成功发送企业微信通知。")
+        if is_test:
+            return "测试消息发送成功！"
+    else:
+        print(f"发送企业微信通知失败: {result.detail}")
+        if is_test:
+            return f"发送失败: {result.detail}"
+
+
+class TokenBucket:
+    """令牌桶限速: 每 60/rate 秒补充一个令牌，最多攒 capacity 个"""
+    def __init__(self, rate_per_minute, capacity=None):
+        self.rate = rate_per_minute / 60.0
+        self.capacity = capacity or rate_per_minute
+        self.tokens = float(self.capacity)
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def try_acquire(self):
+        """取一个令牌；成功返回0，否则返回还需等待的秒数"""
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            if self.tokens >= 1:
+                self.tokens -= 1
+                return 0
+            return (1 - self.tokens) / self.rate
+
+
+class NotificationJob:
+    __slots__ = ('channel', 'webhook_url', 'secret', 'title', 'message', 'attempts', 'created_at')
+
+    def __init__(self, channel, webhook_url, secret, title, message):
+        self.channel = channel
+        self.webhook_url = webhook_url
+        self.secret = secret
+        self.title = title
+        self.message = message
+        self.attempts = 0
+        self.created_at = datetime.now()
+
+
+def notification_target(config):
+    """配置的通知方式 -> (通道, webhook, 签名密钥)，未配置时返回 None"""
+    if not config:
+        return None
+    if config.notification_type == 'dingtalk' and config.dingtalk_webhook:
+        return 'dingtalk', config.dingtalk_webhook, config.dingtalk_secret
+    if config.notification_type == 'wecom' and config.wecom_webhook:
+        return 'wecom', config.wecom_webhook, None
+    return None
+
+
+class NotificationDispatcher:
+    """
+    后台通知发送器
+    限流或重试中的通知放入延迟队列，由调度线程到期后再放回发送队列，
+    不会占用发送线程，也不会阻塞其他机器人的通知。
+    延迟队列有上限，超出的通知和最终发送失败的通知一起保存到数据库，
+    补发线程在启动时和之后每隔 NOTIFY_REPLAY_INTERVAL 秒把它们重新放回发送队列。
+    """
+    def __init__(self, workers=NOTIFY_WORKERS, max_queue=NOTIFY_QUEUE_SIZE,
+                 max_attempts=NOTIFY_MAX_ATTEMPTS, rate_per_minute=NOTIFY_RATE_PER_MINUTE,
+                 max_delayed=NOTIFY_MAX_DELAYED, replay_interval=NOTIFY_REPLAY_INTERVAL):
+        self.workers = workers
+        self.max_attempts = max_attempts
+        self.rate_per_minute = rate_per_minute
+        self.max_delayed = max_delayed
+        self.replay_interval = replay_interval
+        self.queue = queue.Queue(maxsize=max_queue)
+        self.senders = {
+            'dingtalk': lambda job: deliver_dingtalk(job.webhook_url, job.secret, job.title, job.message),
+            'wecom': lambda job: deliver_wecom(job.webhook_url, job.title, job.message),
+        }
+        self._buckets = {}
+        self._buckets_lock = threading.Lock()
+        self._delayed = []  # 堆: (到期时间, 序号, job)
+        self._delayed_cond = threading.Condition()
+        self._seq = itertools.count()
+        self._threads = []
+        self._start_lock = threading.Lock()
+
+        # 统计信息
+        self.sent = 0
+        self.retried = 0
+        self.rate_limited = 0
+        self.persisted = 0
+        self.delayed_overflow = 0
+        self.replayed = 0
+        self.last_latency = None
+
+    def register_sender(self, channel, sender):
+        """注册自定义通道: sender(job) -> DeliveryResult"""
+        self.senders[channel] = sender
+
+    def start(self):
+        with self._start_lock:
+            if any(t.is_alive() for t in self._threads):
+                return
+            self._threads = [
+                threading.Thread(target=self._worker, name=f"Notify-{i}", daemon=True)
+                for i in range(self.workers)
+            ]
+            self._threads.append(threading.Thread(target=self._scheduler, name="NotifyScheduler", daemon=True))
+            if self.replay_interval > 0:
+                self._threads.append(threading.Thread(target=self._replayer, name="NotifyReplay", daemon=True))
+            for thread in self._threads:
+                thread.start()
+
+    def submit(self, channel, webhook_url, secret, title, message):
+        """提交一条通知（不阻塞）；队列满时直接保存为未送达通知"""
+        self.start()
+        job = NotificationJob(channel, webhook_url, secret, title, message)
+        try:
+            self.queue.put_nowait(job)
+            return True
+        except queue.Full:
+            self._persist(job, "发送队列已满")
+            return False
+
+    def notify(self, config, title, message):
+        """根据配置的通知方式提交通知"""
+        target = notification_target(config)
+        if target is None:
+            return False
+        return self.submit(*target, title, message)
+
+    def replay_failed(self, config, limit=NOTIFY_REPLAY_BATCH, max_age_hours=NOTIFY_REPLAY_MAX_AGE):
+        """
+        把数据库中保存的未送达通知重新放回发送队列，返回补发条数
+        只补发当前配置的机器人的通知（数据库中不保存签名密钥，使用当前配置的密钥）；
+        按发送队列和延迟队列的剩余空间取数，避免补发本身又把队列塞满。
+        保留原来的创建时间，超过 max_age_hours 的通知不再补发，只留在表中备查。
+        """
+        target = notification_target(config)
+        if target is None:
+            return 0
+        channel, webhook_url, secret = target
+        with self._delayed_cond:
+            delayed = len(self._delayed)
+        room = min(limit, self.queue.maxsize - self.queue.qsize(), self.max_delayed - delayed)
+        if room <= 0:
+            return 0
+
+        jobs = []
+        session = get_session()
+        try:
+            rows = session.query(FailedNotification).filter(
+                FailedNotification.channel == channel,
+                FailedNotification.webhook_url == webhook_url,
+                FailedNotification.created_at >= datetime.now() - timedelta(hours=max_age_hours),
+            ).order_by(FailedNotification.id).limit(room).all()
+            for row in rows:
+                job = NotificationJob(channel, webhook_url, secret, row.title, row.message)
+                job.created_at = row.created_at
+                jobs.append(job)
+                session.delete(row)
+            session.commit()
+        except Exception as e:
+            session.rollback()
+            print(f"[通知] 读取未送达通知失败: {e}")
+            return 0
+        finally:
+            session.close()
+
+        for job in jobs:
+            try:
+                self.queue.put_nowait(job)
+            except queue.Full:
+                self._persist(job, "发送队列已满")
+        if jobs:
+            self.replayed += len(jobs)
+            print(f"[通知] 已重新提交 {len(jobs)} 条未送达通知")
+        return len(jobs)
+
+    def _bucket(self, job):
+        key = (job.channel, job.webhook_url)
+        with self._buckets_lock:
+            bucket = self._buckets.get(key)
+            if bucket is None:
+                bucket = self._buckets[key] = TokenBucket(self.rate_per_minute)
+            return bucket
+
+    def _schedule(self, job, delay):
+        """放入延迟队列；队列已满时保存到数据库，等补发线程重新提交"""
+        with self._delayed_cond:
+            if len(self._delayed) < self.max_delayed:
+                heapq.heappush(self._delayed, (time.monotonic() + delay, next(self._seq), job))
+                self._delayed_cond.notify()
+                return
+        self.delayed_overflow += 1
+        self._persist(job, "延迟队列已满")
+
+    def _scheduler(self):
+        while True:
+            with self._delayed_cond:
+                while not self._delayed:
+                    self._delayed_cond.wait()
+                due, _, job = self._delayed[0]
+                wait = due - time.monotonic()
+                if wait > 0:
+                    self._delayed_cond.wait(timeout=wait)
+                    continue
+                heapq.heappop(self._delayed)
+            # 放回发送队列（此时队列满则阻塞调度线程，等待发送线程消化）
+            self.queue.put(job)
+
+    def _replayer(self):
+        """启动时补发一次，之后定期补发"""
+        while True:
+            try:
+                self.replay_failed(config_cache.get())
+            except Exception as e:
+                print(f"[通知] 补发未送达通知失败: {e}")
+            time.sleep(self.replay_interval)
+
+    def _worker(self):
+        while True:
+            job = self.queue.get()
+            wait = self._bucket(job).try_acquire()
+            if wait > 0:
+                self.rate_limited += 1
+                self._schedule(job, wait)
+                continue
+
+            sender = self.senders.get(job.channel)
+            if sender is None:
+                self._persist(job, f"未知的通知通道: {job.channel}")
+                continue
+
+            job.attempts += 1
+            started = time.perf_counter()
+            try:
+                result = sender(job)
+            except Exception as e:
+                result = DeliveryResult(False, True, f"发生异常: {e}")
+            self.last_latency = time.perf_counter() - started
+
+            if result.ok:
+                self.sent += 1
+            elif result.retryable and job.attempts < self.max_attempts:
+                self.retried += 1
+                delay = min(2 ** job.attempts, 60)
+                print(f"[通知] {job.channel} 发送失败({result.detail})，{delay}秒后重试 ({job.attempts}/{self.max_attempts})")
+                self._schedule(job, delay)
+            else:
+                print(f"[通知] {job.channel} 发送失败，已保存为未送达通知: {result.detail}")
+                self._persist(job, result.detail)
+
+    def _persist(self, job, error):
+        """保存无法送达的通知（不保存签名密钥）"""
+        self.persisted += 1
+        session = get_session()
+        try:
+            session.add(FailedNotification(
+                channel=job.channel,
+                webhook_url=job.webhook_url,
+                title=job.title[:255],
+                message=job.message,
+                error=str(error)[:500],
+                attempts=job.attempts,
+                created_at=job.created_at
+            ))
+            session.commit()
+        except Exception as e:
+            session.rollback()
+            print(f"[通知] 保存未送达通知失败: {e}")
+        finally:
+            session.close()
+
+    def get_stats(self):
+        with self._delayed_cond:
+            delayed = len(self._delayed)
+        return {
+            'queue_depth': self.queue.qsize(),
+            'delayed': delayed,
+            'sent': self.sent,
+            'retried': self.retried,
+            'rate_limited': self.rate_limited,
+            'persisted': self.persisted,
+            'delayed_overflow': self.delayed_overflow,
+            'replayed': self.replayed,
+            'last_latency': self.last_latency,
+        }
+
+
+notification_dispatcher = NotificationDispatcher()
+
+
+# 一次关键词命中的通知内容
+# keyword 为展示用的命中关键词（全匹配模式下是逗号连接的全部关键词），keywords 为去重后的单个关键词，用于按关键词合并
+Alert = namedtuple('Alert', ['keyword', 'group_name', 'sender', 'content', 'is_image', 'immediate', 'keywords'],
+                   defaults=((),))
+
+
+def alert_keywords(alert):
+    return alert.keywords or (alert.keyword,)
+
+
+def format_alert(alert):
+    """单条命中的通知标题和正文（与原来逐条发送的格式一致）"""
+    title = f"关键词 '{alert.keyword}' 触发"
+    header = "关键词监控提醒（图片识别）" if alert.is_image else "关键词监控提醒"
+    message = (
+        f"#### **{header}**\n\n"
+        f"> **群组**: {alert.group_name}\n\n"
+        f"> **发送人**: {alert.sender or 'N/A'}\n\n"
+        f"> **关键词**: {alert.keyword}\n\n"
+        f"> **消息内容**: {alert.content}\n"
+    )
+    return title, message
+
+
+class DigestBucket:
+    """一个摘要窗口内（首条之后）的统计，只保留计数和前N条示例，内存有界"""
+    __slots__ = ('key', 'config', 'count', 'groups', 'keywords', 'samples', 'opened_at')
+
+    def __init__(self, key, config, alert):
+        self.key = key
+        self.config = config
+        self.count = 0
+        self.groups = Counter()
+        self.keywords = Counter()
+        self.samples = []
+        self.opened_at = time.monotonic()
+
+    def add(self, config, alert, max_samples):
+        self.config = config
+        self.count += 1
+        self.groups[alert.group_name] += 1
+        self.keywords.update(alert_keywords(alert))
+        if len(self.samples) < max_samples:
+            self.samples.append(alert)
+
+
+class AlertDigester:
+    """
+    告警合并: 同一关键词（或群组）的第一次命中立即发送，之后窗口期内的命中合并为一条摘要，
+    避免转发潮时几百条通知把机器人限流额度耗尽。设置为立即通知的关键词不参与合并。
+    """
+    def __init__(self, dispatcher, window=ALERT_DIGEST_WINDOW, group_by=ALERT_DIGEST_BY,
+                 max_samples=ALERT_DIGEST_SAMPLES):
+        self.dispatcher = dispatcher
+        self.window = window
+        self.group_by = group_by
+        self.max_samples = max_samples
+        self._buckets = {}
+        self._lock = threading.Lock()
+        self._thread = None
+
+        # 统计信息
+        self.immediate = 0
+        self.digested = 0
+        self.summaries = 0
+
+    def _keys(self, alert):
+        """一次命中所属的摘要窗口: 按关键词合并时，命中的每个关键词各一个"""
+        if self.group_by == 'group':
+            return [('group', alert.group_name)]
+        if self.group_by == 'keyword_group':
+            return [('keyword_group', keyword, alert.group_name) for keyword in alert_keywords(alert)]
+        return [('keyword', keyword) for keyword in alert_keywords(alert)]
+
+    def add(self, config, alert):
+        """提交一次命中；立即通知的关键词或未开启摘要时直接发送"""
+        if not config:
+            return
+        if alert.immediate or self.window <= 0:
+            self.immediate += 1
+            title, message = format_alert(alert)
+            self.dispatcher.notify(config, title, message)
+            return
+
+        self._ensure_flusher()
+        with self._lock:
+            keys = self._keys(alert)
+            new_keys = [key for key in keys if key not in self._buckets]
+            if not new_keys:
+                # 命中的关键词都已在窗口内通知过: 计入各自的摘要
+                for key in keys:
+                    self._buckets[key].add(config, alert, self.max_samples)
+                self.digested += 1
+                return
+            # 有关键词是窗口内的第一次命中: 立即发送，并为这些关键词开启窗口
+            for key in new_keys:
+                self._buckets[key] = DigestBucket(key, config, alert)
+        self.immediate += 1
+        title, message = format_alert(alert)
+        self.dispatcher.notify(config, title, message)
+
+    def _ensure_flusher(self):
+        if self._thread is None or not self._thread.is_alive():
+            with self._lock:
+                if self._thread is None or not self._thread.is_alive():
+                    self._thread = threading.Thread(target=self._flusher, name="AlertDigest", daemon=True)
+                    self._thread.start()
+
+    def _flusher(self):
+        while True:
+            time.sleep(min(1.0, self.window / 4))
+            self.flush()
+
+    def flush(self, force=False):
+        """发送所有已到期（force=True 时为全部）的摘要"""
+        now = time.monotonic()
+        with self._lock:
+            due = [key for key, bucket in self._buckets.items()
+                   if force or now - bucket.opened_at >= self.window]
+            buckets = [self._buckets.pop(key) for key in due]
+
+        for bucket in buckets:
+            if bucket.count == 0:
+                continue
+            if bucket.count == 1:
+                title, message = format_alert(bucket.samples[0])
+            else:
+                title, message = self.format_digest(bucket)
+                self.summaries += 1
+            self.dispatcher.notify(bucket.config, title, message)
+
+    def format_digest(self, bucket):
+        """摘要通知: 命中次数、群组/关键词分布和前N条示例"""
+        if self.group_by == 'group':
+            subject = f"群组 '{bucket.key[1]}'"
+        elif self.group_by == 'keyword_group':
+            subject = f"关键词 '{bucket.key[1]}' @ {bucket.key[2]}"
+        else:
+            subject = f"关键词 '{bucket.key[1]}'"
+
+        title = f"{subject} {self.window:g}秒内又触发 {bucket.count} 次"
+        lines = [
+            f"#### **关键词监控摘要**\n\n",
+            f"> **对象**: {subject}\n\n",
+            f"> **命中次数**: {bucket.count}（{len(bucket.groups)} 个群组, {len(bucket.keywords)} 个关键词）\n\n",
+            f"> **群组分布**: " + ", ".join(
+                f"{name}({count})" for name, count in bucket.groups.most_common(self.max_samples)
+            ) + "\n\n",
+        ]
+        if self.group_by == 'group':
+            lines.append("> **关键词分布**: " + ", ".join(
+                f"{kw}({count})" for kw, count in bucket.keywords.most_common(self.max_samples)
+            ) + "\n\n")
+        lines.append(f"**示例消息（前{len(bucket.samples)}条）**\n\n")
+        for i, sample in enumerate(bucket.samples, start=1):
+            content = sample.content if len(sample.content) <= 200 else sample.content[:200] + '...'
+            lines.append(f"{i}. [{sample.group_name}] {sample.sender or 'N/A'}: {content}\n\n")
+        return title, ''.join(lines)
+
+    def get_stats(self):
+        with self._lock:
+            pending = len(self._buckets)
+        return {
+            'window': self.window,
+            'group_by': self.group_by,
+            'pending_digests': pending,
+            'immediate': self.immediate,
+            'digested': self.digested,
+            'summaries': self.summaries,
+        }
+
+
+alert_digester = AlertDigester(notification_dispatcher)
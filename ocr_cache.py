@@ -0,0 +1,250 @@
+"""
+OCR 结果缓存
+同一张表情包、二维码广告、截图会在各个群里被反复转发。识别结果按两种键缓存:
+    - Telegram photo id: 转发的图片共用同一个文件ID，命中时连下载都不需要
+    - 图片感知哈希（dHash）: 重新上传/压缩过的同一张图片哈希相同（可选允许相差几位）
+命中后直接拿缓存的文字去匹配关键词，跳过 Tesseract。
+内存中按 LRU 淘汰，可选 SQLite 磁盘层（重启后仍可命中）。
+"""
+import io
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+
+from database import instance_path
+
+OCR_CACHE_SIZE = int(os.environ.get('OCR_CACHE_SIZE', 20000))            # 内存中缓存的图片数
+# dHash 汉明距离不超过此值视为同一张图片。截图类图片改一行字距离只有几位，
+# 设为大于0会把内容不同的截图当成同一张，默认只接受哈希完全相同
+OCR_CACHE_MAX_DISTANCE = int(os.environ.get('OCR_CACHE_MAX_DISTANCE', 0))
+OCR_CACHE_DISK = os.environ.get('OCR_CACHE_DISK', '1') not in ('0', 'false', 'False')
+OCR_CACHE_DISK_PATH = os.path.join(instance_path, 'ocr_cache.sqlite')
+OCR_CACHE_DISK_MAX_AGE = 30 * 24 * 3600  # 磁盘层保留30天
+
+# 16x16 的 dHash（256位）: 8x8 的哈希会把版式相同的不同截图算成同一张
+HASH_SIZE = 16
+HASH_BITS = HASH_SIZE * HASH_SIZE
+
+
+def image_dhash(image_or_data, hash_size=HASH_SIZE):
+    """
+    计算图片的 dHash（hash_size² 位整数）
+    灰度缩放到 (hash_size+1) x hash_size 后比较相邻像素亮度，对缩放、重新压缩、轻微调色不敏感
+    参数可以是 PIL.Image、图片文件路径或图片字节
+    """
+    from PIL import Image
+    if isinstance(image_or_data, (bytes, bytearray)):
+        image = Image.open(io.BytesIO(image_or_data))
+    elif isinstance(image_or_data, str):
+        image = Image.open(image_or_data)
+    else:
+        image = image_or_data
+    # draft 让 JPEG 解码时直接按缩小的尺寸解码，大图也很快
+    image.draft('L', (hash_size * 8, hash_size * 8))
+    pixels = list(image.convert('L').resize((hash_size + 1, hash_size), Image.BILINEAR).getdata())
+
+    value = 0
+    for row in range(hash_size):
+        offset = row * (hash_size + 1)
+        for col in range(hash_size):
+            value = (value << 1) | (pixels[offset + col] > pixels[offset + col + 1])
+    return value
+
+
+def split_bands(dhash, bands):
+    """
+    把哈希切成 bands 段，用于近似查找:
+    汉明距离不超过 bands-1 的两个哈希至少有一段完全相同（抽屉原理）
+    """
+    band_bits = HASH_BITS // bands
+    mask = (1 << band_bits) - 1
+    return [(index, (dhash >> (index * band_bits)) & mask) for index in range(bands)]
+
+
+class OcrResultCache:
+    def __init__(self, max_entries=OCR_CACHE_SIZE, max_distance=OCR_CACHE_MAX_DISTANCE,
+                 disk_path=OCR_CACHE_DISK_PATH if OCR_CACHE_DISK else None):
+        self.max_entries = max_entries
+        self.max_distance = max(0, max_distance)
+        self.bands = self.max_distance + 1
+        self._by_hash = OrderedDict()   # {dhash: 识别文字}（LRU）
+        self._by_photo = OrderedDict()  # {photo_id: dhash}
+        self._bands = {}                # {(段号, 段值): {dhash, ...}} 近似查找索引
+        self._lock = threading.Lock()
+
+        self.disk_path = disk_path
+        self._disk = None
+        self._disk_lock = threading.Lock()
+
+        # 统计信息
+        self.photo_hits = 0
+        self.hash_hits = 0
+        self.near_hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+
+    # --- 内存层 ---
+
+    def _touch(self, dhash):
+        text = self._by_hash.get(dhash)
+        if text is not None:
+            self._by_hash.move_to_end(dhash)
+        return text
+
+    def _store(self, dhash, text, photo_id=None):
+        if self.max_distance and dhash not in self._by_hash:
+            for band in split_bands(dhash, self.bands):
+                self._bands.setdefault(band, set()).add(dhash)
+        self._by_hash[dhash] = text
+        self._by_hash.move_to_end(dhash)
+        if photo_id is not None:
+            self._by_photo[photo_id] = dhash
+            self._by_photo.move_to_end(photo_id)
+
+        while len(self._by_hash) > self.max_entries:
+            old_hash, _ = self._by_hash.popitem(last=False)
+            if self.max_distance:
+                self._unindex(old_hash)
+        while len(self._by_photo) > self.max_entries:
+            self._by_photo.popitem(last=False)
+
+    def _unindex(self, dhash):
+        for band in split_bands(dhash, self.bands):
+            members = self._bands.get(band)
+            if members is not None:
+                members.discard(dhash)
+                if not members:
+                    del self._bands[band]
+
+    def _nearest(self, dhash):
+        """查找汉明距离最近且不超过阈值的已缓存哈希"""
+        best, best_distance = None, self.max_distance + 1
+        for band in split_bands(dhash, self.bands):
+            for candidate in self._bands.get(band, ()):
+                distance = bin(candidate ^ dhash).count('1')
+                if distance < best_distance:
+                    best, best_distance = candidate, distance
+        return best
+
+    # --- 查询 ---
+
+    def get_by_photo(self, photo_id):
+        """按 photo id 查询（下载前调用），未命中返回 None"""
+        with self._lock:
+            dhash = self._by_photo.get(photo_id)
+            if dhash is not None:
+                text = self._touch(dhash)
+                if text is not None:
+                    self._by_photo.move_to_end(photo_id)
+                    self.photo_hits += 1
+                    return text
+
+        row = self._disk_get(f"photo:{photo_id}")
+        if row is not None:
+            dhash, text = row
+            with self._lock:
+                self._store(dhash, text, photo_id)
+                self.disk_hits += 1
+            return text
+        return None
+
+    def get_by_hash(self, dhash, photo_id=None):
+        """按图片哈希查询（下载后、识别前调用）；命中时记录 photo id 方便下次直接命中"""
+        with self._lock:
+            text = self._touch(dhash)
+            if text is None and self.max_distance:
+                nearest = self._nearest(dhash)
+                if nearest is not None:
+                    text = self._touch(nearest)
+                    if text is not None:
+                        self.near_hits += 1
+            if text is not None:
+                self.hash_hits += 1
+                self._store(dhash, text, photo_id)
+                return text
+
+        row = self._disk_get(f"dhash:{dhash:064x}")
+        if row is not None:
+            text = row[1]
+            with self._lock:
+                self._store(dhash, text, photo_id)
+                self.disk_hits += 1
+            self._disk_put(photo_id, dhash, text)
+            return text
+
+        with self._lock:
+            self.misses += 1
+        return None
+
+    def put(self, photo_id, dhash, text):
+        """保存识别结果"""
+        if text is None:
+            return
+        with self._lock:
+            self._store(dhash, text, photo_id)
+        self._disk_put(photo_id, dhash, text)
+
+    # --- 磁盘层 ---
+
+    def _connection(self):
+        if self._disk is None:
+            os.makedirs(os.path.dirname(self.disk_path), exist_ok=True)
+            connection = sqlite3.connect(self.disk_path, check_same_thread=False)
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.execute(
+                "CREATE TABLE IF NOT EXISTS ocr_cache ("
+                "key TEXT PRIMARY KEY, dhash TEXT NOT NULL, text TEXT NOT NULL, updated_at REAL NOT NULL)"
+            )
+            connection.execute("DELETE FROM ocr_cache WHERE updated_at < ?",
+                               (time.time() - OCR_CACHE_DISK_MAX_AGE,))
+            connection.commit()
+            self._disk = connection
+        return self._disk
+
+    def _disk_get(self, key):
+        if not self.disk_path:
+            return None
+        try:
+            with self._disk_lock:
+                row = self._connection().execute(
+                    "SELECT dhash, text FROM ocr_cache WHERE key = ?", (key,)
+                ).fetchone()
+        except sqlite3.Error as e:
+            print(f"[OCR缓存] 读取磁盘缓存失败: {e}")
+            return None
+        return (int(row[0], 16), row[1]) if row else None
+
+    def _disk_put(self, photo_id, dhash, text):
+        if not self.disk_path:
+            return
+        now = time.time()
+        rows = [(f"dhash:{dhash:064x}", f"{dhash:064x}", text, now)]
+        if photo_id is not None:
+            rows.append((f"photo:{photo_id}", f"{dhash:064x}", text, now))
+        try:
+            with self._disk_lock:
+                connection = self._connection()
+                connection.executemany("INSERT OR REPLACE INTO ocr_cache VALUES (?, ?, ?, ?)", rows)
+                connection.commit()
+        except sqlite3.Error as e:
+            print(f"[OCR缓存] 写入磁盘缓存失败: {e}")
+
+    def get_stats(self):
+        hits = self.photo_hits + self.hash_hits + self.disk_hits
+        total = hits + self.misses
+        return {
+            'size': len(self._by_hash),
+            'max_entries': self.max_entries,
+            'disk': bool(self.disk_path),
+            'photo_hits': self.photo_hits,
+            'hash_hits': self.hash_hits,
+            'near_hits': self.near_hits,
+            'disk_hits': self.disk_hits,
+            'misses': self.misses,
+            'hit_rate': hits / total if total else None,
+        }
+
+
+ocr_cache = OcrResultCache()
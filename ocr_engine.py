@@ -0,0 +1,414 @@
+"""
+图片文字识别引擎（进程池）
+pytesseract 每识别一张图片都要启动一次 tesseract 进程并重新加载 chi_sim+eng 模型。
+这里改为固定数量的工作进程，每个进程启动时初始化一次 Tesseract（tesserocr 的 PyTessBaseAPI）
+并一直复用；未安装 tesserocr 时退回 pytesseract，同样按核数并行。
+"""
+import heapq
+import io
+import itertools
+import multiprocessing
+import os
+import threading
+import time
+from concurrent.futures import Future, ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+from ocr_preprocess import OCR_PREPROCESS, draft_for_ocr, parse_steps, preprocess_image
+
+
+def _available_cores():
+    try:
+        return len(os.sched_getaffinity(0))
+    except AttributeError:
+        return os.cpu_count() or 1
+
+
+OCR_WORKERS = int(os.environ.get('OCR_WORKERS', 0)) or _available_cores()  # 0 表示按可用核数
+OCR_LANG = os.environ.get('OCR_LANG', 'chi_sim+eng')
+OCR_BACKEND = os.environ.get('OCR_BACKEND', 'auto')  # auto / tesserocr / pytesseract
+OCR_START_METHOD = os.environ.get('OCR_START_METHOD') or None  # 进程启动方式，默认使用平台默认值
+# 运行中重建进程池（识别超时、工作进程异常退出）时的启动方式: 此时父进程已有事件循环、写入线程等多个线程，
+# fork 会把其他线程持有的锁原样复制到子进程中，可能导致子进程死锁，因此默认改用 spawn
+OCR_RESTART_METHOD = os.environ.get('OCR_RESTART_METHOD', 'spawn')
+OCR_QUEUE_SIZE = int(os.environ.get('OCR_QUEUE_SIZE', 200))    # 等待识别的图片数上限
+OCR_MAX_WAIT = float(os.environ.get('OCR_MAX_WAIT', 120))      # 秒，排队超过此时间的图片直接丢弃（0表示不限）
+OCR_JOB_TIMEOUT = float(os.environ.get('OCR_JOB_TIMEOUT', 30))  # 秒，单张图片识别超时（0表示不限）
+# 父进程判定超时前多等待的时间: pytesseract 会在 OCR_JOB_TIMEOUT 时自行结束 tesseract，
+# 只有工作进程本身卡住（如 tesserocr 调用不返回）时才需要父进程结束它
+OCR_TIMEOUT_GRACE = 2
+
+# 以下为工作进程内的全局状态
+_worker_api = None
+_worker_backend = None
+_worker_lang = None
+_worker_preprocess = ()
+
+
+def _init_worker(lang, backend, preprocess=OCR_PREPROCESS):
+    """工作进程初始化: 加载一次 Tesseract 模型，之后每张图片复用"""
+    global _worker_api, _worker_backend, _worker_lang, _worker_preprocess
+    _worker_lang = lang
+    _worker_preprocess = parse_steps(preprocess)
+    if backend in ('auto', 'tesserocr'):
+        try:
+            import tesserocr
+            _worker_api = tesserocr.PyTessBaseAPI(lang=lang)
+            _worker_backend = 'tesserocr'
+            return
+        except Exception as e:
+            if backend == 'tesserocr':
+                print(f"[OCR引擎] tesserocr 初始化失败，退回 pytesseract: {e}")
+    _worker_backend = 'pytesseract'
+
+
+def _worker_info(_index=None):
+    return os.getpid(), _worker_backend
+
+
+def recognize_image(image, timeout=0):
+    """
+    在当前工作进程中识别一张图片（PIL.Image），返回文字
+    timeout 只对 pytesseract 生效（超时会结束 tesseract 进程）；tesserocr 的超时由父进程判定
+    """
+    if _worker_backend is None:
+        _init_worker(OCR_LANG, OCR_BACKEND)
+    if _worker_backend == 'tesserocr':
+        _worker_api.SetImage(image)
+        return _worker_api.GetUTF8Text()
+    import pytesseract
+    return pytesseract.image_to_string(image, lang=_worker_lang, timeout=timeout)
+
+
+def ocr_image(source, timeout=0):
+    """
+    识别一张图片（在工作进程中运行）
+    source: 图片字节（内存下载的图片）或图片文件路径
+    先按 OCR_PREPROCESS 预处理，判定为没有文字的图片直接返回空文本
+    返回: (ocr_text, error)
+    """
+    try:
+        from PIL import Image
+        if _worker_backend is None:
+            _init_worker(OCR_LANG, OCR_BACKEND)
+        with Image.open(io.BytesIO(source) if isinstance(source, bytes) else source) as image:
+            draft_for_ocr(image, _worker_preprocess)
+            image.load()
+            prepared = preprocess_image(image, _worker_preprocess)
+            if prepared is None:
+                return '', None
+            return recognize_image(prepared, timeout), None
+    except ImportError as e:
+        return None, f"未安装OCR依赖: {e}"
+    except Exception as e:
+        return None, str(e)
+
+
+class OcrJob:
+    __slots__ = ('source', 'priority', 'seq', 'future', 'enqueued_at', 'started_at', 'executor')
+
+    def __init__(self, source, priority, seq):
+        self.source = source
+        self.priority = priority
+        self.seq = seq
+        self.future = Future()
+        self.enqueued_at = time.monotonic()
+        self.started_at = None
+        self.executor = None  # 正在识别该任务的进程池（进程池重建后，旧进程池的回调据此忽略）
+
+
+class OcrEngine:
+    """
+    OCR 进程池 + 有界优先级队列
+    submit() 立即返回 concurrent.futures.Future，结果为 (ocr_text, error)。
+    图片先进入父进程中的有界队列，由调度线程按优先级（高优先）取出送进进程池，
+    进程池中同时最多只有 workers 张图片，队列积压不会无限占用内存。
+    队列满时丢弃最旧的低优先级任务；排队太久的任务直接丢弃；识别超时的任务返回超时错误，
+    并结束卡住的工作进程、重建进程池（同一进程池中其他正在识别的图片重新排队）。
+    注意: Future 的回调在调度线程或进程池的管理线程中执行，耗时的后续处理应转交其他线程。
+    """
+    def __init__(self, workers=OCR_WORKERS, lang=OCR_LANG, backend=OCR_BACKEND, start_method=OCR_START_METHOD,
+                 max_queue=OCR_QUEUE_SIZE, max_wait=OCR_MAX_WAIT, job_timeout=OCR_JOB_TIMEOUT,
+                 preprocess=OCR_PREPROCESS, restart_method=OCR_RESTART_METHOD):
+        self.workers = max(1, workers)
+        self.lang = lang
+        self.backend = backend
+        self.preprocess = parse_steps(preprocess)
+        self.start_method = start_method
+        self.restart_method = restart_method
+        self.max_queue = max_queue
+        self.max_wait = max_wait
+        self.job_timeout = job_timeout
+        self._executor = None
+        self._lock = threading.Lock()
+        self.worker_backends = {}
+
+        self._pending = []   # 堆: (-优先级, 序号, OcrJob)
+        self._running = {}   # {序号: OcrJob}
+        self._reserved = 0   # 已预留名额（图片正在下载或计算哈希，尚未提交），计入队列深度
+        self._cond = threading.Condition()
+        self._seq = itertools.count()
+        self._dispatcher = None
+
+        # 统计信息
+        self.submitted = 0
+        self.completed = 0
+        self.failed = 0
+        self.dropped = 0     # 队列满被丢弃
+        self.expired = 0     # 排队超过 max_wait 被丢弃
+        self.timeouts = 0    # 识别超时
+        self._total_latency = 0.0
+        self.max_latency = 0.0
+        self._started_jobs = 0
+        self._total_wait = 0.0
+        self.max_wait_seen = 0.0
+
+    def start(self, start_method=None):
+        """
+        启动进程池并等待所有工作进程完成模型加载
+        以 fork 方式启动时应尽早调用（在启动其他后台线程之前）；
+        运行中重建进程池时传入 restart_method（默认 spawn），不从多线程的父进程 fork
+        """
+        with self._lock:
+            if self._dispatcher is None or not self._dispatcher.is_alive():
+                self._dispatcher = threading.Thread(target=self._dispatch, name="OcrDispatcher", daemon=True)
+                self._dispatcher.start()
+            if self._executor is not None:
+                return
+            context = multiprocessing.get_context(start_method or self.start_method)
+            self._executor = ProcessPoolExecutor(
+                max_workers=self.workers, mp_context=context,
+                initializer=_init_worker, initargs=(self.lang, self.backend, self.preprocess)
+            )
+            started = time.perf_counter()
+            try:
+                for pid, backend in self._executor.map(_worker_info, range(self.workers)):
+                    self.worker_backends[pid] = backend
+            except Exception as e:
+                print(f"[OCR引擎] 工作进程启动失败: {e}")
+                return
+            backends = ', '.join(sorted(set(self.worker_backends.values())))
+            print(f"[OCR引擎] 已启动 {self.workers} 个工作进程（{backends}, 语言 {self.lang}），"
+                  f"耗时 {time.perf_counter() - started:.2f}s")
+
+    def would_accept(self, priority=0):
+        """队列是否还能接收该优先级的任务（已预留的名额也计入队列深度）"""
+        with self._cond:
+            return self._would_accept(priority)
+
+    def _would_accept(self, priority):
+        if len(self._pending) + self._reserved < self.max_queue:
+            return True
+        lowest = self._lowest_pending()
+        return lowest is not None and priority >= lowest.priority
+
+    def reserve(self, priority=0):
+        """
+        下载图片之前预留一个队列名额，返回 False 表示队列已满、应跳过该图片
+        预留后必须调用 submit(..., reserved=True) 或 release() 归还；
+        预留数本身不超过队列上限，下载中和等待提交的图片占用的内存同样有界
+        """
+        with self._cond:
+            if self._reserved >= self.max_queue or not self._would_accept(priority):
+                return False
+            self._reserved += 1
+            return True
+
+    def release(self):
+        """归还 reserve() 预留的名额（图片下载失败或命中缓存，不再提交）"""
+        with self._cond:
+            self._reserved = max(0, self._reserved - 1)
+
+    def submit(self, source, priority=0, reserved=False):
+        """
+        提交一张图片（字节或文件路径），返回 Future；priority 越大越先识别
+        图片字节经进程池管道传给工作进程（照片通常只有一两百KB，复制开销可以忽略）
+        reserved=True 表示使用 reserve() 预留的名额
+        """
+        self.start()
+        job = OcrJob(source, priority, next(self._seq))
+        dropped = None
+        with self._cond:
+            self.submitted += 1
+            if reserved:
+                self._reserved = max(0, self._reserved - 1)
+            if len(self._pending) + self._reserved >= self.max_queue:
+                lowest = self._lowest_pending()
+                if lowest is None or priority < lowest.priority:
+                    dropped = job
+                else:
+                    # 丢弃最旧的低优先级任务，为新任务腾出位置
+                    self._pending = [entry for entry in self._pending if entry[2] is not lowest]
+                    heapq.heapify(self._pending)
+                    dropped = lowest
+                self.dropped += 1
+            if dropped is not job:
+                heapq.heappush(self._pending, (-priority, job.seq, job))
+                self._cond.notify()
+
+        if dropped is not None:
+            dropped.source = None
+            self._resolve(dropped, (None, "OCR队列已满，任务已丢弃"))
+        return job.future
+
+    def _lowest_pending(self):
+        """优先级最低的任务中最旧的一个"""
+        lowest = None
+        for _, _, job in self._pending:
+            if lowest is None or (job.priority, job.seq) < (lowest.priority, lowest.seq):
+                lowest = job
+        return lowest
+
+    def _resolve(self, job, result):
+        if not job.future.done():
+            job.future.set_result(result)
+
+    def _dispatch(self):
+        """调度线程: 进程池有空闲时按优先级取出任务提交"""
+        while True:
+            timed_out = []
+            expired = []
+            job = None
+            with self._cond:
+                while job is None:
+                    now = time.monotonic()
+                    for running in self._running.values():
+                        if self.job_timeout and now - running.started_at > self.job_timeout + OCR_TIMEOUT_GRACE:
+                            timed_out.append(running)
+                    if timed_out:
+                        break
+                    if self._pending and len(self._running) < self.workers:
+                        _, _, candidate = heapq.heappop(self._pending)
+                        wait = now - candidate.enqueued_at
+                        if self.max_wait and wait > self.max_wait:
+                            expired.append(candidate)
+                            continue
+                        candidate.started_at = now
+                        self._running[candidate.seq] = candidate
+                        self._started_jobs += 1
+                        self._total_wait += wait
+                        self.max_wait_seen = max(self.max_wait_seen, wait)
+                        job = candidate
+                    else:
+                        if expired:
+                            break
+                        self._cond.wait(0.5)
+
+            for stale in expired:
+                self.expired += 1
+                stale.source = None
+                self._resolve(stale, (None, f"排队超过 {self.max_wait:g} 秒，任务已丢弃"))
+            if timed_out:
+                for running in timed_out:
+                    self.timeouts += 1
+                    running.source = None
+                    self._resolve(running, (None, f"识别超时（{self.job_timeout:g} 秒）"))
+                self._recycle_pool(timed_out)
+            if job is not None:
+                self._run(job)
+
+    def _recycle_pool(self, stuck_jobs):
+        """
+        识别超时: 结束整个进程池（卡住的工作进程不会自己返回，一直占用名额）并重建
+        同一进程池中其他正在识别的图片重新排队（保留原优先级和序号）
+        """
+        with self._cond:
+            for job in stuck_jobs:
+                self._running.pop(job.seq, None)
+            requeued = list(self._running.values())
+            self._running.clear()
+            for job in requeued:
+                job.executor = None
+                job.started_at = None
+                heapq.heappush(self._pending, (-job.priority, job.seq, job))
+        print(f"[OCR引擎] {len(stuck_jobs)} 张图片识别超时，正在重建进程池"
+              f"（{len(requeued)} 张正在识别的图片重新排队）...")
+        self.shutdown(wait=False, terminate=True)
+        self.start(self.restart_method)
+
+    def _run(self, job):
+        try:
+            try:
+                executor = self._executor
+                inner = executor.submit(ocr_image, job.source, self.job_timeout)
+            except BrokenProcessPool:
+                # 工作进程异常退出（如内存不足被杀）: 重建进程池
+                print("[OCR引擎] 进程池已损坏，正在重建...")
+                self.shutdown(wait=False)
+                self.start(self.restart_method)
+                executor = self._executor
+                inner = executor.submit(ocr_image, job.source, self.job_timeout)
+        except Exception as e:
+            self._finish(job, None, e)
+            return
+        job.executor = executor
+        inner.add_done_callback(lambda f: self._finish(job, f, executor=executor))
+
+    def _finish(self, job, inner, error=None, executor=None):
+        with self._cond:
+            if executor is not None and job.executor is not executor:
+                # 进程池已因超时重建: 该任务已重新排队或已按超时处理
+                return
+            self._running.pop(job.seq, None)
+            self._cond.notify()
+        job.source = None
+        if job.future.done():
+            return
+
+        if inner is not None:
+            try:
+                result = inner.result()
+            except Exception as e:
+                result = (None, str(e))
+        else:
+            result = (None, str(error))
+
+        latency = time.monotonic() - job.started_at
+        if result[1]:
+            self.failed += 1
+        else:
+            self.completed += 1
+        self._total_latency += latency
+        self.max_latency = max(self.max_latency, latency)
+        self._resolve(job, result)
+
+    def shutdown(self, wait=True, terminate=False):
+        """terminate=True 时直接结束工作进程（用于结束卡住的识别）"""
+        with self._lock:
+            if self._executor is not None:
+                processes = list((getattr(self._executor, '_processes', None) or {}).values()) if terminate else []
+                self._executor.shutdown(wait=wait, cancel_futures=not wait)
+                for process in processes:
+                    process.terminate()
+                self._executor = None
+                self.worker_backends = {}
+
+    def get_stats(self):
+        finished = self.completed + self.failed
+        with self._cond:
+            queue_depth = len(self._pending)
+            in_flight = len(self._running)
+            reserved = self._reserved
+        return {
+            'workers': self.workers,
+            'lang': self.lang,
+            'preprocess': list(self.preprocess),
+            'backends': sorted(set(self.worker_backends.values())),
+            'queue_depth': queue_depth,
+            'queue_capacity': self.max_queue,
+            'reserved': reserved,
+            'in_flight': in_flight,
+            'submitted': self.submitted,
+            'completed': self.completed,
+            'failed': self.failed,
+            'dropped': self.dropped,
+            'expired': self.expired,
+            'timeouts': self.timeouts,
+            'avg_wait': self._total_wait / self._started_jobs if self._started_jobs else None,
+            'max_wait': self.max_wait_seen,
+            'avg_latency': self._total_latency / finished if finished else None,
+            'max_latency': self.max_latency,
+        }
+
+
+ocr_engine = OcrEngine()
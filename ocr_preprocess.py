@@ -0,0 +1,162 @@
+"""
+OCR 前的图片预处理（在 OCR 工作进程中执行，只依赖 Pillow）
+Tesseract 的耗时与像素数基本成正比，而群里的大图多数是照片、文字很少。可选步骤（按顺序执行）:
+    - skip_blank: 边缘密度过低（大概率没有文字）的图片直接跳过，不送 Tesseract
+    - grayscale:  转为灰度
+    - downscale:  按目标 DPI 或最长边缩小
+    - crop:       裁剪到文字所在区域（边缘密集的区域）
+    - binarize:   大津法二值化
+通过 OCR_PREPROCESS 配置启用的步骤（逗号分隔，设为 none 关闭预处理）。
+"""
+import os
+
+PREPROCESS_STEPS = ('skip_blank', 'grayscale', 'downscale', 'crop', 'binarize')
+
+OCR_PREPROCESS = os.environ.get('OCR_PREPROCESS', 'skip_blank,grayscale,downscale,binarize')
+OCR_MAX_SIDE = int(os.environ.get('OCR_MAX_SIDE', 1600))      # 缩小后的最长边（像素），0 表示不限
+OCR_TARGET_DPI = int(os.environ.get('OCR_TARGET_DPI', 0))     # 图片带 DPI 信息时缩到此 DPI，0 表示不按 DPI 缩放
+# 边缘像素占比低于此值视为没有文字。大照片上只有一行小字时占比也只有千分之几，阈值不宜设高
+OCR_MIN_EDGE_DENSITY = float(os.environ.get('OCR_MIN_EDGE_DENSITY', 0.002))
+
+# 边缘检测在缩略图上进行，速度与原图大小无关
+EDGE_SAMPLE_SIDE = 320
+EDGE_THRESHOLD = 48
+CROP_PADDING = 0.02  # 裁剪时四周保留的边距（占原图边长的比例）
+
+
+def parse_steps(value=OCR_PREPROCESS):
+    """解析预处理步骤配置，返回按执行顺序排列的步骤元组"""
+    if isinstance(value, str):
+        value = [step.strip() for step in value.split(',')]
+    enabled = set(step for step in value if step and step != 'none')
+    unknown = enabled - set(PREPROCESS_STEPS)
+    if unknown:
+        print(f"[OCR预处理] 忽略未知的预处理步骤: {', '.join(sorted(unknown))}")
+    return tuple(step for step in PREPROCESS_STEPS if step in enabled)
+
+
+def edge_map(image):
+    """在缩略图上计算边缘图（二值，255 为边缘），返回 (边缘图, 缩放比例)"""
+    from PIL import ImageFilter
+    gray = image.convert('L')
+    scale = min(1.0, EDGE_SAMPLE_SIDE / max(gray.size))
+    if scale < 1.0:
+        gray = gray.resize((max(1, round(gray.width * scale)), max(1, round(gray.height * scale))))
+    edges = gray.filter(ImageFilter.FIND_EDGES)
+    return edges.point(lambda value: 255 if value > EDGE_THRESHOLD else 0), scale
+
+
+def edge_density(edges):
+    """边缘像素占比（FIND_EDGES 的最外一圈像素不可靠，不计入）"""
+    width, height = edges.size
+    if width <= 2 or height <= 2:
+        return 0.0
+    inner = edges.crop((1, 1, width - 1, height - 1))
+    return inner.histogram()[255] / (inner.width * inner.height)
+
+
+def text_region(edges, scale, size):
+    """按边缘图估算文字区域，返回原图坐标的 (left, top, right, bottom)，找不到返回 None"""
+    width, height = edges.size
+    box = edges.crop((1, 1, width - 1, height - 1)).getbbox()
+    if box is None:
+        return None
+    pad_x, pad_y = size[0] * CROP_PADDING, size[1] * CROP_PADDING
+    left = max(0, int((box[0] + 1) / scale - pad_x))
+    top = max(0, int((box[1] + 1) / scale - pad_y))
+    right = min(size[0], int((box[2] + 1) / scale + pad_x))
+    bottom = min(size[1], int((box[3] + 1) / scale + pad_y))
+    return left, top, right, bottom
+
+
+def otsu_threshold(gray):
+    """大津法求二值化阈值（基于灰度直方图，只需遍历 256 个灰度级）"""
+    histogram = gray.histogram()[:256]
+    total = sum(histogram)
+    if not total:
+        return 128
+    sum_all = sum(level * count for level, count in enumerate(histogram))
+    sum_background = weight_background = 0
+    best_threshold, best_variance = 128, -1.0
+    for level, count in enumerate(histogram):
+        weight_background += count
+        if not weight_background:
+            continue
+        weight_foreground = total - weight_background
+        if not weight_foreground:
+            break
+        sum_background += level * count
+        mean_background = sum_background / weight_background
+        mean_foreground = (sum_all - sum_background) / weight_foreground
+        variance = weight_background * weight_foreground * (mean_background - mean_foreground) ** 2
+        if variance > best_variance:
+            best_threshold, best_variance = level, variance
+    return best_threshold
+
+
+def downscale_size(image, max_side=OCR_MAX_SIDE, target_dpi=OCR_TARGET_DPI):
+    """计算缩小后的尺寸（只缩小不放大），不需要缩小时返回 None"""
+    ratio = 1.0
+    dpi = image.info.get('dpi')
+    if target_dpi and dpi and dpi[0]:
+        ratio = min(ratio, target_dpi / float(dpi[0]))
+    if max_side:
+        ratio = min(ratio, max_side / max(image.size))
+    if ratio >= 1.0:
+        return None
+    return max(1, round(image.width * ratio)), max(1, round(image.height * ratio))
+
+
+def draft_for_ocr(image, steps, max_side=OCR_MAX_SIDE, target_dpi=OCR_TARGET_DPI):
+    """
+    在解码前调用: JPEG 可以直接按 1/2、1/4、1/8 缩小解码（并直接解码为灰度），大图解码快很多
+    draft 只会缩到不小于目标尺寸，精确缩放仍由 downscale 完成
+    """
+    if 'downscale' not in steps:
+        return
+    size = downscale_size(image, max_side, target_dpi)
+    if size is None:
+        return
+    original_width = image.width
+    image.draft('L' if 'grayscale' in steps else None, size)
+    dpi = image.info.get('dpi')
+    if dpi and image.width != original_width:
+        # 缩小解码后按比例修正 DPI，避免 downscale 按原 DPI 再缩一次
+        ratio = image.width / original_width
+        image.info['dpi'] = (dpi[0] * ratio, dpi[1] * ratio)
+
+
+def preprocess_image(image, steps, max_side=OCR_MAX_SIDE, target_dpi=OCR_TARGET_DPI,
+                     min_edge_density=OCR_MIN_EDGE_DENSITY):
+    """
+    按 steps 预处理一张 PIL.Image
+    返回处理后的图片；判定为没有文字时返回 None（调用方直接得到空文本）
+    """
+    if not steps:
+        return image
+    from PIL import Image
+
+    edges = scale = None
+    if 'skip_blank' in steps or 'crop' in steps:
+        edges, scale = edge_map(image)
+        if 'skip_blank' in steps and edge_density(edges) < min_edge_density:
+            return None
+
+    if 'crop' in steps:
+        box = text_region(edges, scale, image.size)
+        if box is not None and box != (0, 0) + image.size:
+            image = image.crop(box)
+
+    if 'grayscale' in steps or 'binarize' in steps:
+        image = image.convert('L')
+
+    if 'downscale' in steps:
+        size = downscale_size(image, max_side, target_dpi)
+        if size is not None:
+            image = image.resize(size, Image.LANCZOS)
+
+    if 'binarize' in steps:
+        threshold = otsu_threshold(image)
+        image = image.point(lambda value: 255 if value > threshold else 0)
+
+    return image
@@ -0,0 +1,350 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+离线匹配 Telegram Desktop 导出的聊天记录（result.json）
+不需要加入群组: 用项目的关键词引擎扫描导出文件，命中结果写入 matched_message 表或输出为 NDJSON。
+
+导出文件常有几个GB，这里不用 json.load 整体读取，而是分块读取、逐条解码 "messages" 数组中的消息
+（同时支持单个聊天的导出和“导出全部数据”的 chats.list 结构），按批分发到进程池匹配。
+只匹配文本，不识别图片。
+
+用法:
+    python offline_matcher.py result.json --output hits.ndjson
+    python offline_matcher.py result.json --db --workers 8
+    python offline_matcher.py result.json --keywords words.txt --output -
+"""
+import argparse
+import json
+import os
+import re
+import sys
+import time
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime
+
+from keyword_engine import KEYWORD_LITERAL, KeywordMatcher, KeywordRow, load_keyword_rows
+
+READ_CHUNK_SIZE = 1 << 20        # 每次读取 1MB
+MAX_HEADER_BUFFER = 1 << 20      # 两个 messages 数组之间最多保留的文本（用于找聊天名称）
+MATCH_BATCH_SIZE = 2000          # 每批分发给工作进程的消息数
+PROGRESS_INTERVAL = 5            # 秒
+
+_MESSAGES_KEY = re.compile(r'"messages"\s*:\s*\[')
+_NAME_FIELD = re.compile(r'"name"\s*:\s*("(?:[^"\\]|\\.)*"|null)')
+_ID_FIELD = re.compile(r'"id"\s*:\s*(-?\d+)')
+_WHITESPACE = ' \t\r\n,'
+
+# 离线匹配不区分群组: 全部关键词都挂在第 0 号群组上
+OFFLINE_GROUP_ID = 0
+
+
+def iter_export_messages(path, chunk_size=READ_CHUNK_SIZE):
+    """
+    流式读取导出文件，逐条返回 (聊天名称, 聊天ID, 消息dict)
+    在 "messages" 数组之外只做正则查找（记录最近出现的聊天名称和ID），数组之内用 raw_decode 逐条解码
+    """
+    decoder = json.JSONDecoder()
+    with open(path, 'r', encoding='utf-8') as f:
+        buffer = ''
+        pos = 0
+        eof = False
+        in_array = False
+        chat_name, chat_id = None, None
+
+        def read_more():
+            nonlocal buffer, pos, eof
+            data = f.read(chunk_size)
+            if not data:
+                eof = True
+                return False
+            buffer = buffer[pos:] + data
+            pos = 0
+            return True
+
+        while True:
+            if not in_array:
+                match = _MESSAGES_KEY.search(buffer, pos)
+                if match is None:
+                    # 保留末尾一段，避免键名被分块截断；过长的头部只保留最近的部分
+                    pos = max(pos, len(buffer) - MAX_HEADER_BUFFER)
+                    if not read_more():
+                        return
+                    continue
+                header = buffer[pos:match.start()]
+                names = _NAME_FIELD.findall(header)
+                if names:
+                    chat_name = json.loads(names[-1])
+                ids = _ID_FIELD.findall(header)
+                if ids:
+                    chat_id = int(ids[-1])
+                pos = match.end()
+                in_array = True
+                continue
+
+            while pos < len(buffer) and buffer[pos] in _WHITESPACE:
+                pos += 1
+            if pos >= len(buffer):
+                if not read_more():
+                    raise ValueError("导出文件在 messages 数组中意外结束")
+                continue
+            if buffer[pos] == ']':
+                pos += 1
+                in_array = False
+                continue
+            try:
+                message, end = decoder.raw_decode(buffer, pos)
+            except json.JSONDecodeError:
+                # 消息被分块截断: 读取更多数据后重试
+                if not read_more():
+                    raise
+                continue
+            pos = end
+            yield chat_name, chat_id, message
+
+
+def message_text(message):
+    """导出格式中 text 可能是字符串，也可能是字符串与实体（链接、加粗等）混合的列表"""
+    text = message.get('text', '')
+    if isinstance(text, list):
+        return ''.join(part if isinstance(part, str) else part.get('text', '') for part in text)
+    return text or ''
+
+
+def load_keywords(keywords_file=None, group_id=None):
+    """
+    加载关键词: 指定文件时每行一个普通关键词（ID 为行号，只在本次匹配中使用），否则从数据库读取（可按监控群组筛选）
+    所有关键词都改为挂在 OFFLINE_GROUP_ID 上
+    """
+    if keywords_file:
+        with open(keywords_file, encoding='utf-8') as f:
+            texts = list(dict.fromkeys(line.strip() for line in f if line.strip()))
+        return [KeywordRow(index + 1, text, 1 << OFFLINE_GROUP_ID, False, KEYWORD_LITERAL)
+                for index, text in enumerate(texts)]
+
+    from database import get_session
+    session = get_session()
+    try:
+        rows = load_keyword_rows(session)
+    finally:
+        session.close()
+    if group_id is not None:
+        rows = [row for row in rows if row.group_mask >> group_id & 1]
+    return [row._replace(group_mask=1 << OFFLINE_GROUP_ID) for row in rows if row.group_mask]
+
+
+def resolve_keyword_ids(rows):
+    """
+    关键词文件中的关键词 -> keyword 表中同名普通关键词的 ID（{行号ID: 关键词ID或None}）
+    写入 matched_keyword_span 时使用，表中没有的关键词记为 None，不会把命中记到无关的关键词上
+    """
+    from database import Keyword, get_session
+    texts = [row.text for row in rows]
+    session = get_session()
+    try:
+        existing = {}
+        for start in range(0, len(texts), 500):
+            existing.update(session.query(Keyword.text, Keyword.id).filter(
+                Keyword.text.in_(texts[start:start + 500]), Keyword.keyword_type == KEYWORD_LITERAL
+            ).all())
+    finally:
+        session.close()
+    return {row.id: existing.get(row.text) for row in rows}
+
+
+# --- 工作进程 ---
+
+_matcher = None
+
+
+def _init_worker(rows):
+    global _matcher
+    _matcher = KeywordMatcher(rows)
+
+
+def match_batch(batch):
+    """匹配一批消息 [(聊天名称, 聊天ID, 消息ID, 日期, 发送人, 文本), ...]，只返回命中的消息及命中区间"""
+    results = []
+    for item in batch:
+        hits = _matcher.find_all(item[5], OFFLINE_GROUP_ID)
+        if hits:
+            results.append((item, [(hit.keyword_id, hit.keyword_text, hit.start, hit.end) for hit in hits]))
+    return results
+
+
+# --- 输出 ---
+
+def matched_keyword_text(spans):
+    text = ', '.join(dict.fromkeys(span[1] for span in spans))
+    return text[:97] + '...' if len(text) > 100 else text
+
+
+def parse_date(value):
+    try:
+        return datetime.fromisoformat(value)
+    except (TypeError, ValueError):
+        return datetime.now()
+
+
+class NdjsonSink:
+    def __init__(self, path):
+        self.file = sys.stdout if path == '-' else open(path, 'w', encoding='utf-8')
+
+    def write(self, results):
+        for (chat_name, chat_id, message_id, date, sender, text), spans in results:
+            self.file.write(json.dumps({
+                'chat': chat_name,
+                'chat_id': chat_id,
+                'message_id': message_id,
+                'date': date,
+                'sender': sender,
+                'text': text,
+                'matched_keyword': matched_keyword_text(spans),
+                'hits': [{'keyword_id': k, 'keyword': t, 'start': s, 'end': e} for k, t, s, e in spans],
+            }, ensure_ascii=False))
+            self.file.write('\n')
+
+    def close(self):
+        if self.file is not sys.stdout:
+            self.file.close()
+
+
+class DatabaseSink:
+    """
+    批量写入 matched_message（与实时监控共用 MatchWriter 的多行 INSERT）
+    keyword_ids: 使用关键词文件时，行号ID到 keyword 表ID的映射（见 resolve_keyword_ids）
+    """
+    def __init__(self, batch_size=500, keyword_ids=None):
+        from database import get_session
+        from match_writer import match_writer
+        self.get_session = get_session
+        self.writer = match_writer
+        self.batch_size = batch_size
+        self.keyword_ids = keyword_ids
+        self.pending = []
+
+    def write(self, results):
+        for (chat_name, _, _, date, sender, text), spans in results:
+            if self.keyword_ids is not None:
+                spans = [(self.keyword_ids.get(keyword_id), keyword_text, start, end)
+                         for keyword_id, keyword_text, start, end in spans]
+            self.pending.append({
+                'group_name': chat_name or '离线导入',
+                'message_content': text,
+                'sender': sender,
+                'message_date': parse_date(date),
+                'matched_keyword': matched_keyword_text(spans),
+                'fingerprint': None,
+                'spans': spans,
+            })
+        if len(self.pending) >= self.batch_size:
+            self.flush()
+
+    def flush(self):
+        if not self.pending:
+            return
+        session = self.get_session()
+        try:
+            self.writer.insert_records(session, self.pending)
+            session.commit()
+        except Exception:
+            session.rollback()
+            raise
+        finally:
+            session.close()
+        self.pending = []
+
+    def close(self):
+        self.flush()
+
+
+# --- 主流程 ---
+
+def iter_batches(path, batch_size):
+    batch = []
+    for chat_name, chat_id, message in iter_export_messages(path):
+        if message.get('type', 'message') != 'message':
+            continue
+        text = message_text(message)
+        if not text:
+            continue
+        batch.append((chat_name, chat_id, message.get('id'), message.get('date'),
+                      message.get('from') or message.get('actor'), text))
+        if len(batch) >= batch_size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def run(path, sinks, rows, workers, batch_size=MATCH_BATCH_SIZE):
+    """返回 (消息数, 命中数, 耗时秒)"""
+    started = time.perf_counter()
+    last_report = started
+    scanned = matched = 0
+
+    def consume(future, size):
+        nonlocal scanned, matched, last_report
+        results = future.result()
+        scanned += size
+        matched += len(results)
+        for sink in sinks:
+            sink.write(results)
+        now = time.perf_counter()
+        if now - last_report >= PROGRESS_INTERVAL:
+            last_report = now
+            print(f"[离线匹配] 已处理 {scanned} 条消息，命中 {matched} 条，"
+                  f"{scanned / (now - started):.0f} 条/秒", file=sys.stderr)
+
+    with ProcessPoolExecutor(max_workers=workers, initializer=_init_worker, initargs=(rows,)) as executor:
+        # 在途批次有上限: 解析速度快于匹配时不会把整个文件读进内存
+        in_flight = deque()
+        for batch in iter_batches(path, batch_size):
+            in_flight.append((executor.submit(match_batch, batch), len(batch)))
+            if len(in_flight) >= workers * 2:
+                consume(*in_flight.popleft())
+        while in_flight:
+            consume(*in_flight.popleft())
+
+    return scanned, matched, time.perf_counter() - started
+
+
+def main():
+    parser = argparse.ArgumentParser(description='用关键词离线匹配 Telegram Desktop 导出的聊天记录（result.json）')
+    parser.add_argument('export', help='导出的 result.json 路径')
+    parser.add_argument('--output', help='把命中结果写为 NDJSON（- 表示标准输出）')
+    parser.add_argument('--db', action='store_true', help='把命中结果写入 matched_message 表')
+    parser.add_argument('--keywords', help='关键词文件（每行一个），默认使用数据库中的关键词')
+    parser.add_argument('--group-id', type=int, help='只使用订阅了该监控群组的关键词')
+    parser.add_argument('--workers', type=int, default=os.cpu_count() or 1)
+    parser.add_argument('--batch-size', type=int, default=MATCH_BATCH_SIZE)
+    args = parser.parse_args()
+
+    if not args.output and not args.db:
+        parser.error('请至少指定 --output 或 --db')
+
+    rows = load_keywords(args.keywords, args.group_id)
+    if not rows:
+        print("没有可用的关键词", file=sys.stderr)
+        return 1
+
+    sinks = []
+    if args.output:
+        sinks.append(NdjsonSink(args.output))
+    if args.db:
+        sinks.append(DatabaseSink(keyword_ids=resolve_keyword_ids(rows) if args.keywords else None))
+    try:
+        scanned, matched, elapsed = run(args.export, sinks, rows, max(1, args.workers), args.batch_size)
+    finally:
+        for sink in sinks:
+            sink.close()
+
+    size_mb = os.path.getsize(args.export) / (1 << 20)
+    print(f"[离线匹配] 完成: {len(rows)} 个关键词，{scanned} 条消息，命中 {matched} 条，耗时 {elapsed:.2f}s，"
+          f"{scanned / elapsed if elapsed else 0:.0f} 条/秒（{size_mb / elapsed if elapsed else 0:.1f} MB/秒）",
+          file=sys.stderr)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
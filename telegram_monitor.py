@@ -1,21 +1,19 @@
 import asyncio
 import threading
-from datetime import datetime
-import requests
 import time
-import hmac
-import hashlib
-import base64
-import urllib.parse
-from urllib.parse import urlparse
-from telethon import TelegramClient, events
-from sqlalchemy.orm import sessionmaker
-from sqlalchemy import create_engine
-import ahocorasick
+from collections import OrderedDict, namedtuple
+from datetime import datetime
+from telethon import TelegramClient, events, types
 from concurrent.futures import ThreadPoolExecutor
 import os
 
-from database import Config, MonitoredGroup, Keyword, MatchedMessage, DB_URI
+from database import MonitoredGroup, config_cache, get_session
+from match_writer import match_writer
+from message_dedup import duplicate_filter, message_fingerprint
+from ocr_cache import image_dhash, ocr_cache
+from ocr_engine import ocr_engine
+from notifier import Alert, alert_digester
+from keyword_engine import KeywordEngine, load_keyword_rows
 
 client_instance = None
 client_thread = None
@@ -76,52 +74,293 @@ class VerificationManager:
 
 verification_manager = VerificationManager()
 
-# 性能优化: AC自动机缓存
-keyword_automatons = {}  # {group_id: automaton} 缓存每个群组的AC自动机
-automatons_lock = threading.Lock()  # 线程安全锁
 
-# OCR异步处理: 线程池（最多2个OCR任务并发）
-ocr_executor = ThreadPoolExecutor(max_workers=2, thread_name_prefix="OCR")
+def normalize_chat_id(chat_id):
+    """
+    统一群组ID格式: 只去掉频道/超级群的 -100 前缀，普通群保留负号
+    例如 -1001234567890 / 1234567890 都会被规整为 '1234567890'；
+    普通群 -123 仍为 '-123'，不会与ID为 123 的用户（私聊）混淆
+    """
+    chat_id = str(chat_id).strip()
+    if chat_id.startswith('-100'):
+        return chat_id[4:]
+    return chat_id
+
+def chat_id_aliases(identifier):
+    """
+    同一个群组可能的各种保存形式（添加群组前查重用）
+    频道/超级群: -100xxx 与 xxx；普通群: -xxx 与旧版本按链接添加时保存的不带负号的 xxx
+    """
+    identifier = str(identifier).strip()
+    digits = normalize_chat_id(identifier).lstrip('-')
+    if not digits.isdigit():
+        return {identifier}
+    return {identifier, digits, f"-{digits}", f"-100{digits}"}
+
+GroupRecord = namedtuple('GroupRecord', ['id', 'identifier', 'name', 'priority'])
+
+class MonitoredGroupIndex:
+    """
+    监控群组的进程内索引（性能优化）
+    消息处理时只需一次字典查找即可判断群组是否被监控，不再每条消息全表扫描。
+    刷新时构建新字典后整体替换引用，读取端无需加锁。
+    """
+    def __init__(self):
+        self._by_id = {}        # {规整后的群组ID: GroupRecord}
+        self._by_username = {}  # {小写用户名: GroupRecord}
+        self._lock = threading.Lock()
+
+    def refresh(self, session=None):
+        """从数据库重新加载监控群组（启动时以及群组增删后调用）"""
+        own_session = session is None
+        if own_session:
+            session = get_db_session()
+        try:
+            rows = session.query(
+                MonitoredGroup.id, MonitoredGroup.group_identifier, MonitoredGroup.group_name,
+                MonitoredGroup.priority
+            ).all()
+        finally:
+            if own_session:
+                session.close()
+
+        by_id = {}
+        by_username = {}
+        legacy = []
+        for group_id, identifier, name, priority in rows:
+            record = GroupRecord(group_id, identifier, name, priority or 0)
+            normalized = normalize_chat_id(identifier)
+            if normalized.lstrip('-').isdigit():
+                by_id[normalized] = record
+                if normalized.isdigit():
+                    legacy.append((normalized, record))
+            else:
+                by_username[identifier.lower()] = record
+        # 旧版本按链接添加的普通群保存的是不带负号的ID，而消息中的 chat_id 带负号:
+        # 同时登记带负号的形式（已有明确带负号的记录时以该记录为准）
+        for normalized, record in legacy:
+            by_id.setdefault(f"-{normalized}", record)
+
+        with self._lock:
+            self._by_id, self._by_username = by_id, by_username
+        print(f"[群组索引] 已加载 {len(rows)} 个监控群组")
+        return len(rows)
+
+    def lookup(self, chat_id, username=None):
+        """根据群组ID（或用户名）查找监控群组，不在监控列表中返回 None"""
+        record = None
+        if chat_id is not None:
+            record = self._by_id.get(normalize_chat_id(chat_id))
+        if record is None and username:
+            record = self._by_username.get(username.lower())
+        return record
+
+    def records(self):
+        """全部监控群组（GroupRecord 列表）"""
+        return list(self._by_id.values()) + list(self._by_username.values())
+
+    def __len__(self):
+        return len(self._by_id) + len(self._by_username)
+
+group_index = MonitoredGroupIndex()
+
+# 实体名称缓存配置
+ENTITY_CACHE_SIZE = int(os.environ.get('ENTITY_CACHE_SIZE', 5000))
+ENTITY_CACHE_TTL = float(os.environ.get('ENTITY_CACHE_TTL', 3600))  # 秒，过期后重新解析（改名后能更新）
+
+class EntityNameCache:
+    """
+    发送人显示名 / 群组标题缓存（性能优化）
+    按 peer ID 缓存已解析的名称，活跃发送人的消息不再重复请求 Telegram 实体，
+    减少 API 调用和 FloodWait 风险。LRU 淘汰 + TTL 过期，内存有界。
+    """
+    def __init__(self, max_size=ENTITY_CACHE_SIZE, ttl=ENTITY_CACHE_TTL):
+        self.max_size = max_size
+        self.ttl = ttl
+        self._entries = OrderedDict()  # {(类型, peer_id): (名称, 过期时间)}
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, kind, peer_id):
+        """返回缓存的名称，未命中或已过期返回 None"""
+        key = (kind, peer_id)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                if entry[1] > time.monotonic():
+                    self._entries.move_to_end(key)
+                    self.hits += 1
+                    return entry[0]
+                del self._entries[key]
+            self.misses += 1
+            return None
+
+    def put(self, kind, peer_id, name):
+        if peer_id is None or not name:
+            return
+        key = (kind, peer_id)
+        with self._lock:
+            self._entries[key] = (name, time.monotonic() + self.ttl)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def get_stats(self):
+        total = self.hits + self.misses
+        return {
+            'size': len(self._entries),
+            'max_size': self.max_size,
+            'ttl': self.ttl,
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_rate': self.hits / total if total else None,
+        }
+
+entity_cache = EntityNameCache()
+
+# OCR异步处理: 识别在 OCR 进程池中进行（见 ocr_engine）
+# 下载好的图片在 ocr_feed_executor 中计算哈希、查缓存并提交进程池；下载前先向 OCR 队列预留名额，
+# 等待提交的图片计入队列深度，图片刷屏时不会在进程池队列之前无限堆积。
+# 识别结果的后续处理（匹配、解析名称、保存、通知）在 ocr_result_executor 中执行，
+# 解析名称最多等待 15 秒，放在单独的线程池里，不会卡住给进程池供图的线程
+ocr_feed_executor = ThreadPoolExecutor(max_workers=2, thread_name_prefix="OCRFeed")
+ocr_result_executor = ThreadPoolExecutor(max_workers=2, thread_name_prefix="OCR")
+
+# 下载用于OCR的图片时，选择长边不小于此值的最小尺寸（Telegram 常见尺寸: 320/800/1280/2560）
+OCR_MIN_PHOTO_SIDE = int(os.environ.get('OCR_MIN_PHOTO_SIDE', 1280))
+
+# 全匹配模式: 记录一条消息中命中的全部关键词及位置（设为 0 则只记录第一个命中的关键词）
+MATCH_ALL_KEYWORDS = os.environ.get('MATCH_ALL_KEYWORDS', '1') not in ('0', 'false', 'False')
 
 # WebSocket消息推送回调函数（由 app.py 设置）
 websocket_broadcast_callback = None
 
 def get_db_session():
-    engine = create_engine(DB_URI)
-    Session = sessionmaker(bind=engine)
-    return Session()
+    # 性能优化: 复用全局共享引擎的连接池，不再每次调用都新建引擎
+    return get_session()
+
+def match_keywords(matcher, message_text, group_id):
+    """
+    在消息中匹配关键词（单次扫描）
+    返回: (matched_keyword_text, hits)
+        matched_keyword_text: 命中的关键词（全匹配模式下为去重后用逗号连接的全部关键词），未命中为 None
+        hits: 命中列表（KeywordHit）；全匹配模式下为全部命中区间，否则只有第一个命中
+    """
+    if not MATCH_ALL_KEYWORDS:
+        hit = matcher.first_hit(message_text, group_id)
+        return (hit.keyword_text, [hit]) if hit else (None, [])
+
+    hits = matcher.find_all(message_text, group_id)
+    if not hits:
+        return None, []
+    distinct_keywords = list(dict.fromkeys(hit.keyword_text for hit in hits))
+    matched_keyword_text = ', '.join(distinct_keywords)
+    if len(matched_keyword_text) > 100:
+        matched_keyword_text = matched_keyword_text[:97] + '...'
+    return matched_keyword_text, hits
+
+def hit_keywords(hits):
+    """命中的各个关键词（去重，保持出现顺序），用于按关键词合并通知"""
+    return tuple(dict.fromkeys(hit.keyword_text for hit in hits))
+
+def build_matched_message(group_name, message_text, sender_name, matched_keyword_text, hits, fingerprint=None):
+    """构造待保存的匹配记录（全匹配模式下附带关键词命中区间），交给异步写入队列"""
+    return {
+        'group_name': group_name,
+        'message_content': message_text,
+        'sender': sender_name,
+        'message_date': datetime.now(),
+        'matched_keyword': matched_keyword_text,
+        'fingerprint': fingerprint,
+        'spans': [(hit.keyword_id, hit.keyword_text, hit.start, hit.end) for hit in hits] if MATCH_ALL_KEYWORDS else [],
+    }
 
-def process_ocr_sync(photo_path):
+# 指纹检查和提交写入必须是一个原子操作，保证原记录总是先于它的重复出现进入写入队列
+_dedup_lock = threading.Lock()
+
+def save_matched_message(record):
+    """
+    保存匹配记录；窗口期内已保存过相同内容时只累加出现次数和群组
+    返回: True 表示新消息，False 表示重复（调用方跳过推送和通知）
+    """
+    fingerprint = record['fingerprint']
+    with _dedup_lock:
+        if fingerprint and duplicate_filter.seen(fingerprint):
+            match_writer.submit_duplicate(fingerprint, record['group_name'])
+            return False
+        # 只有成功入队才记录指纹: 写入队列已满丢弃原消息时，后续相同内容仍按新消息保存
+        if match_writer.submit(record) and fingerprint:
+            duplicate_filter.add(fingerprint)
+        return True
+
+def choose_ocr_photo_size(photo, min_side=OCR_MIN_PHOTO_SIDE):
+    """
+    选择用于OCR的图片尺寸: 长边不小于 min_side 的最小尺寸（都不够大时取最大尺寸）
+    返回 PhotoSize 的 type（传给 download_media 的 thumb 参数），无可选尺寸时返回 None（下载原图）
+    """
+    candidates = []
+    for size in photo.sizes:
+        if isinstance(size, types.PhotoSizeProgressive):
+            candidates.append((max(size.w, size.h), max(size.sizes), size.type))
+        elif isinstance(size, types.PhotoSize):
+            candidates.append((max(size.w, size.h), size.size, size.type))
+    if not candidates:
+        return None
+    large_enough = [c for c in candidates if c[0] >= min_side]
+    if large_enough:
+        return min(large_enough, key=lambda c: (c[0], c[1]))[2]
+    return max(candidates, key=lambda c: (c[0], c[1]))[2]
+
+def recognize_photo(image_data, event_data, group, matcher):
     """
-    同步OCR处理函数（在线程池中运行）
-    返回: (ocr_text, error)
+    在OCR供图线程中运行（已通过 ocr_engine.reserve() 预留队列名额）: 先按图片感知哈希查OCR缓存，
+    命中则把结果交给结果处理线程，未命中才提交到OCR进程池识别
     """
     try:
-        from PIL import Image
-        import pytesseract
-        
-        image = Image.open(photo_path)
-        ocr_text = pytesseract.image_to_string(image, lang='chi_sim+eng')
-        print(f"[OCR异步] 识别完成: {ocr_text[:100]}...")
-        
-        # 删除临时文件
-        if os.path.exists(photo_path):
-            os.remove(photo_path)
-        
-        return (ocr_text, None)
-    except ImportError as e:
-        print(f"[OCR异步] 警告: 未安装 pytesseract 或 Pillow - {e}")
-        return (None, "未安装OCR依赖")
+        dhash = image_dhash(image_data)
     except Exception as e:
-        print(f"[OCR异步] 识别失败: {e}")
-        return (None, str(e))
+        print(f"[OCR异步] 计算图片哈希失败: {e}")
+        dhash = None
 
-def handle_ocr_result(future, event_data, group_obj, automaton):
+    if dhash is not None:
+        try:
+            cached_text = ocr_cache.get_by_hash(dhash, event_data['photo_id'])
+        except Exception as e:
+            print(f"[OCR异步] 查询OCR缓存失败: {e}")
+            cached_text = None
+        if cached_text is not None:
+            ocr_engine.release()
+            print(f"[OCR异步] 图片识别结果命中缓存，跳过OCR")
+            ocr_result_executor.submit(handle_ocr_result, (cached_text, None), event_data, group, matcher)
+            return
+
+    future = ocr_engine.submit(image_data, event_data['priority'], reserved=True)
+    future.add_done_callback(
+        lambda f: ocr_result_executor.submit(finish_ocr, f, dhash, event_data, group, matcher)
+    )
+
+def finish_ocr(future, dhash, event_data, group, matcher):
+    """OCR进程池识别完成: 保存到OCR缓存后处理结果"""
+    try:
+        ocr_result = future.result()
+    except Exception as e:
+        ocr_result = (None, str(e))
+    if dhash is not None and not ocr_result[1]:
+        ocr_cache.put(event_data['photo_id'], dhash, ocr_result[0])
+    handle_ocr_result(ocr_result, event_data, group, matcher)
+
+def handle_ocr_result(ocr_result, event_data, group, matcher):
     """
-    OCR结果回调函数（在线程池完成后调用）
+    处理图片识别结果（识别完成或命中OCR缓存后调用）
+    ocr_result: (ocr_text, error)
     """
     try:
-        ocr_text, error = future.result()
+        ocr_text, error = ocr_result
         
         if error:
             print(f"[OCR异步] 处理失败，跳过: {error}")
@@ -130,6 +369,7 @@ def handle_ocr_result(future, event_data, group_obj, automaton):
         if not ocr_text or not ocr_text.strip():
             print(f"[OCR异步] 未识别到文字")
             return
+        print(f"[OCR异步] 识别完成: {ocr_text[:100]}...")
         
         # 组合消息文本
         message_text = event_data['original_text']
@@ -139,379 +379,223 @@ def handle_ocr_result(future, event_data, group_obj, automaton):
             message_text = f"[图片文字]: {ocr_text}".strip()
         
         # 使用AC自动机匹配关键词
-        message_lower = message_text.lower()
-        matched_keyword_text = None
-        
-        for end_index, keyword_text in automaton.iter(message_lower):
-            # automaton 现在返回字符串，不是对象
-            matched_keyword_text = keyword_text
-            break
+        matched_keyword_text, hits = match_keywords(matcher, message_text, group.id)
         
         if matched_keyword_text:
             print(f"[OCR异步] 在图片文字中找到关键词 '{matched_keyword_text}'")
+
+            # 命中关键词后才解析群组和发送人
+            group_name, sender_name = resolve_event_names_threadsafe(event_data['event'], group)
+            event_data['group_name'] = group_name
+            event_data['sender'] = sender_name
             
-            # 保存匹配结果
-            session = get_db_session()
-            try:
-                new_message = MatchedMessage(
-                    group_name=event_data['group_name'],
-                    message_content=message_text,
-                    sender=event_data['sender'],
-                    message_date=datetime.now(),
-                    matched_keyword=matched_keyword_text
-                )
-                session.add(new_message)
-                session.commit()
-                print(f"[OCR异步] 保存成功: 群组 '{event_data['group_name']}' 关键词 '{matched_keyword_text}'")
-                
-                # WebSocket 实时推送
-                if websocket_broadcast_callback:
-                    try:
-                        websocket_broadcast_callback({
-                            'group_name': event_data['group_name'],
-                            'sender': event_data['sender'] or 'N/A',
-                            'matched_keyword': matched_keyword_text,
-                            'message_content': message_text[:200] + '...' if len(message_text) > 200 else message_text,
-                            'message_date': datetime.now().strftime('%Y-%m-%d %H:%M:%S'),
-                            'is_image': True
-                        })
-                    except Exception as e:
-                        print(f"[OCR异步] WebSocket推送失败: {e}")
-                
-                # 发送通知
-                config = session.query(Config).first()
-                if config:
-                    title = f"关键词 '{matched_keyword_text}' 触发"
-                    notification_message = (
-                        f"#### **关键词监控提醒（图片识别）**\n\n"
-                        f"> **群组**: {event_data['group_name']}\n\n"
-                        f"> **发送人**: {event_data['sender'] or 'N/A'}\n\n"
-                        f"> **关键词**: {matched_keyword_text}\n\n"
-                        f"> **消息内容**: {message_text}\n"
-                    )
-                    
-                    # 根据配置发送到不同的通知渠道
-                    if config.notification_type == 'dingtalk' and config.dingtalk_webhook:
-                        send_to_dingtalk(config.dingtalk_webhook, config.dingtalk_secret, title, notification_message)
-                    elif config.notification_type == 'wecom' and config.wecom_webhook:
-                        send_to_wecom(config.wecom_webhook, title, notification_message)
-            finally:
-                session.close()
+            # 保存匹配结果（异步批量写入）；跨群组转发的重复图片只累加到第一条记录上
+            is_new = save_matched_message(build_matched_message(
+                event_data['group_name'], message_text, event_data['sender'], matched_keyword_text, hits,
+                message_fingerprint(event_data['original_text'], event_data['photo_id'], source='ocr',
+                                    keyword_ids=[hit.keyword_id for hit in hits])
+            ))
+            if not is_new:
+                print(f"[OCR异步] 重复消息，已合并: 群组 '{event_data['group_name']}' 关键词 '{matched_keyword_text}'")
+                return
+            print(f"[OCR异步] 已提交保存: 群组 '{event_data['group_name']}' 关键词 '{matched_keyword_text}'")
+
+            # WebSocket 实时推送
+            if websocket_broadcast_callback:
+                try:
+                    websocket_broadcast_callback({
+                        'group_name': event_data['group_name'],
+                        'sender': event_data['sender'] or 'N/A',
+                        'matched_keyword': matched_keyword_text,
+                        'message_content': message_text[:200] + '...' if len(message_text) > 200 else message_text,
+                        'message_date': datetime.now().strftime('%Y-%m-%d %H:%M:%S'),
+                        'is_image': True
+                    })
+                except Exception as e:
+                    print(f"[OCR异步] WebSocket推送失败: {e}")
+
+            # 发送通知: 配置读取缓存快照，不查询数据库
+            # 经摘要合并后提交到后台发送队列（不阻塞消息处理）
+            alert_digester.add(config_cache.get(), Alert(
+                matched_keyword_text, event_data['group_name'], event_data['sender'],
+                message_text, True, matcher.is_immediate(hits), hit_keywords(hits)
+            ))
         else:
             print(f"[OCR异步] 图片文字中未找到关键词")
             
     except Exception as e:
         print(f"[OCR异步] 回调处理失败: {e}")
 
-def build_keyword_automaton(keywords):
+def load_all_keywords():
+    session = get_db_session()
+    try:
+        return load_keyword_rows(session)
+    finally:
+        session.close()
+
+# 性能优化: 全局共享的关键词匹配器（所有群组共用一个AC自动机，后台重建 + 原子切换）
+keyword_engine = KeywordEngine(load_all_keywords)
+
+def invalidate_keyword_matcher():
+    """关键词或群组关联变更后调用，由后台线程重建自动机，不阻塞消息处理"""
+    keyword_engine.request_rebuild()
+
+def get_sender_display_name(sender):
+    """发送人显示名: 优先用户名，其次姓名；无法确定发送人时返回 None"""
+    sender_name = None
+    if sender:
+        sender_name = getattr(sender, 'username', None)
+        if not sender_name:
+            first_name = getattr(sender, 'first_name', '') or ''
+            last_name = getattr(sender, 'last_name', '') or ''
+            sender_name = f"{first_name} {last_name}".strip()
+    return sender_name
+
+async def resolve_event_names(event, group):
     """
-    为一组关键词构建Aho-Corasick自动机
-    性能优化: 将多个关键词编译成状态机,实现O(n)时间复杂度的多模式匹配
-    
-    Args:
-        keywords: 关键词对象列表
-    
-    Returns:
-        automaton: 构建好的AC自动机
+    解析群组名称和发送人（只在命中关键词后调用）
+    性能优化: 先查实体名称缓存，未命中时才请求 Telegram 实体
+    返回: (group_name, sender_name)
     """
-    automaton = ahocorasick.Automaton()
-    
-    for keyword in keywords:
-        # 将关键词的小写形式和文本字符串关联（不存储对象，避免会话分离）
-        keyword_text = keyword.text  # 立即提取字符串
-        automaton.add_word(keyword_text.lower(), keyword_text)
-    
-    # 构建失败指针,完成自动机
-    automaton.make_automaton()
-    
-    return automaton
+    chat_id = event.chat_id
+    group_name = entity_cache.get('chat', chat_id)
+    if group_name is None:
+        chat = await event.get_chat()
+        chat_title = getattr(chat, 'title', None)
+        entity_cache.put('chat', chat_id, chat_title)
+        group_name = chat_title or group.name or '未知群组'
+
+    sender_id = event.sender_id
+    sender_name = entity_cache.get('sender', sender_id) if sender_id is not None else None
+    if sender_name is None:
+        sender = await event.get_sender()
+        sender_name = get_sender_display_name(sender)
+        if sender is not None:
+            entity_cache.put('sender', sender_id, sender_name)
+        else:
+            # 无法确定发送人（如匿名管理员）时显示群组名称
+            sender_name = group_name
+    return group_name, sender_name
+
+def resolve_event_names_threadsafe(event, group, timeout=15):
+    """在OCR线程中解析名称: 把协程投递到监控线程的事件循环执行"""
+    loop = main_loop
+    if loop and loop.is_running():
+        try:
+            future = asyncio.run_coroutine_threadsafe(resolve_event_names(event, group), loop)
+            return future.result(timeout=timeout)
+        except Exception as e:
+            print(f"[OCR异步] 解析发送人失败: {e}")
+    return group.name or '未知群组', None
+
+async def handle_new_message(event):
+    # 性能优化: 先根据 event.chat_id 判断是否为监控群组，未监控的群组不做任何实体请求
+    # event.chat 只读取本地已缓存的实体，不会触发网络请求（用于按用户名配置的群组）
+    current_group = group_index.lookup(event.chat_id, getattr(event.chat, 'username', None))
+    if current_group is None:
+        return
 
-def is_safe_url(url):
-    try:
-        parsed_url = urlparse(url)
-        if parsed_url.scheme not in ['http', 'https']:
-            return False
-        # 限制为钉钉的官方域名
-        allowed_domains = ['oapi.dingtalk.com']
-        if parsed_url.netloc not in allowed_domains:
-            return False
-        return True
-    except Exception:
-        return False
+    print(f"[调试] 群组 '{current_group.name}' (ID: {event.chat_id}) 在监控列表中。开始检查关键词...")
 
-def send_to_dingtalk(webhook_url, secret, title, message, is_test=False):
-    if not webhook_url:
-        if is_test: return "钉钉Webhook未配置。"
-        print("钉钉Webhook未配置，跳过发送。")
-        return
-    
-    if not is_safe_url(webhook_url):
-        error_msg = f"检测到不安全的Webhook URL: {webhook_url}"
-        print(error_msg)
-        if is_test: return error_msg
+    # 性能优化: 读取当前生效的自动机快照（后台重建期间继续使用旧版本）
+    matcher = keyword_engine.snapshot
+    if not matcher.has_group(current_group.id):
+        print(f"[调试] 注意: 群组 '{current_group.name}' 没有配置任何关键词。")
         return
 
-    if secret:
-        timestamp = str(round(time.time() * 1000))
-        secret_enc = secret.encode('utf-8')
-        string_to_sign = '{}\n{}'.format(timestamp, secret)
-        string_to_sign_enc = string_to_sign.encode('utf-8')
-        hmac_code = hmac.new(secret_enc, string_to_sign_enc, digestmod=hashlib.sha256).digest()
-        sign = urllib.parse.quote_plus(base64.b64encode(hmac_code))
-        webhook_url = f"{webhook_url}&timestamp={timestamp}&sign={sign}"
-
-    headers = {'Content-Type': 'application/json;charset=utf-8'}
-    data = {
-        "msgtype": "markdown",
-        "markdown": {
-            "title": title,
-            "text": message
-        }
-    }
-    try:
-        response = requests.post(webhook_url, headers=headers, json=data)
-        if response.status_code == 200 and response.json().get("errcode") == 0:
-            print("成功发送钉钉通知。")
-            if is_test: return "测试消息发送成功！"
+    # 获取要匹配的文本内容
+    message_text = event.message.message or ""
+
+    # 先处理文本消息（不阻塞）
+    matched_keyword_text, hits = match_keywords(matcher, message_text, current_group.id)
+
+    if matched_keyword_text:
+        print(f"[调试] 成功! 在消息中找到关键词 '{matched_keyword_text}'。")
+        # 命中关键词后才解析群组和发送人
+        group_name, sender_name = await resolve_event_names(event, current_group)
+
+        # 性能优化: 放入异步写入队列，由写入线程批量插入，不在事件循环中等待数据库
+        # 跨群组转发的重复消息只累加到第一条记录上，不再推送和通知
+        photo = event.message.photo
+        is_new = save_matched_message(build_matched_message(
+            group_name, message_text, sender_name, matched_keyword_text, hits,
+            message_fingerprint(message_text, photo.id if photo else None,
+                                keyword_ids=[hit.keyword_id for hit in hits])
+        ))
+        if not is_new:
+            print(f"在群组 '{group_name}' 中匹配到关键词 '{matched_keyword_text}'（重复消息，已合并）")
         else:
-            print(f"发送钉钉通知失败: {response.text}")
-            if is_test: return f"发送失败: {response.text}"
-    except Exception as e:
-        print(f"发送钉钉通知时发生异常: {e}")
-        if is_test: return f"发生异常: {e}"
+            print(f"在群组 '{group_name}' 中匹配到关键词 '{matched_keyword_text}'")
 
-def send_to_wecom(webhook_url, title, message, is_test=False):
-    """
-    发送消息到企业微信机器人
-    
-    参数:
-        webhook_url: 企业微信机器人webhook地址
-        title: 消息标题
-        message: 消息内容（markdown格式）
-        is_test: 是否为测试消息
-    
-    返回:
-        如果is_test=True，返回发送结果信息字符串
-    """
-    if not webhook_url:
-        if is_test:
-            return "企业微信Webhook未配置。"
-        print("企业微信Webhook未配置，跳过发送。")
-        return
-    
-    # 安全检查：验证URL格式
-    try:
-        parsed_url = urlparse(webhook_url)
-        if parsed_url.scheme not in ['http', 'https']:
-            error_msg = "企业微信Webhook URL协议不正确（必须是http/https）"
-            print(error_msg)
-            if is_test:
-                return error_msg
+            # WebSocket 实时推送
+            if websocket_broadcast_callback:
+                try:
+                    websocket_broadcast_callback({
+                        'group_name': group_name,
+                        'sender': sender_name or 'N/A',
+                        'matched_keyword': matched_keyword_text,
+                        'message_content': message_text[:200] + '...' if len(message_text) > 200 else message_text,
+                        'message_date': datetime.now().strftime('%Y-%m-%d %H:%M:%S'),
+                        'is_image': False
+                    })
+                except Exception as e:
+                    print(f"[WebSocket] 推送失败: {e}")
+
+            # 配置读取缓存快照，不在事件循环中查询数据库
+            # 经摘要合并后提交到后台发送队列（不阻塞消息处理）
+            alert_digester.add(config_cache.get(), Alert(
+                matched_keyword_text, group_name, sender_name,
+                message_text, False, matcher.is_immediate(hits), hit_keywords(hits)
+            ))
+
+    # OCR异步处理: 如果消息包含图片，提交到线程池处理（不阻塞）
+    if event.message.photo:
+        # 准备事件数据（群组名和发送人在图片命中关键词后才解析）
+        photo_id = event.message.photo.id
+        event_data = {
+            'event': event,
+            'original_text': message_text,
+            'photo_id': photo_id,
+            # OCR队列优先级: 重要群组优先；图片说明文字命中了“立即通知”关键词的再提高一级
+            'priority': current_group.priority + (1 if hits and matcher.is_immediate(hits) else 0)
+        }
+
+        # 性能优化: 转发的图片与原图共用 photo id，已识别过的直接使用缓存结果，不再下载
+        cached_text = ocr_cache.get_by_photo(photo_id)
+        if cached_text is not None:
+            print(f"[OCR异步] 图片识别结果命中缓存，跳过下载和OCR")
+            ocr_result_executor.submit(handle_ocr_result, (cached_text, None), event_data, current_group, matcher)
             return
-        # 限制为企业微信的官方域名
-        allowed_domains = ['qyapi.weixin.qq.com']
-        if parsed_url.netloc not in allowed_domains:
-            error_msg = f"检测到不安全的Webhook URL: {webhook_url}"
-            print(error_msg)
-            if is_test:
-                return error_msg
+
+        # 预留OCR队列名额: 队列已满且优先级不够时直接跳过，不再下载图片
+        if not ocr_engine.reserve(event_data['priority']):
+            print(f"[OCR异步] OCR队列已满，跳过群组 '{current_group.name}' 的图片")
             return
-    except Exception as e:
-        error_msg = f"Webhook URL格式错误: {e}"
-        print(error_msg)
-        if is_test:
-            return error_msg
-        return
-    
-    # 构造企业微信markdown消息格式
-    headers = {'Content-Type': 'application/json;charset=utf-8'}
-    data = {
-        "msgtype": "markdown",
-        "markdown": {
-            "content": f"### {title}\n{message}"
-        }
-    }
-    
-    try:
-        response = requests.post(webhook_url, headers=headers, json=data, timeout=5)
-        if response.status_code == 200:
-            result = response.json()
-            if result.get("errcode") == 0:
-                print("成功发送企业微信通知。")
-                if is_test:
-                    return "测试消息发送成功！"
-            else:
-                error_msg = f"发送失败: {result.get('errmsg', '未知错误')}"
-                print(f"发送企业微信通知失败: {error_msg}")
-                if is_test:
-                    return error_msg
-        else:
-            error_msg = f"HTTP状态码: {response.status_code}"
-            print(f"发送企业微信通知失败: {error_msg}")
-            if is_test:
-                return f"发送失败: {error_msg}"
-    except Exception as e:
-        print(f"发送企业微信通知时发生异常: {e}")
-        if is_test:
-            return f"发生异常: {e}"
+
+        print(f"[OCR异步] 检测到图片消息，提交到OCR进程池处理...")
+        submitted = False
+        try:
+            # 性能优化: 直接下载到内存（不写临时文件），并选择足够OCR使用的较小尺寸
+            image_data = await event.message.download_media(
+                file=bytes, thumb=choose_ocr_photo_size(event.message.photo)
+            )
+            if image_data:
+                # 查图片哈希缓存、提交OCR进程池都在供图线程中进行（不阻塞主流程）
+                ocr_feed_executor.submit(recognize_photo, image_data, event_data, current_group, matcher)
+                submitted = True
+                print(f"[OCR异步] 图片已提交处理，继续处理下一条消息...")
+        except Exception as e:
+            print(f"[OCR异步] 下载图片失败: {e}")
+        finally:
+            if not submitted:
+                ocr_engine.release()
 
 async def start_client_async(api_id, api_hash, phone_number):
     global client_instance, is_running
     
     client = TelegramClient('telegram_session', api_id, api_hash, system_version="4.16.30-vxCUSTOM")
     client_instance = client
-        
-    @client.on(events.NewMessage)
-    async def handler(event):
-        chat = await event.get_chat()
-        print(f"[调试] 收到新消息, 来自群组: '{getattr(chat, 'title', '未知群组')}' (ID: {chat.id})")
-
-        session_handler = get_db_session() 
-        try:
-            sender = await event.get_sender()
-
-            group_name = getattr(chat, 'title', '未知群组')
-            sender_name = None 
-            if sender:
-                sender_name = getattr(sender, 'username', None)
-                if not sender_name: 
-                    first_name = getattr(sender, 'first_name', '') or ''
-                    last_name = getattr(sender, 'last_name', '') or ''
-                    sender_name = f"{first_name} {last_name}".strip()
-            
-            if sender_name is None and hasattr(chat, 'title'):
-                sender_name = chat.title
-
-            standard_chat_id = str(chat.id)
-            if standard_chat_id.startswith('-100'):
-                standard_chat_id = standard_chat_id[4:]
-            
-            all_monitored_ids = [g.group_identifier for g in session_handler.query(MonitoredGroup).all()]
-            
-            standard_monitored_ids = []
-            for mid in all_monitored_ids:
-                if mid.startswith('-100'):
-                    standard_monitored_ids.append(mid[4:])
-                else:
-                    standard_monitored_ids.append(mid)
-
-            current_group_obj = None
-            
-            if standard_chat_id in standard_monitored_ids:
-                original_id = None
-                for mid in all_monitored_ids:
-                    if mid.endswith(standard_chat_id):
-                        original_id = mid
-                        break
-                if original_id:
-                    current_group_obj = session_handler.query(MonitoredGroup).filter_by(group_identifier=original_id).first()
-
-            if not current_group_obj and hasattr(chat, 'username') and chat.username in all_monitored_ids:
-                current_group_obj = session_handler.query(MonitoredGroup).filter_by(group_identifier=chat.username).first()
-
-
-            if current_group_obj:
-                print(f"[调试] 群组 '{getattr(chat, 'title', '未知')}' 在监控列表中。开始检查关键词...")
-                keywords_to_check = current_group_obj.keywords
-                
-                if not keywords_to_check:
-                    print(f"[调试] 注意: 群组 '{getattr(chat, 'title', '未知')}' 没有配置任何关键词。")
-                else:
-                    keyword_texts = [k.text for k in keywords_to_check]
-                    print(f"[调试] 为该群组配置的关键词: {keyword_texts}")
-
-                    # 获取要匹配的文本内容
-                    message_text = event.message.message or ""
-                    
-                    # 性能优化: 使用AC自动机进行高效匹配
-                    # 获取或构建该群组的自动机（带缓存）
-                    with automatons_lock:
-                        if current_group_obj.id not in keyword_automatons:
-                            print(f"[性能优化] 首次为群组 '{group_name}' 构建AC自动机...")
-                            keyword_automatons[current_group_obj.id] = build_keyword_automaton(keywords_to_check)
-                        
-                        automaton = keyword_automatons[current_group_obj.id]
-                    
-                    # 先处理文本消息（不阻塞）
-                    message_lower = message_text.lower()
-                    matched_keyword_text = None
-                    
-                    for end_index, keyword_text in automaton.iter(message_lower):
-                        # automaton 现在返回字符串，不是对象
-                        matched_keyword_text = keyword_text
-                        break
-                    
-                    if matched_keyword_text:
-                        print(f"[调试] 成功! 在消息中找到关键词 '{matched_keyword_text}'。")
-                        new_message = MatchedMessage(
-                            group_name=group_name,
-                            message_content=message_text,
-                            sender=sender_name,
-                            message_date=datetime.now(),
-                            matched_keyword=matched_keyword_text
-                        )
-                        session_handler.add(new_message)
-                        session_handler.commit()
-                        print(f"在群组 '{group_name}' 中匹配到关键词 '{matched_keyword_text}'")
-                        
-                        # WebSocket 实时推送
-                        if websocket_broadcast_callback:
-                            try:
-                                websocket_broadcast_callback({
-                                    'group_name': group_name,
-                                    'sender': sender_name or 'N/A',
-                                    'matched_keyword': matched_keyword_text,
-                                    'message_content': message_text[:200] + '...' if len(message_text) > 200 else message_text,
-                                    'message_date': datetime.now().strftime('%Y-%m-%d %H:%M:%S'),
-                                    'is_image': False
-                                })
-                            except Exception as e:
-                                print(f"[WebSocket] 推送失败: {e}")
-
-                        config = session_handler.query(Config).first()
-                        if config:
-                            title = f"关键词 '{matched_keyword_text}' 触发"
-                            notification_message = (
-                                f"#### **关键词监控提醒**\n\n"
-                                f"> **群组**: {group_name}\n\n"
-                                f"> **发送人**: {sender_name or 'N/A'}\n\n"
-                                f"> **关键词**: {matched_keyword_text}\n\n"
-                                f"> **消息内容**: {message_text}\n"
-                            )
-                            
-                            # 根据配置发送到不同的通知渠道
-                            if config.notification_type == 'dingtalk' and config.dingtalk_webhook:
-                                send_to_dingtalk(config.dingtalk_webhook, config.dingtalk_secret, title, notification_message)
-                            elif config.notification_type == 'wecom' and config.wecom_webhook:
-                                send_to_wecom(config.wecom_webhook, title, notification_message)
-                    
-                    # OCR异步处理: 如果消息包含图片，提交到线程池处理（不阻塞）
-                    if event.message.photo:
-                        print(f"[OCR异步] 检测到图片消息，提交到线程池处理...")
-                        try:
-                            # 下载图片（这是异步操作，但下载必须在这里完成）
-                            photo_path = await event.message.download_media()
-                            if photo_path:
-                                # 准备事件数据
-                                event_data = {
-                                    'group_name': group_name,
-                                    'sender': sender_name,
-                                    'original_text': message_text
-                                }
-                                
-                                # 提交到线程池进行OCR处理（不阻塞主流程）
-                                future = ocr_executor.submit(process_ocr_sync, photo_path)
-                                # 添加回调函数
-                                future.add_done_callback(
-                                    lambda f: handle_ocr_result(f, event_data, current_group_obj, automaton)
-                                )
-                                print(f"[OCR异步] 图片已提交到线程池，继续处理下一条消息...")
-                        except Exception as e:
-                            print(f"[OCR异步] 下载图片失败: {e}")
-            else:
-                print(f"[调试] 群组 '{getattr(chat, 'title', '未知')}' (ID: {chat.id}) 不在监控列表中，已忽略。")
-        finally:
-            session_handler.close() 
+    client.add_event_handler(handle_new_message, events.NewMessage)
 
     while not stop_event.is_set():
         try:
@@ -544,6 +628,11 @@ async def start_client_async(api_id, api_hash, phone_number):
                         raise
 
             verification_manager.set_done()
+
+            # 性能优化: 标记就绪前确保关键词自动机已加载并预热，重连后的第一条消息无需等待构建
+            if keyword_engine.snapshot.version == 0:
+                keyword_engine.rebuild_now()
+
             is_running = True
             print("Telegram客户端已成功连接并开始监听...")
             client_ready.set()
@@ -584,12 +673,17 @@ def start_monitoring():
     
     stop_event.clear() # <-- 新增: 重置停止事件
     client_ready.clear() 
-    session = get_db_session()
-    config = session.query(Config).first()
-    session.close()
+    config_cache.invalidate()
+    config = config_cache.get()
 
     if not (config and config.api_id and config.api_hash and config.phone_number):
         return
+
+    # 性能优化: 启动时构建监控群组索引和关键词自动机，并启动异步写入线程
+    group_index.refresh()
+    keyword_engine.rebuild_now()
+    match_writer.start()
+    ocr_engine.start()
     
     loop = asyncio.new_event_loop()
     main_loop = loop
@@ -613,6 +707,7 @@ def stop_monitoring():
         )
     
     client_thread.join(timeout=5)
+    match_writer.stop()
     
     is_running = False
     main_loop = None
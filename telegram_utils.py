@@ -1,6 +1,6 @@
 import os
 import asyncio
-from telethon import TelegramClient
+from telethon import TelegramClient, utils
 from urllib.parse import urlparse
 import concurrent.futures
 import time
@@ -47,7 +47,8 @@ async def get_group_details_async(group_identifier):
 
         return {
             'success': True,
-            'identifier': str(group_id),
+            # 带标记的ID（频道/超级群 -100xxx，普通群 -xxx），与“我的群组”列表一致，避免普通群与用户ID混淆
+            'identifier': str(utils.get_peer_id(entity)),
             'name': group_name,
             'logo_path': logo_rel_path
         }
@@ -0,0 +1,180 @@
+# -*- coding: utf-8 -*-
+"""
+通知发送管道测试（NotificationDispatcher）
+使用 bench_notifier 中的模拟 webhook 服务，验证令牌桶限速、失败重试与退避、延迟队列上限、
+未送达通知的保存以及重启后的补发。数据库使用内存 SQLite。
+
+用法:
+    python -m pytest -q test_notifier.py
+"""
+import os
+import time
+from datetime import datetime, timedelta
+
+os.environ.setdefault('DB_URI', 'sqlite://')
+
+import pytest
+from sqlalchemy import create_engine
+from sqlalchemy.pool import StaticPool
+
+import database
+from bench_notifier import start_stub_server
+from database import Config, FailedNotification, config_cache, get_session
+from notifier import NotificationDispatcher, post_webhook
+
+
+@pytest.fixture(autouse=True)
+def sqlite_db():
+    engine = create_engine('sqlite://', poolclass=StaticPool, connect_args={'check_same_thread': False})
+    database.bind_engine(engine)
+    database.db.metadata.create_all(engine)
+    config_cache.invalidate()
+    yield engine
+    config_cache.invalidate()
+    engine.dispose()
+
+
+@pytest.fixture
+def stub():
+    servers = []
+
+    def start(responses=()):
+        server, url = start_stub_server(responses=responses)
+        servers.append(server)
+        return server.RequestHandlerClass, url
+
+    yield start
+    for server in servers:
+        server.shutdown()
+
+
+def make_dispatcher(channel='stub', **options):
+    options.setdefault('workers', 2)
+    options.setdefault('replay_interval', 0)
+    dispatcher = NotificationDispatcher(**options)
+    dispatcher.register_sender(channel, lambda job: post_webhook(
+        job.webhook_url, {'msgtype': 'markdown', 'markdown': {'title': job.title, 'text': job.message}}))
+    return dispatcher
+
+
+def wait_until(condition, timeout=10):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if condition():
+            return True
+        time.sleep(0.02)
+    return False
+
+
+def failed_rows():
+    session = get_session()
+    try:
+        return session.query(FailedNotification).order_by(FailedNotification.id).all()
+    finally:
+        session.close()
+
+
+def test_token_bucket_paces_deliveries(stub):
+    handler, url = stub()
+    rate = 60  # 每分钟60条: 令牌桶初始有60个令牌，之后每秒补充一个
+    dispatcher = make_dispatcher(rate_per_minute=rate)
+    for i in range(rate + 3):
+        dispatcher.submit('stub', url, None, f"t{i}", 'm')
+
+    assert wait_until(lambda: dispatcher.sent == rate + 3)
+    assert handler.received == rate + 3
+    assert dispatcher.rate_limited > 0
+    # 初始令牌用完后按补充速度（每秒一条）依次发出
+    times = handler.request_times
+    assert times[-1] - times[-2] >= 0.9
+    assert times[-2] - times[-3] >= 0.9
+
+
+def test_retryable_failure_is_retried_with_backoff(stub):
+    handler, url = stub(responses=[429])
+    dispatcher = make_dispatcher(max_attempts=3)
+    dispatcher.submit('stub', url, None, 't', 'm')
+
+    assert wait_until(lambda: dispatcher.sent == 1)
+    assert handler.received == 2
+    assert dispatcher.retried == 1
+    # 第一次失败后退避 2 秒
+    assert handler.request_times[1] - handler.request_times[0] >= 1.9
+    assert failed_rows() == []
+
+
+def test_non_retryable_failure_is_persisted_without_retry(stub):
+    handler, url = stub(responses=[400])
+    dispatcher = make_dispatcher()
+    dispatcher.submit('stub', url, 'secret', 't', 'm')
+
+    assert wait_until(lambda: len(failed_rows()) == 1)
+    assert handler.received == 1
+    assert dispatcher.retried == 0
+    rows = failed_rows()
+    assert len(rows) == 1
+    assert (rows[0].channel, rows[0].webhook_url, rows[0].attempts) == ('stub', url, 1)
+    assert '400' in rows[0].error
+
+
+def test_exhausted_retries_are_persisted(stub):
+    handler, url = stub(responses=[500, 500])
+    dispatcher = make_dispatcher(max_attempts=2)
+    dispatcher.submit('stub', url, None, 't', 'm')
+
+    assert wait_until(lambda: len(failed_rows()) == 1)
+    assert handler.received == 2
+    assert dispatcher.retried == 1
+    rows = failed_rows()
+    assert len(rows) == 1 and rows[0].attempts == 2
+
+
+def test_delayed_heap_is_bounded(stub):
+    handler, url = stub()
+    # 每分钟1条: 第一条发出后其余都被限速放入延迟队列，延迟队列只能容纳1条
+    dispatcher = make_dispatcher(rate_per_minute=1, max_delayed=1, workers=1)
+    for i in range(3):
+        dispatcher.submit('stub', url, None, f"t{i}", 'm')
+
+    assert wait_until(lambda: len(failed_rows()) == 1)
+    assert dispatcher.delayed_overflow == 1
+    assert dispatcher.get_stats()['delayed'] == 1
+    assert handler.received == 1
+    rows = failed_rows()
+    assert len(rows) == 1 and rows[0].error == '延迟队列已满' and rows[0].attempts == 0
+
+
+def test_persisted_notifications_are_replayed_on_restart(stub):
+    handler, url = stub(responses=[500, 500])
+    session = get_session()
+    session.add(Config(notification_type='wecom', wecom_webhook=url))
+    session.commit()
+    session.close()
+
+    first = make_dispatcher('wecom', max_attempts=1)
+    first.submit('wecom', url, None, 't1', 'm1')
+    first.submit('wecom', url, None, 't2', 'm2')
+    assert wait_until(lambda: len(failed_rows()) == 2)
+
+    # 模拟重启: 新的发送器启动时补发数据库中保存的通知
+    second = make_dispatcher('wecom', replay_interval=60)
+    second.start()
+    assert wait_until(lambda: second.sent == 2)
+    assert second.replayed == 2
+    assert handler.received == 4
+    assert failed_rows() == []
+
+
+def test_old_failures_are_not_replayed(stub):
+    handler, url = stub()
+    session = get_session()
+    session.add(FailedNotification(channel='wecom', webhook_url=url, title='old', message='m', error='x',
+                                   attempts=5, created_at=datetime.now() - timedelta(days=2)))
+    session.commit()
+    session.close()
+    config = database.ConfigSnapshot(1, None, None, None, None, None, 'wecom', url)
+
+    dispatcher = make_dispatcher('wecom')
+    assert dispatcher.replay_failed(config, max_age_hours=24) == 0
+    assert handler.received == 0
+    assert len(failed_rows()) == 1
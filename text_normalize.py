@@ -0,0 +1,144 @@
+"""
+匹配前的文本规整（关键词和消息使用同一张转换表）
+广告常用全角字符、零宽字符、繁体字和插入的标点绕过关键词，以前只能给同一个词加一堆变体。
+这里在启动时预先计算一张 str.translate 转换表，一次遍历完成:
+    - NFKC 兼容折叠 + 转小写（全角转半角、兼容汉字统一等）
+    - 删除零宽/格式控制字符、变体选择符
+    - 删除标点和表情等符号（默认关闭: 开启后含标点的关键词如 c#、1.5 会变成 c、15，添加这类关键词时会被拒绝）
+    - 繁体转简体（可关闭；安装了 opencc 时使用其完整字表，否则使用内置常用字表）
+规整会增删字符，NormalizedText 按需生成偏移表，把命中区间换算回原文位置。
+"""
+import os
+import unicodedata
+
+NORMALIZE_STRIP_PUNCTUATION = os.environ.get('NORMALIZE_STRIP_PUNCTUATION', '0') not in ('0', 'false', 'False')
+NORMALIZE_T2S = os.environ.get('NORMALIZE_T2S', '1') not in ('0', 'false', 'False')
+
+# 内置繁体→简体常用字表（每两个字符一组: 繁体, 简体），未安装 opencc 时使用
+BUILTIN_T2S = (
+    "資资數数據据洩泄擔担價价錢钱幣币電电報报聯联繫系係系買买賣卖號号網网會会員员機机場场節节點点"
+    "穩稳線线絡络優优貸贷銀银碼码帳账賬账戶户轉转賺赚與与為为這这個个們们來来時时間间門门開开關关"
+    "發发髮发實实現现務务單单車车東东華华國国際际對对應应變变體体庫库證证書书傳传說说話话語语訊讯"
+    "認认識识讀读誰谁請请詢询議议評评論论護护贏赢輸输險险隊队陽阳陰阴雙双雜杂難难題题類类顯显風风"
+    "飛飞館馆馬马驗验魚鱼鳥鸟黃黄齊齐龍龙萬万億亿筆笔簡简紅红約约級级紙纸組组結结給给統统經经綁绑"
+    "維维綜综總总績绩續续義义習习聽听腦脑臺台舊旧藥药蘋苹處处衛卫裝装製制複复規规視视覺觉親亲觀观"
+    "計计記记設设許许試试詐诈該该詳详誠诚課课調调談谈謝谢讓让貨货質质購购費费貼贴賭赌賽赛趕赶跡迹"
+    "蹤踪軟软輕轻載载較较輪轮農农迴回週周運运過过達达違违遠远適适選选遺遗郵邮鄉乡醫医針针鈔钞鋪铺"
+    "鍵键鏈链長长閱阅隨随隱隐雲云靈灵韓韩頁页項项順顺預预領领頻频額额願愿飯饭餘余騙骗鬥斗麗丽黨党"
+    "壓压團团圖图壞坏夠够夢梦奪夺獎奖婦妇孫孙學学寶宝審审寫写將将專专導导屆届層层島岛幫帮廣广廠厂"
+    "張张強强彈弹後后從从復复徵征懷怀態态戰战戲戏擊击擁拥擇择擴扩攝摄敗败斷断無无爭争愛爱燈灯獲获"
+    "環环產产畫画當当盤盘盡尽監监確确礎础禮礼種种積积窮穷競竞範范築筑糧粮罰罚羅罗職职聲声膠胶興兴"
+    "舉举藝艺蘭兰蟲虫術术衝冲補补裡里裏里見见訂订託托訪访誤误謀谋讚赞豐丰貝贝負负財财貿贸賀贺賓宾"
+    "賴赖贈赠躍跃輛辆辦办邊边釋释鐘钟錄录錯错鎖锁問问閃闪陣阵陳陈陸陆雞鸡離离靜静響响頭头顏颜驚惊"
+    "鬧闹麼么齒齿於于雖虽還还啟启狀状況况嗎吗沒没騷骚擾扰詞词盜盗竊窃駭骇帳账廣广滙汇匯汇鉅巨獨独"
+)
+
+# 删除的字符类别: Cf 零宽/方向控制等格式字符；P* 标点；So/Sk 表情和修饰符号
+PUNCTUATION_CATEGORIES = {'Pc', 'Pd', 'Ps', 'Pe', 'Pi', 'Pf', 'Po', 'So', 'Sk'}
+STRIP_CATEGORIES = {'Cf'}
+if NORMALIZE_STRIP_PUNCTUATION:
+    STRIP_CATEGORIES |= PUNCTUATION_CATEGORIES
+
+# 组合用的变体选择符、表情键帽等（类别为 Mn/Me，单独列出）
+STRIP_CODEPOINTS = set(range(0xFE00, 0xFE10)) | set(range(0xE0100, 0xE01F0)) | {0x20E3, 0x034F}
+
+# 生成转换表时检查的码位: 基本平面 + 表情所在的第一辅助平面 + 标签字符
+TABLE_RANGES = (range(0x20000), range(0xE0000, 0xE0080), range(0xE0100, 0xE01F0))
+
+
+def _load_t2s():
+    if not NORMALIZE_T2S:
+        return {}
+    mapping = {BUILTIN_T2S[i]: BUILTIN_T2S[i + 1] for i in range(0, len(BUILTIN_T2S), 2)}
+    try:
+        import opencc
+        converter = opencc.OpenCC('t2s')
+        for codepoint in range(0x4E00, 0xA000):
+            char = chr(codepoint)
+            converted = converter.convert(char)
+            if converted != char and len(converted) == 1:
+                mapping[char] = converted
+    except ImportError:
+        pass
+    except Exception as e:
+        print(f"[文本规整] opencc 加载失败，使用内置繁简字表: {e}")
+    return mapping
+
+
+def _strip(char):
+    return ord(char) in STRIP_CODEPOINTS or unicodedata.category(char) in STRIP_CATEGORIES
+
+
+def build_translation_table():
+    """预先计算转换表: {码位: 替换字符串或 None（删除）}，只包含会变化的字符"""
+    t2s = _load_t2s()
+    table = {}
+    for codepoints in TABLE_RANGES:
+        for codepoint in codepoints:
+            if 0xD800 <= codepoint < 0xE000:  # 代理区
+                continue
+            char = chr(codepoint)
+            if _strip(char):
+                table[codepoint] = None
+                continue
+            folded = unicodedata.normalize('NFKC', char).lower()
+            folded = ''.join(t2s.get(c, c) for c in folded if not _strip(c))
+            if folded != char:
+                table[codepoint] = folded or None
+    return table
+
+
+TRANSLATION_TABLE = build_translation_table()
+
+# 规整规则的签名（规则或字表变化时，磁盘上的预编译自动机需要失效）
+TABLE_SIGNATURE = f"{len(TRANSLATION_TABLE)}:{int(NORMALIZE_STRIP_PUNCTUATION)}:{int(NORMALIZE_T2S)}"
+
+
+def normalize(text):
+    """规整文本（一次 str.translate）"""
+    return text.translate(TRANSLATION_TABLE)
+
+
+def stripped_symbols(text):
+    """
+    关键词中规整时会被删除的标点和符号（去重后连接成字符串，未开启删除标点时为空）
+    这些字符被删除后关键词的含义会改变（c# → c），添加关键词时据此拒绝
+    """
+    if not NORMALIZE_STRIP_PUNCTUATION:
+        return ''
+    folded = unicodedata.normalize('NFKC', text)
+    return ''.join(dict.fromkeys(char for char in folded if unicodedata.category(char) in PUNCTUATION_CATEGORIES))
+
+
+class NormalizedText:
+    """
+    规整后的文本及到原文的偏移映射
+    偏移表只在需要换算命中区间时才生成（绝大多数消息没有命中，不必付出这部分开销）
+    """
+    __slots__ = ('original', 'text', '_offsets')
+
+    def __init__(self, original):
+        self.original = original
+        self.text = normalize(original)
+        self._offsets = None
+
+    @property
+    def offsets(self):
+        """offsets[i] 为规整后第 i 个字符在原文中的位置"""
+        if self._offsets is None:
+            if len(self.text) == len(self.original) and self.text == self.original:
+                self._offsets = range(len(self.original))
+            else:
+                offsets = []
+                table = TRANSLATION_TABLE
+                for index, char in enumerate(self.original):
+                    replacement = table.get(ord(char), char)
+                    if replacement:
+                        offsets.extend([index] * len(replacement))
+                self._offsets = offsets
+        return self._offsets
+
+    def original_span(self, start, end):
+        """把规整文本中的区间 [start, end) 换算为原文中的区间"""
+        offsets = self.offsets
+        return offsets[start], offsets[end - 1] + 1